@@ -0,0 +1,67 @@
+# Measures how long a fresh LocalDocumentIndex takes to load index.json and
+# catalog.json from disk, and fails if it's over budget.
+#
+#   python benchmarks/bench_cold_load.py [--documents 100] [--chunks 10] [--budget-ms 50]
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+from local_document_index import LocalDocumentIndex, LocalDocumentIndexConfig  # noqa: E402
+from local_index import CreateIndexConfig  # noqa: E402
+from text_splitter import TextChunk  # noqa: E402
+
+
+def open_index(folder_path: str) -> LocalDocumentIndex:
+    # The tokenizer is never used as nothing is split
+    return LocalDocumentIndex(LocalDocumentIndexConfig(folder_path=folder_path, tokenizer=object()))
+
+
+async def build_index(folder_path: str, documents: int, chunks: int, dimensions: int) -> None:
+    index = open_index(folder_path)
+    await index.create_index(CreateIndexConfig(version=1, delete_if_exists=True))
+    await index.begin_update()
+    for i in range(documents):
+        document_id = f'doc-{i}'
+        document_chunks = [TextChunk(text='', tokens=[0] * 100, start_pos=j * 400, end_pos=j * 400 + 399,
+                                     start_overlap=[], end_overlap=[]) for j in range(chunks)]
+        vectors = [[random.random() for _ in range(dimensions)] for _ in range(chunks)]
+        await index.add_chunks_to_update(document_id, document_chunks, vectors)
+        index.add_document_to_catalog(f'https://example.com/{i}', document_id)
+    await index.end_update()
+
+
+async def cold_load(folder_path: str) -> float:
+    start = time.perf_counter()
+    await open_index(folder_path).load_index_data()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=100)
+    parser.add_argument('--chunks', type=int, default=10, help='chunks per document')
+    parser.add_argument('--dimensions', type=int, default=32)
+    parser.add_argument('--runs', type=int, default=5, help='loads to time, the fastest is reported')
+    parser.add_argument('--budget-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        folder_path = os.path.join(folder, 'index')
+        asyncio.run(build_index(folder_path, args.documents, args.chunks, args.dimensions))
+        ms = min(asyncio.run(cold_load(folder_path)) for _ in range(args.runs))
+
+    print(f'{args.documents} documents, {args.documents * args.chunks} chunks: cold load {ms:.1f}ms')
+    if ms > args.budget_ms:
+        print(f'FAIL over {args.budget_ms:.0f}ms budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Compares index.json save and load time, file size and peak memory for each JSON
+# codec and vector encoding on a synthetic index, and the time to lazily open the
+# columnar file.
+#
+#   python benchmarks/bench_index_codec.py [--items 20000] [--dimensions 1536]
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+from index_file import (  # noqa: E402
+    VECTOR_ENCODING_COLUMNAR,
+    VECTOR_ENCODING_FLOAT32,
+    VECTOR_ENCODING_JSON,
+    open_index_file,
+    read_index_file,
+    write_index_file,
+)
+
+
+def make_index(items: int, dimensions: int) -> dict:
+    return {
+        "version": 1,
+        "metadata_config": {},
+        "items": [{
+            "id": f"item-{i}",
+            "metadata": {"document_id": f"doc-{i // 10}", "start_pos": i * 400, "end_pos": i * 400 + 399},
+            "vector": [random.uniform(-1, 1) for _ in range(dimensions)],
+            "norm": 1.0,
+        } for i in range(items)],
+    }
+
+
+def measure(fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    # Timed without tracemalloc, which slows allocation heavy code down a lot
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    args = parser.parse_args()
+
+    data = make_index(args.items, args.dimensions)
+    codecs = ['json'] + (['orjson'] if importlib.util.find_spec('orjson') else [])
+
+    print(f"{args.items} items x {args.dimensions} dimensions")
+    print(f"{'codec':>8} {'vectors':>16} {'size MB':>9} {'save s':>8} {'save peak MB':>13} {'load s':>8} {'load peak MB':>13}")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'index.json')
+        for codec in codecs:
+            for vector_encoding in (VECTOR_ENCODING_JSON, VECTOR_ENCODING_FLOAT32, VECTOR_ENCODING_COLUMNAR):
+                save_time, save_peak = measure(lambda: write_index_file(
+                    path, data, keep_previous=False, codec=codec, vector_encoding=vector_encoding))
+                load_time, load_peak = measure(lambda: read_index_file(path, codec))
+                size = os.path.getsize(path)
+                print(f"{codec:>8} {vector_encoding:>16} {size / 1e6:>9.1f} {save_time:>8.2f} {save_peak / 1e6:>13.1f} "
+                      f"{load_time:>8.2f} {load_peak / 1e6:>13.1f}")
+            # Lazy loading of the columnar file just written reads its header and ids
+            open_time, open_peak = measure(lambda: open_index_file(path, codec)["items"].close())
+            print(f"{codec:>8} {'lazy open':>16} {'':>9} {'':>8} {'':>13} {open_time:>8.2f} {open_peak / 1e6:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
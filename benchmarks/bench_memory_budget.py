@@ -0,0 +1,68 @@
+# Runs the same query mix against a lazily loaded index under several memory budgets
+# and reports the vector cache hit rate, bytes read per query and query latency, to
+# help size a budget. Most queries repeat a small set of hot query vectors.
+#
+#   python benchmarks/bench_memory_budget.py [--items 50000] [--dimensions 384] [--queries 200]
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+from local_index import LocalIndex  # noqa: E402
+
+
+async def build_index(folder_path: str, items: int, dimensions: int) -> None:
+    index = LocalIndex(folder_path, lazy=True)
+    await index.create_index()
+    await index.begin_update()
+    for i in range(items):
+        await index.add_item_to_update({
+            "id": f"item-{i}",
+            "vector": [random.uniform(-1, 1) for _ in range(dimensions)],
+            "metadata": {"position": i},
+        }, True)
+    await index.end_update()
+
+
+async def run_queries(folder_path: str, memory_budget: int, queries: list) -> dict:
+    index = LocalIndex(folder_path, memory_budget=memory_budget)
+    start = time.perf_counter()
+    for vector in queries:
+        await index.query_items(vector, 10)
+    stats = index.get_cache_stats()
+    stats["ms_per_query"] = (time.perf_counter() - start) * 1000 / len(queries)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--dimensions', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--hot', type=int, default=5, help='distinct query vectors making up most queries')
+    args = parser.parse_args()
+
+    hot = [[random.uniform(-1, 1) for _ in range(args.dimensions)] for _ in range(args.hot)]
+    queries = [random.choice(hot) if random.random() < 0.8 else [random.uniform(-1, 1) for _ in range(args.dimensions)]
+               for _ in range(args.queries)]
+    vector_bytes = args.items * (args.dimensions * 4 + 8)
+
+    with tempfile.TemporaryDirectory() as folder:
+        folder_path = os.path.join(folder, 'index')
+        asyncio.run(build_index(folder_path, args.items, args.dimensions))
+        print(f"{args.items} items x {args.dimensions} dimensions, {vector_bytes / 1e6:.1f}MB of vectors")
+        print(f"{'budget MB':>10} {'hit rate':>9} {'MB read/query':>14} {'ms/query':>9}")
+        for fraction in (0.1, 0.25, 0.5, 1.0):
+            stats = asyncio.run(run_queries(folder_path, int(vector_bytes * fraction), queries))
+            print(f"{vector_bytes * fraction / 1e6:>10.1f} {stats['hit_rate']:>9.2f} "
+                  f"{stats['bytes_read_per_query'] / 1e6:>14.2f} {stats['ms_per_query']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Guards against startup regressions: imports each entry point in a fresh interpreter,
+# reports the time taken and fails if it's over budget or if a heavy backend
+# (transformers, tiktoken, bs4, ...) was imported before it's actually used.
+#
+#   python benchmarks/bench_startup.py [--budget-ms 250] [--runs 3]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+HEAVY_MODULES = [
+    'transformers',
+    'sentence_transformers',
+    'torch',
+    'tiktoken',
+    'bs4',
+    'markdownify',
+    'lxml',
+    'requests',
+]
+
+ENTRY_POINTS = {
+    'local_index': 'import local_index',
+    'local_document_index': 'import local_document_index',
+    'text_splitter': 'import text_splitter',
+    'ingest_pipeline': 'import ingest_pipeline',
+    'openai_embeddings': (
+        'from openai_embeddings import OpenAIEmbeddings, OpenAIEmbeddingsOptions\n'
+        'OpenAIEmbeddings(OpenAIEmbeddingsOptions(api_key="", model="text-embedding-ada-002"))'
+    ),
+    'oss_embeddings': (
+        'from oss_embeddings import OSSEmbeddings, OSSEmbeddingsOptions\n'
+        'OSSEmbeddings(OSSEmbeddingsOptions(model="sentence-transformers/all-MiniLM-L6-v2", tokenizer=None))'
+    ),
+    'vectra-cli': (
+        'import importlib.util\n'
+        f'spec = importlib.util.spec_from_file_location("vectra_cli", {os.path.join(SRC, "vectra-cli.py")!r})\n'
+        'spec.loader.exec_module(importlib.util.module_from_spec(spec))'
+    ),
+}
+
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+{statement}
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{"ms": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def probe(statement: str) -> dict:
+    code = PROBE.format(src=SRC, statement=statement, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=250, help='max import time per entry point')
+    parser.add_argument('--runs', type=int, default=3, help='runs per entry point, the fastest is reported')
+    args = parser.parse_args()
+
+    failures = []
+    for name, statement in ENTRY_POINTS.items():
+        results = [probe(statement) for _ in range(args.runs)]
+        ms = min(result['ms'] for result in results)
+        heavy = results[0]['heavy']
+        status = 'ok'
+        if heavy:
+            status = f"FAIL imported {', '.join(heavy)}"
+        elif ms > args.budget_ms:
+            status = f'FAIL over {args.budget_ms:.0f}ms budget'
+        if status != 'ok':
+            failures.append(name)
+        print(f'{name:>22}: {ms:8.1f}ms  {status}')
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Compares TextSplitter's separator and alphanumeric scan with the original one, which
+# checked each part character by character and split oversized text at every
+# separator level, on large generated Python, markdown, HTML and CJK inputs. Both must
+# give the same chunks.
+#
+#   python benchmarks/bench_text_splitter.py [--size 2000000] [--chunk-size 512] [--tokenizer chars]
+#
+# The chars tokenizer counts four characters per token, leaving the scan as most of
+# the work. With gpt3 most of the time goes to tiktoken.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+from gpt3_tokenizer import GPT3Tokenizer  # noqa: E402
+from text_splitter import ALPHANUMERIC_CHARS, TextSplitter  # noqa: E402
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'value', 'result', 'index', 'vector', 'token', 'chunk']
+CJK_WORDS = ['数据', '向量', '索引', '文档', '查询', '结果', 'データ', '検索']
+
+
+class CharTokenizer:
+    def encode(self, text):
+        return [0] * (len(text) // 4 + 1)
+
+    def decode(self, tokens):
+        return ''
+
+
+class OriginalTextSplitter(TextSplitter):
+    def contains_alphanumeric(self, text: str) -> bool:
+        return any(char in ALPHANUMERIC_CHARS for char in text)
+
+    def _skip_absent_separators(self, text, separators):
+        return separators
+
+
+def make_python(size: int) -> str:
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        name = random.choice(WORDS)
+        body = '\n'.join(f"    {random.choice(WORDS)} = {random.choice(WORDS)}({random.randint(0, 99)})"
+                         for _ in range(random.randint(2, 30)))
+        parts.append(random.choice([f"\ndef {name}():\n{body}\n", f"\nclass {name.title()}:\n{body}\n\n"]))
+    return ''.join(parts)
+
+
+def make_markdown(size: int) -> str:
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        heading = '#' * random.randint(2, 4)
+        paragraphs = '\n\n'.join(' '.join(random.choices(WORDS, k=random.randint(20, 120)))
+                                 for _ in range(random.randint(1, 6)))
+        parts.append(f"\n{heading} {random.choice(WORDS)}\n\n{paragraphs}\n")
+    return ''.join(parts)
+
+
+def make_html(size: int) -> str:
+    parts = ['<body>']
+    while sum(len(part) for part in parts) < size:
+        tag = random.choice(['<p>', '<div>', '<li>', '<td>', '<span>'])
+        parts.append(f"{tag}{' '.join(random.choices(WORDS, k=random.randint(5, 80)))}")
+    return ''.join(parts)
+
+
+def make_cjk(size: int) -> str:
+    # Mostly text without ASCII letters or digits, with a numbered heading per section
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        sentences = '。'.join(''.join(random.choices(CJK_WORDS, k=random.randint(5, 40)))
+                             for _ in range(random.randint(3, 20)))
+        parts.append(f"\n## {random.randint(1, 999)}\n\n{sentences}\n")
+    return ''.join(parts)
+
+
+def summarize(chunks):
+    return [(chunk.text, chunk.tokens, chunk.start_pos, chunk.end_pos) for chunk in chunks]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2_000_000, help='characters per generated document')
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--tokenizer', choices=['gpt3', 'chars'], default='gpt3')
+    args = parser.parse_args()
+
+    random.seed(42)
+    # No token cache, so the first run doesn't warm it up for the second
+    tokenizer = GPT3Tokenizer(cache_size=0) if args.tokenizer == 'gpt3' else CharTokenizer()
+    for doc_type, make in [('py', make_python), ('md', make_markdown), ('html', make_html), ('md', make_cjk)]:
+        text = make(args.size)
+        config = {
+            'keep_separators': True,
+            'chunk_size': args.chunk_size,
+            'chunk_overlap': 0,
+            'tokenizer': tokenizer,
+            'doc_type': doc_type,
+        }
+
+        start = time.perf_counter()
+        original = OriginalTextSplitter(dict(config)).split(text)
+        original_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunks = TextSplitter(dict(config)).split(text)
+        current_time = time.perf_counter() - start
+
+        identical = summarize(original) == summarize(chunks)
+        print(f"{make.__name__[5:]:>8}: {len(text):,} chars, {len(chunks):,} chunks | "
+              f"original {original_time:.3f}s | current {current_time:.3f}s | "
+              f"speedup {original_time / current_time:.2f}x | identical={identical}")
+        if not identical:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,68 @@
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer
+import threading
 
 
 class OSSTokenizer:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        # Load model from HuggingFace Hub
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", add_special_tokens: bool = True):
+        self.model_name = model_name
+        self.add_special_tokens = add_special_tokens
+        self._tokenizer = None
+        self._load_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to split_batch workers without the lock, reloading the model on first use
+        return {"model_name": self.model_name, "add_special_tokens": self.add_special_tokens}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def tokenizer(self):
+        # transformers is slow to import and the model may need downloading,
+        # so both wait until the tokenizer is first used
+        if self._tokenizer is None:
+            with self._load_lock:
+                if self._tokenizer is None:
+                    from transformers import AutoTokenizer
+                    # Load model from HuggingFace Hub, preferring the Rust-backed fast tokenizer
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+        return self._tokenizer
 
     def decode(self, tokens):
-        pass
+        return self.tokenizer.decode(tokens, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
     def encode(self, text):
         try:
-            if len(text) > 1:  # if text is a list of strings
-                data = [self.tokenizer.encode(item) for item in text]
-                return data
-            else:
-                data = self.tokenizer.encode(text)
-                return data
+            if isinstance(text, str):
+                return self.tokenizer.encode(text, add_special_tokens=self.add_special_tokens)
+            else:  # text is a list of strings
+                return self.encode_batch(text)
         except Exception as e:
             print('encoding error', e)
             return None
+
+    def encode_batch(self, texts, num_threads: int = None):
+        # The fast tokenizer encodes the whole batch in parallel in Rust
+        if not texts:
+            return []
+        encoding = self.tokenizer(
+            list(texts),
+            add_special_tokens=self.add_special_tokens,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return encoding["input_ids"]
+
+    def count_tokens(self, text) -> int:
+        return len(self.encode(text))
+
+    def encode_with_offsets(self, text):
+        # Returns the tokens along with the character offset each token starts at.
+        # Special tokens are left out as they don't map to any text.
+        encoding = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return encoding["input_ids"], [start for start, _ in encoding["offset_mapping"]]
@@ -0,0 +1,170 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import List, Union, Dict, Any
+
+from custom_types import EmbeddingsResponse
+
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048]
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram. Each bucket counts the observations that are
+    less than or equal to its upper bound, the last bucket catches the rest.
+    """
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={bucket}" for bucket in self.buckets] + ["+inf"]
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class BatchingEmbeddingsOptions:
+    def __init__(
+        self,
+        max_wait_ms: float = 5,
+        max_batch_size: int = 64,
+        max_concurrent_batches: int = 4,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        if max_concurrent_batches < 1:
+            raise ValueError("max_concurrent_batches must be >= 1")
+        self.max_wait_ms = max_wait_ms
+        self.max_batch_size = max_batch_size
+        self.max_concurrent_batches = max_concurrent_batches
+
+
+class BatchingEmbeddings:
+    """
+    Embeddings front-end that gathers concurrent create_embeddings calls made
+    within a short window into a single call on the wrapped model
+    (OpenAIEmbeddings, OSSEmbeddings, ...) and fans the vectors back out.
+    Anything else (options, tokenizer, model) is read from the wrapped model.
+    """
+    def __init__(self, embeddings, batch_options: BatchingEmbeddingsOptions = None):
+        self.embeddings = embeddings
+        self.batch_options = batch_options or BatchingEmbeddingsOptions()
+        self.latency_histogram = Histogram(LATENCY_BUCKETS_MS)
+        self.batch_size_histogram = Histogram(BATCH_SIZE_BUCKETS)
+        self._pending = []  # (inputs, future, enqueued_at)
+        self._pending_count = 0
+        self._flush_handle = None
+        self._semaphore = None
+        self._tasks = set()
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails. copy and pickle look up hooks on an
+        # instance whose __init__ hasn't run, so a missing wrapped model must raise
+        # AttributeError rather than KeyError
+        try:
+            embeddings = object.__getattribute__(self, "embeddings")
+        except AttributeError:
+            raise AttributeError(name) from None
+        return getattr(embeddings, name)
+
+    @property
+    def max_tokens(self):
+        return self.embeddings.max_tokens
+
+    async def create_embeddings(self, inputs: Union[str, List[str]]) -> EmbeddingsResponse:
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        # Don't let a new request push the pending batch over the limit
+        if self._pending and self._pending_count + len(inputs) > self.batch_options.max_batch_size:
+            self._flush()
+
+        self._pending.append((inputs, future, time.perf_counter()))
+        self._pending_count += len(inputs)
+        if self._pending_count >= self.batch_options.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_options.max_wait_ms / 1000, self._flush)
+
+        return await future
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "latency_ms": self.latency_histogram.to_dict(),
+            "batch_size": self.batch_size_histogram.to_dict(),
+        }
+
+    def reset_stats(self) -> None:
+        self.latency_histogram.reset()
+        self.batch_size_histogram.reset()
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        self._pending_count = 0
+        task = asyncio.ensure_future(self._dispatch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, pending) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.batch_options.max_concurrent_batches)
+
+        batch = [text for inputs, _, _ in pending for text in inputs]
+        self.batch_size_histogram.observe(len(batch))
+        try:
+            async with self._semaphore:
+                response = await self.embeddings.create_embeddings(batch)
+        except Exception as err:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        if response.status == 'success' and len(response.output or []) != len(batch):
+            response = EmbeddingsResponse(
+                status="error",
+                message=f"Expected {len(batch)} embeddings but received {len(response.output or [])}",
+            )
+
+        finished = time.perf_counter()
+        offset = 0
+        for inputs, future, enqueued_at in pending:
+            self.latency_histogram.observe((finished - enqueued_at) * 1000)
+            if not future.done():
+                if response.status == 'success':
+                    future.set_result(EmbeddingsResponse(
+                        status="success",
+                        output=response.output[offset:offset + len(inputs)],
+                        message=response.message,
+                    ))
+                else:
+                    future.set_result(EmbeddingsResponse(status=response.status, message=response.message))
+            offset += len(inputs)
@@ -0,0 +1,234 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+CATALOG_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog_info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    content_hash TEXT,
+    token_count INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    document_id TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_document_id ON chunks (document_id);
+"""
+
+
+@dataclass
+class DocumentRecord:
+    id: str
+    uri: str
+    chunk_ids: List[str] = field(default_factory=list)
+    content_hash: Optional[str] = None
+    token_count: int = 0
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+
+class DocumentCatalog:
+    """
+    The documents of a LocalDocumentIndex, each with its uri, chunk ids, content hash,
+    token count and timestamps. It's kept in a sqlite database (catalog.db) so a commit
+    only writes the rows of the documents that changed.
+
+    Changes are staged between begin and commit. Lookups with pending=True see the
+    staged changes, other lookups only see committed documents.
+
+    Each commit can record the index generation it belongs to, so the index can tell
+    whether the catalog has caught up with it.
+    """
+    def __init__(self, folder_path: str):
+        self._folder_path = folder_path
+        self._path = os.path.join(folder_path, 'catalog.db')
+        self._connection = None
+        self._lock = threading.Lock()
+        self._changes = None  # document id -> DocumentRecord, or None when deleted
+        self._uri_changes = None  # uri -> document id, or None when deleted
+
+    @property
+    def is_open(self) -> bool:
+        return self._connection is not None
+
+    @property
+    def in_update(self) -> bool:
+        return self._changes is not None
+
+    def open(self) -> None:
+        if self._connection is not None:
+            return
+        # Opened in a worker thread by load_index_data but used from the event loop
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.execute("INSERT OR IGNORE INTO catalog_info (key, value) VALUES ('version', ?)",
+                               (str(CATALOG_VERSION),))
+        self._connection = connection
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self._changes = None
+            self._uri_changes = None
+
+    @property
+    def version(self) -> int:
+        row = self._query_one("SELECT value FROM catalog_info WHERE key = 'version'")
+        return int(row[0]) if row else CATALOG_VERSION
+
+    @property
+    def generation(self) -> int:
+        row = self._query_one("SELECT value FROM catalog_info WHERE key = 'generation'")
+        return int(row[0]) if row else 0
+
+    def needs_migration(self) -> bool:
+        return os.path.exists(self._json_path) and self.count() == 0
+
+    def migrate(self, items: Iterable[Dict[str, Any]]) -> None:
+        """
+        Imports a catalog.json written by earlier versions. The index items are used to
+        recover each document's chunk ids and token counts. The old file is kept as
+        catalog.json.bak.
+        """
+        with open(self._json_path, 'r') as catalog_file:
+            catalog = json.load(catalog_file)
+
+        now = time.time()
+        records = {
+            document_id: DocumentRecord(id=document_id, uri=uri, created_at=now, updated_at=now)
+            for document_id, uri in catalog.get('id_to_uri', {}).items()
+        }
+        for item in items:
+            record = records.get(item["metadata"].get("document_id"))
+            if record is not None:
+                record.chunk_ids.append(item["id"])
+                record.token_count += item["metadata"].get("token_count", 0)
+
+        self.begin()
+        for record in records.values():
+            self.upsert(record)
+        self.commit()
+        os.replace(self._json_path, f'{self._json_path}.bak')
+
+    def count(self) -> int:
+        return self._query_one("SELECT COUNT(*) FROM documents")[0]
+
+    def get_document_id(self, uri: str, pending: bool = False) -> Optional[str]:
+        if pending and self._uri_changes is not None and uri in self._uri_changes:
+            return self._uri_changes[uri]
+        row = self._query_one("SELECT id FROM documents WHERE uri = ?", (uri,))
+        return row[0] if row else None
+
+    def get_document_uri(self, document_id: str, pending: bool = False) -> Optional[str]:
+        record = self.get_document(document_id, pending, with_chunks=False)
+        return record.uri if record else None
+
+    def get_document(self, document_id: str, pending: bool = False, with_chunks: bool = True) -> Optional[DocumentRecord]:
+        if pending and self._changes is not None and document_id in self._changes:
+            return self._changes[document_id]
+        row = self._query_one(
+            "SELECT id, uri, content_hash, token_count, created_at, updated_at FROM documents WHERE id = ?",
+            (document_id,)
+        )
+        if row is None:
+            return None
+        record = DocumentRecord(id=row[0], uri=row[1], content_hash=row[2], token_count=row[3],
+                                created_at=row[4], updated_at=row[5])
+        if with_chunks:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id FROM chunks WHERE document_id = ? ORDER BY position", (document_id,)
+                ).fetchall()
+            record.chunk_ids = [chunk_id for chunk_id, in rows]
+        return record
+
+    def begin(self) -> None:
+        self._changes = {}
+        self._uri_changes = {}
+
+    def cancel(self) -> None:
+        self._changes = None
+        self._uri_changes = None
+
+    def upsert(self, record: DocumentRecord) -> None:
+        self._changes[record.id] = record
+        self._uri_changes[record.uri] = record.id
+
+    def delete(self, document_id: str) -> None:
+        uri = self.get_document_uri(document_id, pending=True)
+        if uri is not None:
+            self._uri_changes[uri] = None
+        self._changes[document_id] = None
+
+    def pending_changes(self) -> Dict[str, Any]:
+        """
+        Returns the staged changes in a form that can be saved as JSON and passed to apply.
+        """
+        return {
+            "upserted": [asdict(record) for record in self._changes.values() if record is not None],
+            "deleted": [document_id for document_id, record in self._changes.items() if record is None],
+        }
+
+    def apply(self, changes: Dict[str, Any], generation: Optional[int] = None) -> None:
+        """
+        Commits changes returned by pending_changes.
+        """
+        self.begin()
+        for document_id in changes["deleted"]:
+            self.delete(document_id)
+        for record in changes["upserted"]:
+            self.upsert(DocumentRecord(**record))
+        self.commit(generation)
+
+    def commit(self, generation: Optional[int] = None) -> None:
+        """
+        Writes the staged changes, and the index generation when given, in a single
+        transaction.
+        """
+        changes = self._changes
+        deleted = [(document_id,) for document_id, record in changes.items() if record is None]
+        upserted = [record for record in changes.values() if record is not None]
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM documents WHERE id = ?", deleted)
+            self._connection.executemany("DELETE FROM chunks WHERE document_id = ?",
+                                         deleted + [(record.id,) for record in upserted])
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO documents (id, uri, content_hash, token_count, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(record.id, record.uri, record.content_hash, record.token_count, record.created_at,
+                  record.updated_at) for record in upserted]
+            )
+            self._connection.executemany(
+                "INSERT INTO chunks (id, document_id, position) VALUES (?, ?, ?)",
+                [(chunk_id, record.id, i) for record in upserted for i, chunk_id in enumerate(record.chunk_ids)]
+            )
+            if generation is not None:
+                self._connection.execute("INSERT OR REPLACE INTO catalog_info (key, value) VALUES ('generation', ?)",
+                                         (str(generation),))
+        self._changes = None
+        self._uri_changes = None
+
+    @property
+    def _json_path(self) -> str:
+        return os.path.join(self._folder_path, 'catalog.json')
+
+    def _query_one(self, sql: str, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchone()
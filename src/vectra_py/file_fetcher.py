@@ -1,25 +1,133 @@
+import asyncio
+import fnmatch
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Union
 
 
 class FileFetcher:
-    async def fetch(self, uri):
-        # Check if the path exists and whether it's a directory
-        if os.path.exists(uri):
-            if os.path.isdir(uri):
-                # If it's a directory, read all files and recurse
-                files = os.listdir(uri)
-                for file in files:
-                    file_path = os.path.join(uri, file)
-                    await self.fetch(file_path)
-                return True
-            else:
-                # If it's a file, read its contents
-                with open(uri, 'r', encoding='utf-8') as file:
-                    text = file.read()
-                    # Determine the document type based on the file extension
-                    _, file_extension = os.path.splitext(uri)
-                    doc_type = file_extension[1:].lower() if file_extension else None
-                    return uri, text, doc_type
-        else:
-            # Handle the case where the path doesn't exist
+    """
+    Fetches a file, or every file below a folder, yielding (uri, text, doc_type).
+    Folders are walked with os.scandir and files are read concurrently in a thread
+    pool. Files larger than stream_threshold are yielded with text as an iterator of
+    text blocks instead of a single string so they are never read whole. The include,
+    exclude and max_file_size filters also apply to a single file, matched by its name.
+    """
+    def __init__(self, config=None):
+        self._config = {
+            "include": None,  # glob patterns a file must match, e.g. ["*.md", "docs/*"]
+            "exclude": [],  # glob patterns of files and folders to skip
+            "max_file_size": None,  # in bytes, larger files are skipped
+            "max_workers": 8,
+            "block_size": 1 << 20,
+            "stream_threshold": 16 << 20,
+        }
+        if config:
+            self._config.update(config)
+
+    async def fetch(self, uri) -> AsyncIterator[Tuple[str, Union[str, Iterator[str]], Optional[str]]]:
+        if not os.path.exists(uri):
+            raise Exception(f'File or folder "{uri}" not found')
+
+        loop = asyncio.get_running_loop()
+        max_workers = self._config["max_workers"]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            if not os.path.isdir(uri):
+                # The filters match a single file by its name
+                name = os.path.basename(uri)
+                size = os.path.getsize(uri)
+                if self._is_excluded(name, name) or self._is_too_large(size):
+                    return
+                text = await loop.run_in_executor(pool, self.read_file, uri, size)
+                yield uri, text, self.get_doc_type(uri)
+                return
+
+            entries = await loop.run_in_executor(pool, lambda: list(self.walk(uri)))
+
+            # Keep a bounded window of reads in flight and yield them in walk order
+            pending = []
+            for path, size in entries:
+                pending.append((path, loop.run_in_executor(pool, self.read_file, path, size)))
+                if len(pending) >= max_workers * 2:
+                    result = await self._next_result(pending.pop(0))
+                    if result:
+                        yield result
+            for entry in pending:
+                result = await self._next_result(entry)
+                if result:
+                    yield result
+
+    def walk(self, root: str) -> Iterator[Tuple[str, int]]:
+        """
+        Yields (path, size) for every file below root that passes the include,
+        exclude and max_file_size filters.
+        """
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            try:
+                with os.scandir(folder) as scanner:
+                    entries = sorted(scanner, key=lambda entry: entry.name)
+            except OSError as err:
+                print(f'Error reading folder "{folder}": {str(err)}')
+                continue
+
+            subfolders = []
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                if entry.is_dir(follow_symlinks=False):
+                    if not self._is_excluded(relative_path, entry.name, is_file=False):
+                        subfolders.append(entry.path)
+                elif entry.is_file():
+                    if self._is_excluded(relative_path, entry.name):
+                        continue
+                    size = entry.stat().st_size
+                    if self._is_too_large(size):
+                        continue
+                    yield entry.path, size
+            # Visit subfolders in name order
+            folders.extend(reversed(subfolders))
+
+    def read_file(self, path: str, size: int) -> Union[str, Iterator[str]]:
+        if size > self._config["stream_threshold"]:
+            return self.iter_blocks(path)
+        with open(path, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def iter_blocks(self, path: str) -> Iterator[str]:
+        with open(path, 'r', encoding='utf-8') as file:
+            while True:
+                block = file.read(self._config["block_size"])
+                if not block:
+                    return
+                yield block
+
+    @staticmethod
+    def get_doc_type(path: str) -> Optional[str]:
+        # Determine the document type based on the file extension
+        _, file_extension = os.path.splitext(path)
+        return file_extension[1:].lower() if file_extension else None
+
+    async def _next_result(self, entry):
+        path, future = entry
+        try:
+            text = await future
+        except (UnicodeDecodeError, OSError) as err:
+            print(f'Error reading file "{path}": {str(err)}')
             return None
+        return path, text, self.get_doc_type(path)
+
+    def _is_excluded(self, relative_path: str, name: str, is_file: bool = True) -> bool:
+        if self._matches(self._config["exclude"], relative_path, name):
+            return True
+        # include only applies to files, folders are walked for files that match
+        return is_file and bool(self._config["include"]) and not self._matches(self._config["include"],
+                                                                               relative_path, name)
+
+    def _is_too_large(self, size: int) -> bool:
+        return self._config["max_file_size"] is not None and size > self._config["max_file_size"]
+
+    @staticmethod
+    def _matches(patterns: List[str], relative_path: str, name: str) -> bool:
+        return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern)
+                   for pattern in patterns or [])
@@ -1,13 +1,99 @@
-import tiktoken
-# from tiktoken import encode, decode
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Texts longer than this are encoded without going through the cache
+MAX_CACHED_TEXT_LENGTH = 16384
+
+# Encodings are shared by every tokenizer for the same model
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(model_name: str):
+    encoding = _encodings.get(model_name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model_name)
+            if encoding is None:
+                # Imported on first use to keep tiktoken out of startup
+                import tiktoken
+                encoding = tiktoken.encoding_for_model(model_name)
+                _encodings[model_name] = encoding
+    return encoding
 
 
 class GPT3Tokenizer:
-    def __init__(self, model_name: str = "gpt-3.5-turbo"):
-        self.encoding = tiktoken.encoding_for_model(model_name)
+    def __init__(self, model_name: str = "gpt-3.5-turbo", cache_size: int = 4096):
+        self.model_name = model_name
+        # LRU cache of text hash -> tokens for strings that get encoded repeatedly
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to split_batch workers without the cache and its lock
+        return {"model_name": self.model_name, "cache_size": self._cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def encoding(self):
+        return get_encoding(self.model_name)
 
     def decode(self, tokens):
         return self.encoding.decode(tokens)
 
     def encode(self, text):
-        return self.encoding.encode(text)
+        return list(self._encode_cached(text))
+
+    def encode_batch(self, texts, num_threads: int = 8):
+        # Look up every text first, then encode the misses in one multi-threaded call
+        results = [self._cache_get(text) for text in texts]
+        misses = [i for i, tokens in enumerate(results) if tokens is None]
+        if misses:
+            encoded = self.encoding.encode_batch([texts[i] for i in misses], num_threads=num_threads)
+            for i, tokens in zip(misses, encoded):
+                results[i] = self._cache_put(texts[i], tokens)
+        return [list(tokens) for tokens in results]
+
+    def count_tokens(self, text) -> int:
+        return len(self._encode_cached(text))
+
+    def encode_with_offsets(self, text):
+        # Returns the tokens along with the character offset each token starts at
+        tokens = self.encoding.encode(text)
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        return tokens, offsets
+
+    def _encode_cached(self, text):
+        tokens = self._cache_get(text)
+        if tokens is None:
+            tokens = self._cache_put(text, self.encoding.encode(text))
+        return tokens
+
+    def _cache_key(self, text):
+        if not self._cache_size or len(text) > MAX_CACHED_TEXT_LENGTH:
+            return None
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _cache_get(self, text):
+        key = self._cache_key(text)
+        if key is None:
+            return None
+        with self._cache_lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+            return tokens
+
+    def _cache_put(self, text, tokens):
+        tokens = tuple(tokens)
+        key = self._cache_key(text)
+        if key is not None:
+            with self._cache_lock:
+                self._cache[key] = tokens
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return tokens
@@ -0,0 +1,535 @@
+import base64
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import threading
+import weakref
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional
+from vector_cache import VECTOR_BLOCK_BYTES, VectorCache
+
+INDEX_FILE_FORMAT = 'vectra-index'
+INDEX_FORMAT_VERSION = 3
+
+# Vectors are written either as JSON lists or as base64 little-endian float32 blobs,
+# which are about a third of the size and much faster to parse. The columnar encoding
+# moves ids, metadata, norms and vectors into separate sections so open_index_file can
+# load them on demand (format version 3, other encodings are still written as 2).
+VECTOR_ENCODING_JSON = 'json'
+VECTOR_ENCODING_FLOAT32 = 'float32-base64'
+VECTOR_ENCODING_COLUMNAR = 'float32-columnar'
+COLUMNAR_SECTIONS = ('data', 'ids', 'record_offsets', 'records', 'norms', 'vectors')
+# Item keys kept out of the per-item records
+COLUMNAR_KEYS = ('id', 'vector', 'norm')
+
+# Tells apart the blocks of different files in a shared VectorCache
+_cache_tokens = itertools.count()
+
+# Prefer orjson when it's installed
+DEFAULT_CODEC = 'orjson' if importlib.util.find_spec('orjson') else 'json'
+
+
+class JsonCodec:
+    name = 'json'
+
+    def dumps(self, data: Any) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data: bytes) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, data: Any) -> bytes:
+        return self._orjson.dumps(data)
+
+    def loads(self, data: bytes) -> Any:
+        return self._orjson.loads(data)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+}
+_codecs = {}
+
+
+def get_codec(name: Optional[str] = None):
+    name = name or DEFAULT_CODEC
+    if name not in _codecs:
+        if name not in CODECS:
+            raise ValueError(f'Unknown index codec "{name}"')
+        _codecs[name] = CODECS[name]()
+    return _codecs[name]
+
+
+def encode_vector(vector: List[float]) -> str:
+    values = array('f', vector)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def decode_vector(encoded: str) -> List[float]:
+    values = array('f')
+    values.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+def write_index_file(path: str,
+                     data: Dict[str, Any],
+                     keep_previous: bool = True,
+                     codec: Optional[str] = None,
+                     vector_encoding: str = VECTOR_ENCODING_JSON,
+                     generation: Optional[int] = None) -> None:
+    """
+    Crash-safely replaces the index file at path. The body is preceded by a one line
+    JSON header holding its size, crc32 checksum, how vectors are encoded and the
+    commit generation, if given. It's written to a temp file, fsynced and renamed over
+    the old file, which is kept as <path>.prev (a hard link, so nothing is copied) for
+    read_index_file to fall back on.
+    """
+    header = {
+        "format": INDEX_FILE_FORMAT,
+        "format_version": 2,
+        "vector_encoding": vector_encoding,
+    }
+    if generation is not None:
+        header["generation"] = generation
+    dimensions = {len(item["vector"]) for item in data["items"]}
+    if vector_encoding == VECTOR_ENCODING_COLUMNAR and len(dimensions) > 1:
+        # Vectors are stored as one fixed width block, which mixed sizes don't fit
+        vector_encoding = header["vector_encoding"] = VECTOR_ENCODING_FLOAT32
+
+    if vector_encoding == VECTOR_ENCODING_COLUMNAR:
+        body = _encode_columnar(data, get_codec(codec), header)
+        header["format_version"] = INDEX_FORMAT_VERSION
+        header["dimensions"] = dimensions.pop() if dimensions else 0
+    elif vector_encoding == VECTOR_ENCODING_FLOAT32:
+        data = {**data, "items": [{**item, "vector": encode_vector(item["vector"])} for item in data["items"]]}
+        body = get_codec(codec).dumps(data)
+    elif vector_encoding == VECTOR_ENCODING_JSON:
+        body = get_codec(codec).dumps(data)
+    else:
+        raise ValueError(f'Unknown vector encoding "{vector_encoding}"')
+    header["size"] = len(body)
+    header["checksum"] = zlib.crc32(body)
+    header = json.dumps(header)
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(header.encode('utf-8') + b'\n')
+        index_file.write(body)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+    if keep_previous and os.path.exists(path):
+        _link_previous(path)
+    os.replace(temp_path, path)
+    _fsync_folder(os.path.dirname(path))
+
+
+def read_index_file(path: str, codec: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Reads an index file written by write_index_file, verifying its size and checksum.
+    If the file is damaged the previous version is read instead.
+    """
+    try:
+        return _read_verified(path, codec)
+    except (ValueError, UnicodeDecodeError) as err:
+        previous_path = f'{path}.prev'
+        if not os.path.exists(previous_path):
+            raise
+        print(f'Error reading index file "{path}": {str(err)}. Recovering from "{previous_path}"')
+        return _read_verified(previous_path, codec)
+
+
+def read_index_generation(path: str) -> Optional[int]:
+    """
+    Returns the commit generation in the header of an index file, reading only the
+    header, or None if the file has none.
+    """
+    with open(path, 'rb') as index_file:
+        # Files written before headers were added can be a single long line
+        if index_file.read(9) != b'{"format"':
+            return None
+        first_line = b'{"format"' + index_file.readline()
+    try:
+        return json.loads(first_line).get("generation")
+    except ValueError:
+        return None
+
+
+def open_index_file(path: str, codec: Optional[str] = None, cache: Optional[VectorCache] = None) -> Dict[str, Any]:
+    """
+    Like read_index_file, except the items of a columnar file are returned as LazyItems
+    and only the header, the index data and the id table are read up front. Other files
+    are read in full.
+    """
+    try:
+        return _open_lazy(path, codec, cache)
+    except (ValueError, UnicodeDecodeError) as err:
+        previous_path = f'{path}.prev'
+        if not os.path.exists(previous_path):
+            raise
+        print(f'Error reading index file "{path}": {str(err)}. Recovering from "{previous_path}"')
+        return _open_lazy(previous_path, codec, cache)
+
+
+class LazyItems:
+    """
+    The items of a columnar index file, read on demand. The ids are read when the file
+    is opened, norms and vectors the first time a query scans them, and each item's
+    record (metadata and so on) the first time the item is accessed.
+
+    With a VectorCache, vectors and norms are instead read in blocks as queries scan
+    them and only the blocks the cache admits stay in memory, and records aren't kept.
+    Blocks aren't checked against the section checksums, as that needs the whole section.
+
+    Supports len(), indexing, slicing and iteration like the item list it stands in
+    for. Items are built on each access, so changing one doesn't change the index.
+    Iterating and slicing read the rows' sections in bulk rather than item by item.
+    The file is kept open so a commit replacing it doesn't affect the items, except on
+    Windows, where it has to be closed before the file can be replaced.
+    """
+    def __init__(self,
+                 index_file,
+                 body_offset: int,
+                 header: Dict[str, Any],
+                 ids: List[str],
+                 codec,
+                 cache: Optional[VectorCache] = None):
+        self._file = index_file
+        self._file_lock = threading.Lock()
+        self._body_offset = body_offset
+        self._sections = header["sections"]
+        self._dimensions = header["dimensions"]
+        self._ids = ids
+        self._codec = codec
+        self._rows = None  # id -> row, built on the first lookup by id
+        self._record_offsets = None
+        self._records = {}
+        self._norms = None
+        self._vectors = None
+        self._cache = cache
+        self._cache_token = next(_cache_tokens)
+        self._block_rows = max(1, VECTOR_BLOCK_BYTES // (self._dimensions * 4 + 8))
+        if cache is not None:
+            weakref.finalize(self, cache.discard, self._cache_token)
+
+    @property
+    def dimensions(self) -> int:
+        return self._dimensions
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return self._iter_rows(0, len(self._ids))
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            start, stop, step = row.indices(len(self._ids))
+            if step == 1:
+                return list(self._iter_rows(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+        if row < 0:
+            row += len(self._ids)
+        return {
+            "id": self._ids[row],
+            **self.record(row),
+            "vector": self._vector(row).tolist(),
+            "norm": self._norm(row),
+        }
+
+    def get(self, id: str) -> Optional[Dict[str, Any]]:
+        if self._rows is None:
+            self._rows = {item_id: row for row, item_id in enumerate(self._ids)}
+        row = self._rows.get(id)
+        return None if row is None else self[row]
+
+    def record(self, row: int) -> Dict[str, Any]:
+        """
+        Returns the item's fields other than its id, vector and norm, decoding them on
+        first access.
+        """
+        record = self._records.get(row)
+        if record is None:
+            if self._record_offsets is None:
+                self._record_offsets = _array_from_bytes('Q', self._read_section('record_offsets'))
+            start, end = self._record_offsets[row], self._record_offsets[row + 1]
+            record = self._codec.loads(self._read_section('records', start, end - start))
+            if self._cache is None:
+                self._records[row] = record
+        return {**record, "metadata": dict(record.get("metadata") or {})}
+
+    def vectors(self, rows: Iterable[int], query_stats: Optional[Dict[str, int]] = None):
+        """
+        Yields the row, vector and norm of each row, in ascending row order. Without a
+        cache all the vectors are paged in on first use, with one they're read block by
+        block and the cache hits, misses and bytes read are added to query_stats.
+        """
+        dimensions = self._dimensions
+        if self._cache is None:
+            self._load_vectors()
+            vectors, norms = self._vectors, self._norms
+            for row in rows:
+                start = row * dimensions
+                yield row, vectors[start:start + dimensions], norms[row]
+            return
+
+        block = None
+        for row in rows:
+            if row // self._block_rows != block:
+                block = row // self._block_rows
+                first_row = block * self._block_rows
+                vectors, norms = self._get_block(block, query_stats)
+            offset = row - first_row
+            yield row, vectors[offset * dimensions:(offset + 1) * dimensions], norms[offset]
+
+    def record_results(self, rows: Iterable[int], query_stats: Dict[str, int]) -> None:
+        """
+        Tells the cache which rows a query returned, making their blocks hotter.
+        """
+        if self._cache is not None:
+            self._cache.record_query(query_stats, {(self._cache_token, row // self._block_rows) for row in rows})
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _iter_rows(self, start: int, stop: int):
+        # Reads the records, norms and vectors of [start, stop) with one read each
+        if start >= stop:
+            return iter(())
+        if self._record_offsets is None:
+            self._record_offsets = _array_from_bytes('Q', self._read_section('record_offsets'))
+        verify = start == 0 and stop == len(self._ids)
+        dimensions = self._dimensions
+        record_start = self._record_offsets[start]
+        records = self._read_section('records', record_start, self._record_offsets[stop] - record_start, verify)
+        norms = _array_from_bytes('d', self._read_section('norms', start * 8, (stop - start) * 8, verify))
+        vectors = _array_from_bytes('f', self._read_section('vectors', start * dimensions * 4,
+                                                            (stop - start) * dimensions * 4, verify))
+        return _columnar_items(self._ids[start:stop], self._record_offsets[start:stop + 1], record_start,
+                               records, norms, vectors, dimensions, self._codec)
+
+    def _vector(self, row: int) -> array:
+        start = row * self._dimensions
+        if self._vectors is not None:
+            return self._vectors[start:start + self._dimensions]
+        # Point lookups read just the one vector
+        return _array_from_bytes('f', self._read_section('vectors', start * 4, self._dimensions * 4))
+
+    def _norm(self, row: int) -> float:
+        if self._norms is not None:
+            return self._norms[row]
+        return _array_from_bytes('d', self._read_section('norms', row * 8, 8))[0]
+
+    def _get_block(self, block: int, query_stats: Optional[Dict[str, int]]):
+        key = (self._cache_token, block)
+        cached = self._cache.get(key)
+        if cached is not None:
+            if query_stats is not None:
+                query_stats["hits"] += 1
+            return cached
+
+        first_row = block * self._block_rows
+        rows = min(self._block_rows, len(self._ids) - first_row)
+        vector_bytes = rows * self._dimensions * 4
+        cached = (
+            _array_from_bytes('f', self._read_section('vectors', first_row * self._dimensions * 4, vector_bytes)),
+            _array_from_bytes('d', self._read_section('norms', first_row * 8, rows * 8)),
+        )
+        if query_stats is not None:
+            query_stats["misses"] += 1
+            query_stats["bytes_read"] += vector_bytes + rows * 8
+        self._cache.put(key, cached, vector_bytes + rows * 8)
+        return cached
+
+    def _load_vectors(self) -> None:
+        if self._vectors is None:
+            self._norms = _array_from_bytes('d', self._read_section('norms', verify=True))
+            self._vectors = _array_from_bytes('f', self._read_section('vectors', verify=True))
+
+    def _read_section(self, name: str, start: int = 0, length: Optional[int] = None, verify: bool = False) -> bytes:
+        offset, size, checksum = self._sections[name]
+        with self._file_lock:
+            self._file.seek(self._body_offset + offset + start)
+            contents = self._file.read(size - start if length is None else length)
+        if verify and zlib.crc32(contents) != checksum:
+            raise ValueError(f'Index file section "{name}" checksum mismatch')
+        return contents
+
+
+def _encode_columnar(data: Dict[str, Any], codec, header: Dict[str, Any]) -> bytes:
+    items = data["items"]
+    records = [codec.dumps({key: value for key, value in item.items() if key not in COLUMNAR_KEYS})
+               for item in items]
+    record_offsets = array('Q', [0])
+    for record in records:
+        record_offsets.append(record_offsets[-1] + len(record))
+    vectors = array('f')
+    for item in items:
+        vectors.extend(item["vector"])
+
+    sections = {
+        "data": codec.dumps({key: value for key, value in data.items() if key != "items"}),
+        "ids": codec.dumps([item["id"] for item in items]),
+        "record_offsets": _array_to_bytes(record_offsets),
+        "records": b''.join(records),
+        "norms": _array_to_bytes(array('d', (item["norm"] for item in items))),
+        "vectors": _array_to_bytes(vectors),
+    }
+    header["count"] = len(items)
+    header["sections"] = {}
+    offset = 0
+    for name in COLUMNAR_SECTIONS:
+        header["sections"][name] = [offset, len(sections[name]), zlib.crc32(sections[name])]
+        offset += len(sections[name])
+    return b''.join(sections[name] for name in COLUMNAR_SECTIONS)
+
+
+def _decode_columnar(header: Dict[str, Any], body: memoryview, codec) -> Dict[str, Any]:
+    def section(name):
+        offset, size, _ = header["sections"][name]
+        return body[offset:offset + size]
+
+    data = codec.loads(section('data'))
+    ids = codec.loads(section('ids'))
+    record_offsets = _array_from_bytes('Q', section('record_offsets'))
+    records = section('records')
+    norms = _array_from_bytes('d', section('norms'))
+    vectors = _array_from_bytes('f', section('vectors'))
+    data["items"] = list(_columnar_items(ids, record_offsets, 0, records, norms, vectors, header["dimensions"], codec))
+    return data
+
+
+def _columnar_items(ids: List[str],
+                    record_offsets: array,
+                    records_start: int,
+                    records,
+                    norms: array,
+                    vectors: array,
+                    dimensions: int,
+                    codec):
+    # Builds the items of consecutive rows from their sections. record_offsets holds one
+    # more entry than ids, relative to records_start.
+    for row, id in enumerate(ids):
+        start, end = record_offsets[row] - records_start, record_offsets[row + 1] - records_start
+        yield {
+            "id": id,
+            **codec.loads(records[start:end]),
+            "vector": vectors[row * dimensions:(row + 1) * dimensions].tolist(),
+            "norm": norms[row],
+        }
+
+
+def _array_to_bytes(values: array) -> bytes:
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array_from_bytes(typecode: str, contents: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(contents)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _open_lazy(path: str, codec: Optional[str] = None, cache: Optional[VectorCache] = None) -> Dict[str, Any]:
+    index_file = open(path, 'rb')
+    try:
+        first_line = index_file.readline()
+        header = json.loads(first_line) if first_line.startswith(b'{"format"') else {}
+        if header.get("vector_encoding") != VECTOR_ENCODING_COLUMNAR:
+            index_file.close()
+            return _read_verified(path, codec)
+        if header["format_version"] > INDEX_FORMAT_VERSION:
+            raise ValueError(f'Index file format version {header["format_version"]} is not supported')
+
+        body_offset = len(first_line)
+        size = os.fstat(index_file.fileno()).st_size - body_offset
+        if size != header["size"]:
+            raise ValueError(f'Index file is truncated, expected {header["size"]} bytes but found {size}')
+        # Only the sections needed to answer stats and lookups are read now
+        codec = get_codec(codec)
+        sections = {}
+        for name in ('data', 'ids'):
+            offset, length, checksum = header["sections"][name]
+            index_file.seek(body_offset + offset)
+            sections[name] = index_file.read(length)
+            if zlib.crc32(sections[name]) != checksum:
+                raise ValueError(f'Index file section "{name}" checksum mismatch')
+        data = codec.loads(sections['data'])
+        data["items"] = LazyItems(index_file, body_offset, header, codec.loads(sections['ids']), codec, cache)
+        return data
+    except BaseException:
+        index_file.close()
+        raise
+
+
+def _read_verified(path: str, codec: Optional[str] = None) -> Dict[str, Any]:
+    with open(path, 'rb') as index_file:
+        contents = index_file.read()
+
+    newline = contents.find(b'\n')
+    if not contents.startswith(b'{"format"') or newline < 0:
+        # Written before headers were added
+        return get_codec(codec).loads(contents)
+
+    header = json.loads(contents[:newline])
+    if header.get("format_version", 1) > INDEX_FORMAT_VERSION:
+        raise ValueError(f'Index file format version {header["format_version"]} is not supported')
+    # orjson parses the body in place, the stdlib codec needs a copy
+    body = memoryview(contents)[newline + 1:]
+    if len(body) != header["size"]:
+        raise ValueError(f'Index file is truncated, expected {header["size"]} bytes but found {len(body)}')
+    if zlib.crc32(body) != header["checksum"]:
+        raise ValueError('Index file checksum mismatch')
+
+    if header.get("vector_encoding") == VECTOR_ENCODING_COLUMNAR:
+        return _decode_columnar(header, body, get_codec(codec))
+    data = get_codec(codec).loads(body)
+    if header.get("vector_encoding", VECTOR_ENCODING_JSON) == VECTOR_ENCODING_FLOAT32:
+        for item in data["items"]:
+            item["vector"] = decode_vector(item["vector"])
+    return data
+
+
+def _link_previous(path: str) -> None:
+    previous_path = f'{path}.prev'
+    temp_path = f'{previous_path}.tmp'
+    try:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        os.link(path, temp_path)
+    except OSError:
+        # Hard links aren't supported everywhere, the commit goes ahead without a backup
+        return
+    os.replace(temp_path, previous_path)
+
+
+def _fsync_folder(folder_path: str) -> None:
+    # Makes the rename itself durable. Folders can't be opened for fsync on Windows.
+    if os.name != 'posix':
+        return
+    fd = os.open(folder_path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
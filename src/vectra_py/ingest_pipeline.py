@@ -0,0 +1,267 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from file_fetcher import FileFetcher
+from web_fetcher import WebFetcher
+from local_document import TokenPositions
+from local_document_index import LocalDocumentIndex, StreamedDocument
+
+_DONE = object()
+
+
+@dataclass
+class IngestPipelineConfig:
+    fetch_concurrency: int = 8
+    split_concurrency: int = 2
+    embed_concurrency: int = 4
+    queue_size: int = 16
+    commit_every: int = 32
+    doc_type: Optional[str] = None
+    progress_interval: float = 5.0  # seconds between on_progress calls
+    on_progress: Optional[Callable[['IngestProgress'], None]] = None
+
+
+@dataclass
+class IngestProgress:
+    fetched: int = 0
+    split: int = 0
+    embedded: int = 0
+    unchanged: int = 0
+    written: int = 0
+    chunks: int = 0
+    commits: int = 0
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    @property
+    def documents_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.chunks / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"fetched={self.fetched} unchanged={self.unchanged} split={self.split} embedded={self.embedded} "
+                f"written={self.written} chunks={self.chunks} commits={self.commits} "
+                f"errors={len(self.errors)} elapsed={self.elapsed:.1f}s "
+                f"docs/sec={self.documents_per_second:.2f} chunks/sec={self.chunks_per_second:.1f}")
+
+
+class IngestPipeline:
+    """
+    Streams documents into a LocalDocumentIndex through fetch -> split -> embed -> write
+    stages. Stages are linked by bounded queues so a slow stage applies backpressure to
+    the ones before it, and the writer groups documents into one index commit per
+    commit_every documents.
+    """
+    def __init__(self,
+                 index: LocalDocumentIndex,
+                 config: Optional[IngestPipelineConfig] = None,
+                 file_fetcher: Optional[FileFetcher] = None,
+                 web_fetcher: Optional[WebFetcher] = None):
+        self._index = index
+        self._config = config or IngestPipelineConfig()
+        self._file_fetcher = file_fetcher or FileFetcher()
+        self._web_fetcher = web_fetcher or WebFetcher()
+        # A fetcher created here is closed at the end of each run, releasing its threads
+        self._owns_web_fetcher = web_fetcher is None
+        self._progress = None
+        # Validators of fetched pages, saved to the web fetcher's cache once the page
+        # is committed. Cache entries are kept per index.
+        self._validators = {}
+        self._cache_scope = os.path.abspath(index.folder_path)
+
+    @property
+    def progress(self) -> Optional[IngestProgress]:
+        return self._progress
+
+    async def run(self, uris: Iterable[str]) -> IngestProgress:
+        config = self._config
+        self._progress = IngestProgress()
+        fetch_queue = asyncio.Queue(maxsize=config.queue_size)
+        split_queue = asyncio.Queue(maxsize=config.queue_size)
+        embed_queue = asyncio.Queue(maxsize=config.queue_size)
+        write_queue = asyncio.Queue(maxsize=config.queue_size)
+
+        reporter = asyncio.ensure_future(self._report_progress()) if config.on_progress else None
+        stages = [asyncio.ensure_future(stage) for stage in (
+            self._feed(uris, fetch_queue, config.fetch_concurrency),
+            self._run_stage(fetch_queue, split_queue, self._fetch,
+                            config.fetch_concurrency, config.split_concurrency),
+            self._run_stage(split_queue, embed_queue, self._split,
+                            config.split_concurrency, config.embed_concurrency),
+            self._run_stage(embed_queue, write_queue, self._embed,
+                            config.embed_concurrency, 1),
+            self._write(write_queue),
+        )]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            # Stop the other stages rather than leave them blocked on their queues
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+        finally:
+            self._progress.finished_at = time.perf_counter()
+            if self._owns_web_fetcher:
+                self._web_fetcher.close()
+            if reporter:
+                reporter.cancel()
+                config.on_progress(self._progress)
+
+        return self._progress
+
+    async def _feed(self, uris: Iterable[str], queue: asyncio.Queue, consumers: int) -> None:
+        for uri in uris:
+            await queue.put(uri)
+        for _ in range(consumers):
+            await queue.put(_DONE)
+
+    async def _run_stage(self, in_queue: asyncio.Queue, out_queue: asyncio.Queue,
+                         handler, concurrency: int, consumers: int) -> None:
+        async def worker():
+            while True:
+                item = await in_queue.get()
+                if item is _DONE:
+                    return
+                try:
+                    async for result in handler(item):
+                        await out_queue.put(result)
+                except Exception as err:
+                    self._record_error(item if isinstance(item, str) else item[0], err)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        for _ in range(consumers):
+            await out_queue.put(_DONE)
+
+    async def _fetch(self, uri: str):
+        if uri.startswith("http"):
+            result = await self._web_fetcher.fetch_with_validators_async(uri, self._cache_scope)
+            if result is None:
+                # The cached validators say the page hasn't changed since the last crawl
+                self._progress.unchanged += 1
+                return
+            self._progress.fetched += 1
+            self._validators[uri] = result[3]
+            yield uri, result[1], self._config.doc_type or result[2]
+        else:
+            async for file_uri, text, doc_type in self._file_fetcher.fetch(uri):
+                self._progress.fetched += 1
+                yield file_uri, text, self._config.doc_type or doc_type
+
+    async def _split(self, document):
+        uri, text, doc_type = document
+        if not isinstance(text, str):
+            # Large files arrive as an iterator of text blocks, which are split and
+            # embedded as they stream by and only added to the index when committed
+            streamed = await self._index.prepare_document_stream(uri, text, doc_type)
+            self._progress.split += 1
+            self._progress.embedded += 1
+            yield uri, streamed, None, None
+            return
+
+        def split():
+            chunks = self._index.split_document(uri, text, doc_type)
+            return chunks, TokenPositions.from_text(text, self._index.tokenizer)
+
+        chunks, token_positions = await asyncio.to_thread(split)
+        self._progress.split += 1
+        yield uri, text, chunks, token_positions
+
+    async def _embed(self, document):
+        uri, text, chunks, token_positions = document
+        if isinstance(text, StreamedDocument):
+            yield uri, text, None, None, None
+            return
+        embeddings = await self._index.embed_chunks(chunks)
+        self._progress.embedded += 1
+        yield uri, text, chunks, token_positions, embeddings
+
+    async def _write(self, queue: asyncio.Queue) -> None:
+        batch = []
+        while True:
+            document = await queue.get()
+            if document is not _DONE:
+                batch.append(document)
+            if batch and (document is _DONE or len(batch) >= self._config.commit_every):
+                await self._commit(batch)
+                batch = []
+            if document is _DONE:
+                return
+
+    async def _commit(self, batch) -> None:
+        written = batch
+        try:
+            try:
+                await self._commit_documents(batch)
+            except Exception as err:
+                if len(batch) == 1:
+                    self._record_error(batch[0][0], err)
+                    return
+                # Commit the documents one at a time so only the ones that fail are reported
+                written = []
+                for document in batch:
+                    if isinstance(document[1], StreamedDocument) and not document[1].is_intact():
+                        # Its files were moved into the cancelled update, so it can't be retried
+                        self._record_error(document[0], err)
+                        continue
+                    try:
+                        await self._commit_documents([document])
+                        written.append(document)
+                    except Exception as document_err:
+                        self._record_error(document[0], document_err)
+        finally:
+            # Removes the temporary files of streamed documents that weren't committed
+            for document in batch:
+                if isinstance(document[1], StreamedDocument):
+                    document[1].discard()
+
+        cache = self._web_fetcher.cache
+        for document in written:
+            validators = self._validators.pop(document[0], None)
+            if validators and cache:
+                cache.set(document[0], validators["etag"], validators["last_modified"], self._cache_scope)
+
+        self._progress.written += len(written)
+        self._progress.chunks += sum(len(document[1].spans) if isinstance(document[1], StreamedDocument)
+                                     else len(document[2]) for document in written)
+
+    async def _commit_documents(self, documents) -> None:
+        index = self._index
+        await index.begin_update()
+        try:
+            for uri, text, chunks, token_positions, embeddings in documents:
+                if isinstance(text, StreamedDocument):
+                    await index.add_streamed_document_to_update(text)
+                else:
+                    await index.add_document_to_update(uri, text, chunks, embeddings, token_positions=token_positions)
+            await index.end_update()
+        except BaseException:
+            # Also on cancellation, so the write lock isn't left held
+            index.cancel_update()
+            raise
+        self._progress.commits += 1
+
+    def _record_error(self, uri: str, err: Exception) -> None:
+        self._progress.errors.append((uri, str(err)))
+        # Make sure a failed page is fetched again on the next crawl
+        self._validators.pop(uri, None)
+        if uri.startswith("http") and self._web_fetcher.cache:
+            self._web_fetcher.cache.invalidate(uri, self._cache_scope)
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(self._config.progress_interval)
+            self._config.on_progress(self._progress)
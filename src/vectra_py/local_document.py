@@ -1,6 +1,241 @@
 import asyncio
+import mmap
 import os
 import json
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from custom_types import Tokenizer
+
+# Token offsets are saved as native unsigned 64-bit ints, as a text can pass 4Gi characters
+TOKEN_OFFSET_TYPECODE = 'Q'
+# A .tokens file starts with this, then its format version. Files of the first version
+# hold 32-bit offsets and start with the text length, which couldn't be this large.
+TOKEN_POSITIONS_MARKER = 0xFFFFFFFF
+TOKEN_POSITIONS_VERSION = 2
+# Byte offsets are saved as native unsigned 64-bit ints, as a text file can pass 4GiB
+CHAR_OFFSET_TYPECODE = 'Q'
+# A .chars file starts with this, then its format version. Files of the first version
+# hold 32-bit offsets and start with the text length, which couldn't be this large.
+CHAR_OFFSETS_MARKER = 0xFFFFFFFF
+CHAR_OFFSETS_VERSION = 2
+# Characters between the char -> byte checkpoints saved with each document
+TEXT_BLOCK_SIZE = 4096
+
+
+def encode_offsets(tokenizer: Tokenizer, text: str) -> List[int]:
+    """
+    Returns the character offset each token of text starts at.
+    """
+    if hasattr(tokenizer, 'encode_with_offsets'):
+        return list(tokenizer.encode_with_offsets(text)[1])
+
+    # Tokenizers without offset support are approximated by the length of each decoded token
+    offsets = []
+    pos = 0
+    for token in tokenizer.encode(text):
+        offsets.append(min(pos, len(text)))
+        pos += len(tokenizer.decode([token]))
+    return offsets
+
+
+class TokenPositions:
+    """
+    The character offset each token of a document starts at. It's saved next to the
+    document text at ingest time so renderers can count and slice tokens of any span by
+    bisecting the offsets instead of re-encoding the text.
+    """
+    def __init__(self, offsets: Sequence[int], text_length: int):
+        self.offsets = offsets
+        self.text_length = text_length
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @staticmethod
+    def from_text(text: str, tokenizer: Tokenizer) -> 'TokenPositions':
+        return TokenPositions(array(TOKEN_OFFSET_TYPECODE, encode_offsets(tokenizer, text)), len(text))
+
+    @staticmethod
+    def load(path: str) -> 'TokenPositions':
+        # The file is memory mapped so bisecting only pages in the parts it touches
+        with open(path, 'rb') as file:
+            data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        header = data[:8].cast('I')
+        if header[0] == TOKEN_POSITIONS_MARKER:
+            if header[1] > TOKEN_POSITIONS_VERSION:
+                raise ValueError(f'Token positions format version {header[1]} is not supported')
+            offsets = data[8:].cast(TOKEN_OFFSET_TYPECODE)
+        else:
+            offsets = data.cast('I')
+        # The first value is the length of the text
+        return TokenPositions(offsets[1:], offsets[0])
+
+    def save(self, path: str) -> None:
+        # Replaced rather than rewritten in place as readers may have the old file mapped
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as file:
+            array('I', [TOKEN_POSITIONS_MARKER, TOKEN_POSITIONS_VERSION]).tofile(file)
+            array(TOKEN_OFFSET_TYPECODE, [self.text_length]).tofile(file)
+            array(TOKEN_OFFSET_TYPECODE, self.offsets).tofile(file)
+        os.replace(temp_path, path)
+
+    def count(self, start_pos: int, end_pos: int) -> int:
+        # Tokens starting within [start_pos, end_pos)
+        return bisect_left(self.offsets, end_pos) - bisect_left(self.offsets, start_pos)
+
+    def start_before(self, pos: int, max_tokens: int) -> Tuple[int, int]:
+        """
+        Returns the start position and count of the (up to) max_tokens tokens before pos.
+        """
+        end = bisect_left(self.offsets, pos)
+        start = max(0, end - max_tokens)
+        return (self.offsets[start] if start < end else pos), end - start
+
+    def end_after(self, pos: int, max_tokens: int) -> Tuple[int, int]:
+        """
+        Returns the end position and count of the (up to) max_tokens tokens from pos on.
+        """
+        start = bisect_left(self.offsets, pos)
+        end = min(len(self.offsets), start + max_tokens)
+        return (self.offsets[end] if end < len(self.offsets) else self.text_length), end - start
+
+
+class TokenPositionsWriter:
+    """
+    Writes a .tokens file as a document's token offsets are produced so they never
+    all have to be held in memory. The text length heading the file is written when
+    it's closed.
+    """
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        array('I', [TOKEN_POSITIONS_MARKER, TOKEN_POSITIONS_VERSION]).tofile(self._file)
+        array(TOKEN_OFFSET_TYPECODE, [0]).tofile(self._file)
+        self.count = 0
+        self.text_length = 0
+
+    def extend(self, offsets: Iterable[int]) -> None:
+        offsets = array(TOKEN_OFFSET_TYPECODE, offsets)
+        offsets.tofile(self._file)
+        self.count += len(offsets)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.seek(8)
+        array(TOKEN_OFFSET_TYPECODE, [self.text_length]).tofile(self._file)
+        self._file.close()
+
+    def __enter__(self) -> 'TokenPositionsWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class CharOffsets:
+    """
+    The byte offset of every TEXT_BLOCK_SIZE-th character of a document's utf-8 text
+    file. It's saved next to the text as <id>.chars so any character range can be read
+    with a single seek instead of loading the whole file.
+    """
+    def __init__(self, offsets: Optional[Sequence[int]] = None, text_length: int = 0, byte_length: int = 0):
+        self.offsets = offsets if offsets is not None else array(CHAR_OFFSET_TYPECODE)
+        self.text_length = text_length
+        self.byte_length = byte_length
+
+    @staticmethod
+    def from_text(text: str) -> 'CharOffsets':
+        char_offsets = CharOffsets()
+        char_offsets.extend(text)
+        return char_offsets
+
+    def extend(self, text: str) -> None:
+        # Record a checkpoint for each block boundary falling within the appended text
+        pos = 0
+        checkpoint = -self.text_length % TEXT_BLOCK_SIZE
+        while checkpoint < len(text):
+            self.byte_length += len(text[pos:checkpoint].encode('utf-8'))
+            self.offsets.append(self.byte_length)
+            pos = checkpoint
+            checkpoint += TEXT_BLOCK_SIZE
+        self.byte_length += len(text[pos:].encode('utf-8'))
+        self.text_length += len(text)
+
+    def block_range(self, first: int, last: int) -> Tuple[int, int]:
+        """
+        Returns the [start, end) byte range of blocks first through last.
+        """
+        end = self.offsets[last + 1] if last + 1 < len(self.offsets) else self.byte_length
+        return self.offsets[first], end
+
+    @staticmethod
+    def load(path: str) -> 'CharOffsets':
+        with open(path, 'rb') as file:
+            data = file.read()
+        header = array('I')
+        header.frombytes(data[:2 * header.itemsize])
+        if header[0] == CHAR_OFFSETS_MARKER:
+            if header[1] > CHAR_OFFSETS_VERSION:
+                raise ValueError(f'Char offsets format version {header[1]} is not supported')
+            offsets = array(CHAR_OFFSET_TYPECODE)
+            offsets.frombytes(data[2 * header.itemsize:])
+        else:
+            offsets = array('I')
+            offsets.frombytes(data)
+        # Headed by the text length in characters and in bytes
+        return CharOffsets(offsets[2:], offsets[0], offsets[1])
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as file:
+            array('I', [CHAR_OFFSETS_MARKER, CHAR_OFFSETS_VERSION]).tofile(file)
+            array(CHAR_OFFSET_TYPECODE, [self.text_length, self.byte_length]).tofile(file)
+            array(CHAR_OFFSET_TYPECODE, self.offsets).tofile(file)
+
+
+class TextCache:
+    """
+    LRU cache of document text shared by every LocalDocument, bounded by the total
+    number of characters held. Entries are keyed by the file's path, size and mtime
+    so a rewritten document is never served stale.
+    """
+    def __init__(self, max_chars: int = 16 << 20):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+            return text
+
+    def put(self, key, text: str) -> None:
+        # Anything over an eighth of the budget would just flush everything else
+        if len(text) > self.max_chars // 8:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._chars -= len(previous)
+            self._entries[key] = text
+            self._chars += len(text)
+            while self._chars > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._chars -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+
+
+text_cache = TextCache()
 
 
 class LocalDocument:
@@ -9,7 +244,8 @@ class LocalDocument:
         self._id = id
         self._uri = uri
         self._metadata = None
-        self._text = None
+        self._token_positions = None
+        self._char_offsets = None
 
     @property
     def folder_path(self):
@@ -43,11 +279,92 @@ class LocalDocument:
         return self._metadata
 
     async def load_text(self):
-        if self._text is None:
+        return await asyncio.to_thread(self.read_text)
+
+    async def load_text_range(self, start_pos: int, end_pos: int) -> str:
+        return await asyncio.to_thread(self.read_text_range, start_pos, end_pos)
+
+    def read_text(self) -> str:
+        try:
+            path = os.path.join(self.folder_path, f"{self.id}.txt")
+            key = self._cache_key(path)
+            text = text_cache.get(key)
+            if text is None:
+                with open(path, 'r', encoding='utf-8', newline='') as file:
+                    text = file.read()
+                text_cache.put(key, text)
+            return text
+        except Exception as err:
+            raise Exception(f'Error reading text file for document "{self.uri}": {str(err)}')
+
+    def read_text_range(self, start_pos: int, end_pos: int) -> str:
+        """
+        Returns text[start_pos:end_pos], reading only the blocks of the file that cover it.
+        """
+        char_offsets = self._load_char_offsets()
+        if char_offsets is None:
+            # Documents indexed before char offsets were saved are read whole
+            return self.read_text()[start_pos:end_pos]
+
+        end_pos = min(end_pos, char_offsets.text_length)
+        if end_pos <= start_pos:
+            return ''
+
+        try:
+            path = os.path.join(self.folder_path, f"{self.id}.txt")
+            version = self._cache_key(path)
+            first = start_pos // TEXT_BLOCK_SIZE
+            last = (end_pos - 1) // TEXT_BLOCK_SIZE
+            blocks = [text_cache.get((version, i)) for i in range(first, last + 1)]
+            missing = [i for i, block in enumerate(blocks) if block is None]
+            if missing:
+                # Read every missing block with a single seek
+                start, end = char_offsets.block_range(first + missing[0], first + missing[-1])
+                with open(path, 'rb') as file:
+                    file.seek(start)
+                    text = file.read(end - start).decode('utf-8')
+                for i in range(missing[0], missing[-1] + 1):
+                    offset = (i - missing[0]) * TEXT_BLOCK_SIZE
+                    blocks[i] = text[offset:offset + TEXT_BLOCK_SIZE]
+                    text_cache.put((version, first + i), blocks[i])
+        except Exception as err:
+            raise Exception(f'Error reading text file for document "{self.uri}": {str(err)}')
+
+        offset = first * TEXT_BLOCK_SIZE
+        return ''.join(blocks)[start_pos - offset:end_pos - offset]
+
+    async def load_token_positions(self) -> Optional[TokenPositions]:
+        return await asyncio.to_thread(self.read_token_positions)
+
+    def read_token_positions(self) -> Optional[TokenPositions]:
+        """
+        Returns the token offsets saved at ingest time, or None for documents indexed
+        before they were saved.
+        """
+        if self._token_positions is None:
+            path = os.path.join(self.folder_path, f"{self.id}.tokens")
+            if not os.path.exists(path):
+                return None
+            try:
+                self._token_positions = TokenPositions.load(path)
+            except Exception as err:
+                raise Exception(f'Error reading token offsets for document "{self.uri}": {str(err)}')
+
+        return self._token_positions
+
+    def _load_char_offsets(self) -> Optional[CharOffsets]:
+        if self._char_offsets is None:
+            path = os.path.join(self.folder_path, f"{self.id}.chars")
+            if not os.path.exists(path):
+                return None
             try:
-                with open(os.path.join(self.folder_path, f"{self.id}.txt"), 'r') as file:
-                    self._text = await asyncio.to_thread(file.read)
+                self._char_offsets = CharOffsets.load(path)
             except Exception as err:
-                raise Exception(f'Error reading text file for document "{self.uri}": {str(err)}')
+                raise Exception(f'Error reading char offsets for document "{self.uri}": {str(err)}')
+
+        return self._char_offsets
 
-        return self._text
+    @staticmethod
+    def _cache_key(path: str):
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime_ns
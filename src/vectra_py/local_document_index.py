@@ -1,14 +1,15 @@
+import hashlib
 import os
-import pathlib
-from pathlib import Path
-import time
-import aiofiles.os
 import json
+import time
 import asyncio
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 from gpt3_tokenizer import GPT3Tokenizer
 from local_index import LocalIndex, CreateIndexConfig
-from text_splitter import TextSplitter, TextSplitterConfig
+from document_catalog import DocumentCatalog, DocumentRecord
+from file_lock import FileLock
+from text_splitter import TextSplitter, TextSplitterConfig, TextChunk, STREAM_BLOCK_SIZE
 from custom_types import (
     MetadataFilter,
     EmbeddingsModel,
@@ -18,11 +19,17 @@ from custom_types import (
     QueryResult,
     DocumentChunkMetadata,
     DocumentCatalogStats,
+    DocumentTextSection,
 )
 from local_document_result import LocalDocumentResult
-from local_document import LocalDocument
-from typing import Dict, Optional, List, Union
-from dataclasses import dataclass
+from local_document import LocalDocument, CharOffsets, TokenPositions, TokenPositionsWriter, encode_offsets
+from typing import IO, Dict, Iterable, Iterator, Optional, List, Tuple, Union
+from dataclasses import dataclass, field
+
+# The files saved next to the index for each document
+DOCUMENT_FILE_EXTENSIONS = ('txt', 'tokens', 'chars', 'json')
+# Key of index.json holding the catalog changes and file moves of the last commit
+COMMIT_JOURNAL_KEY = 'document_commit'
 
 
 @dataclass
@@ -33,34 +40,57 @@ class DocumentQueryOptions:
 
 
 @dataclass
-class LocalDocumentIndexConfig:
-    folder_path: str
-    tokenizer: Tokenizer
-    embeddings: Optional[EmbeddingsModel] = None
-    chunking_config: Optional[TextSplitterConfig] = None
+class UpsertDocumentsResult:
+    documents: List[LocalDocument]
+    chunks: int
+    elapsed: float
+
+    @property
+    def documents_per_second(self) -> float:
+        return len(self.documents) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"documents={len(self.documents)} chunks={self.chunks} elapsed={self.elapsed:.1f}s "
+                f"docs/sec={self.documents_per_second:.2f}")
 
 
 @dataclass
-class DocumentCatalog:
-    version: int
-    count: int
-    uri_to_id: Dict[str, str]
-    id_to_uri: Dict[str, str]
+class StreamedDocument:
+    """
+    A document split and embedded by LocalDocumentIndex.prepare_document_stream. Its
+    text and offsets are in temporary files until it's added to an update.
+    """
+    uri: str
+    temp_paths: Dict[str, str]  # extension -> temporary file
+    spans: List[Tuple[int, int, int]] = field(default_factory=list)  # (start_pos, end_pos, token_count)
+    embeddings: List[List[float]] = field(default_factory=list)
+    content_hash: Optional[str] = None
+    token_count: int = 0
+
+    def is_intact(self) -> bool:
+        # False once its files have been moved into an update
+        return all(os.path.exists(temp_path) for temp_path in self.temp_paths.values())
+
+    def discard(self) -> None:
+        # Files already moved into an update are gone, so this is safe to call either way
+        for temp_path in self.temp_paths.values():
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
 
 
-def is_catalog_created():
-    # TODO: pass in appropriate path
-    catalog_path = "/Users/brian/Documents/GitHub/vectra-py/index/catalog.json"
-    exists = os.path.exists(catalog_path)
-    if exists:
-        print(f"exists: {exists}")
-    # time.sleep(1)
-    return exists
+@dataclass
+class LocalDocumentIndexConfig:
+    folder_path: str
+    tokenizer: Tokenizer
+    embeddings: Optional[EmbeddingsModel] = None
+    chunking_config: Optional[TextSplitterConfig] = None
+    # Read index items on demand, see LocalIndex
+    lazy: bool = False
 
 
 class LocalDocumentIndex(LocalIndex):
     def __init__(self, doc_index_config: LocalDocumentIndexConfig):
-        super().__init__(doc_index_config.folder_path)
+        super().__init__(doc_index_config.folder_path, lazy=doc_index_config.lazy)
         self._embeddings = doc_index_config.embeddings
         self._chunking_config = {
             "keep_separators": True,
@@ -70,16 +100,27 @@ class LocalDocumentIndex(LocalIndex):
         }
         self._tokenizer = doc_index_config.tokenizer or self._chunking_config.get("tokenizer") or GPT3Tokenizer()
         self._chunking_config["tokenizer"] = self._tokenizer
-        self._catalog = None
-        self._new_catalog = None
+        self._catalog = DocumentCatalog(self.folder_path)
+        # Document files written or deleted by the pending update. New files are written
+        # under a staged name until the update is committed and they're moved into place.
+        self._staged_files = {}  # final path -> staged path, or None to delete the file
+        self._recovered_generation = None  # generation last checked for an unapplied journal
+
+    @property
+    def embeddings(self) -> Optional[EmbeddingsModel]:
+        return self._embeddings
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        return self._tokenizer
 
     async def get_document_id(self, uri: str) -> Optional[str]:
         await self.load_index_data()
-        return self._catalog["uri_to_id"].get(uri)
+        return self._catalog.get_document_id(uri)
 
     async def get_document_uri(self, document_id: str) -> Optional[str]:
         await self.load_index_data()
-        return self._catalog.id_to_uri.get(document_id)
+        return self._catalog.get_document_uri(document_id)
 
     async def create_index(self, config: Optional[CreateIndexConfig] = None) -> None:
         await super().create_index(config)
@@ -90,38 +131,45 @@ class LocalDocumentIndex(LocalIndex):
         if document_id is None:
             return
 
+        # The document's files are deleted by the commit
         await self.begin_update()
         try:
-            chunks = await self.list_items_by_metadata(DocumentChunkMetadata(document_id=document_id))
-            for chunk in chunks:
-                await self.deleteItem(chunk.id)
-
-            del self._new_catalog.uri_to_id[uri]
-            del self._new_catalog.id_to_uri[document_id]
-            self._new_catalog.count -= 1
-
+            self.remove_document_from_update(uri)
             await self.end_update()
         except Exception as err:
             self.cancel_update()
             raise Exception(f'Error deleting document "{uri}": {str(err)}')
 
-        try:
-            os.unlink(os.path.join(self.folder_path, f'{document_id}.txt'))
-        except Exception as err:
-            raise Exception(f'Error removing text file for document "{uri}" from disk: {str(err)}')
+    def remove_document_from_update(self, uri: str) -> Optional[str]:
+        """
+        Removes a document's chunks, catalog entry and files from the pending update.
+        Returns the removed document id.
+        """
+        document_id = self._catalog.get_document_id(uri, pending=True)
+        if document_id is None:
+            return None
 
-        try:
-            os.unlink(os.path.join(self.folder_path, f'{document_id}.json'))
-        except Exception as err:
-            raise Exception(f'Error removing json metadata file for document "{uri}" from disk: {str(err)}')
+        record = self._catalog.get_document(document_id, pending=True)
+        if record and record.chunk_ids:
+            self.remove_items_from_update(record.chunk_ids)
+        else:
+            # The chunks of documents migrated without a chunk list are found by scanning
+            self.remove_items_from_update([
+                item["id"] for item in self._update["items"]
+                if item["metadata"].get("document_id") == document_id
+            ])
+        self._catalog.delete(document_id)
+        for extension in DOCUMENT_FILE_EXTENSIONS:
+            self._stage_removal(os.path.join(self.folder_path, f'{document_id}.{extension}'))
+        return document_id
 
     async def get_catalog_stats(self) -> DocumentCatalogStats:
-        stats = await self.getIndexStats()
+        stats = await self.get_index_stats()
         return DocumentCatalogStats(
             version=self._catalog.version,
-            documents=self._catalog.count,
-            chunks=stats.items,
-            metadata_config=stats.metadata_config,
+            documents=self._catalog.count(),
+            chunks=stats['items'],
+            metadata_config=stats['metadata_config'],
         )
 
     async def upsert_document(
@@ -134,12 +182,80 @@ class LocalDocumentIndex(LocalIndex):
         if not self._embeddings:
             raise Exception('Embeddings model not configured.')
 
-        document_id = await self.get_document_id(uri)
-        if document_id is not None:
-            await self.delete_document(uri)
-        else:
-            document_id = str(uuid4())
+        chunks = self.split_document(uri, text, doc_type)
+        token_positions = TokenPositions.from_text(text, self._tokenizer)
+        embeddings = await self.embed_chunks(chunks)
 
+        await self.begin_update()
+        try:
+            document = await self.add_document_to_update(uri, text, chunks, embeddings, metadata, token_positions)
+            await self.end_update()
+        except Exception as err:
+            self.cancel_update()
+            raise Exception(f'Error adding document "{uri}": {str(err)}')
+
+        return document
+
+    async def upsert_documents(
+        self,
+        documents: Iterable[Tuple[str, str, Optional[str], Optional[Dict[str, MetadataTypes]]]],
+        concurrency: int = 4
+    ) -> UpsertDocumentsResult:
+        """
+        Upserts many (uri, text, doc_type, metadata) documents in a single commit. Up to
+        concurrency documents are split (in worker threads) and embedded at a time, then
+        every chunk insert, delete and catalog change is applied by one update.
+        """
+        if not self._embeddings:
+            raise Exception('Embeddings model not configured.')
+
+        started_at = time.perf_counter()
+        documents = list(documents)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        def split(uri, text, doc_type):
+            return self.split_document(uri, text, doc_type), TokenPositions.from_text(text, self._tokenizer)
+
+        async def prepare(uri, text, doc_type):
+            async with semaphore:
+                try:
+                    chunks, token_positions = await asyncio.to_thread(split, uri, text, doc_type)
+                    embeddings = await self.embed_chunks(chunks)
+                except Exception as err:
+                    raise Exception(f'Error adding document "{uri}": {str(err)}')
+            return chunks, token_positions, embeddings
+
+        tasks = [asyncio.ensure_future(prepare(uri, text, doc_type)) for uri, text, doc_type, _ in documents]
+        try:
+            prepared = await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop splitting and embedding the other documents once one of them fails
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        await self.begin_update()
+        try:
+            added = []
+            for (uri, text, _, metadata), (chunks, token_positions, embeddings) in zip(documents, prepared):
+                added.append(await self.add_document_to_update(uri, text, chunks, embeddings, metadata, token_positions))
+            await self.end_update()
+        except Exception as err:
+            self.cancel_update()
+            raise Exception(f'Error adding documents: {str(err)}')
+
+        return UpsertDocumentsResult(
+            documents=added,
+            chunks=sum(len(chunks) for chunks, _, _ in prepared),
+            elapsed=time.perf_counter() - started_at,
+        )
+
+    def split_document(self, uri: str, text: str, doc_type: Optional[str] = None) -> List[TextChunk]:
+        splitter = TextSplitter(self.get_chunking_config(uri, doc_type))
+        return splitter.split(text)
+
+    def get_chunking_config(self, uri: str, doc_type: Optional[str] = None) -> Dict:
         config = {
             **(self._chunking_config or {}),
             "doc_type": doc_type or self._chunking_config.get("doc_type"),
@@ -151,8 +267,12 @@ class LocalDocumentIndex(LocalIndex):
                 ext = uri[pos + 1:].lower()
                 config["doc_type"] = ext
 
-        splitter = TextSplitter(config)
-        chunks = splitter.split(text)
+        return config
+
+    async def embed_chunks(self, chunks: List[TextChunk]) -> List[List[float]]:
+        if not self._embeddings:
+            raise Exception('Embeddings model not configured.')
+
         total_tokens = 0
         chunk_batches = []
         current_batch = []
@@ -160,7 +280,7 @@ class LocalDocumentIndex(LocalIndex):
         for chunk in chunks:
             total_tokens += len(chunk.tokens)
 
-            if total_tokens > self._embeddings.max_tokens:
+            if total_tokens > self._embeddings.max_tokens and current_batch:
                 chunk_batches.append(current_batch)
                 current_batch = []
                 total_tokens = len(chunk.tokens)
@@ -183,41 +303,200 @@ class LocalDocumentIndex(LocalIndex):
 
             embeddings.extend(response.output or [])
 
-        await self.begin_update()
+        return embeddings
+
+    async def add_document_to_update(
+        self,
+        uri: str,
+        text: str,
+        chunks: List[TextChunk],
+        embeddings: List[List[float]],
+        metadata: Optional[Dict[str, MetadataTypes]] = None,
+        token_positions: Optional[TokenPositions] = None
+    ) -> LocalDocument:
+        """
+        Adds an already split and embedded document to the pending update,
+        replacing the chunks of any previous version of the document. The text's
+        token offsets are computed here unless they're passed in. The document's files
+        are staged and only replace the previous version's when the update is committed.
+        """
+        document_id = self.remove_document_from_update(uri) or str(uuid4())
+        chunk_ids = await self.add_chunks_to_update(document_id, chunks, embeddings, metadata)
+
+        text_path = self._stage_file(os.path.join(self.folder_path, f'{document_id}.txt'))
+        with open(text_path, 'w', encoding='utf-8', newline='') as text_file:
+            text_file.write(text)
+        if token_positions is None:
+            token_positions = TokenPositions.from_text(text, self._tokenizer)
+        token_positions.save(self._stage_file(os.path.join(self.folder_path, f'{document_id}.tokens')))
+        CharOffsets.from_text(text).save(self._stage_file(os.path.join(self.folder_path, f'{document_id}.chars')))
+
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return self.add_document_to_catalog(uri, document_id, metadata, chunk_ids, content_hash, len(token_positions))
+
+    async def upsert_document_stream(
+        self,
+        uri: str,
+        blocks: Union[IO[str], Iterable[str]],
+        doc_type: Optional[str] = None,
+        metadata: Optional[Dict[str, MetadataTypes]] = None
+    ) -> LocalDocument:
+        """
+        Upserts a document read from a file handle or an iterable of text blocks. The text
+        is split, embedded and copied to disk as it streams through, so memory use depends
+        on the chunk size rather than the document size.
+
+        The document is split and embedded into temporary files before the update is
+        begun, so the write lock is only held while its chunks are added and committed.
+        """
+        document = await self.prepare_document_stream(uri, blocks, doc_type)
         try:
-            for i, chunk in enumerate(chunks):
-                embedding = embeddings[i]
-                chunk_metadata = {
-                    "document_id": document_id,
-                    "start_pos": chunk.start_pos,
-                    "end_pos": chunk.end_pos,
-                    **(metadata or {}),
-                }
-                await self.insert_item(
-                    {
-                        "id": str(uuid4()),
-                        "metadata": chunk_metadata,
-                        "vector": embedding,
-                    }
-                )
-            if metadata:
-                with open(os.path.join(self.folder_path, f'{document_id}.json'), 'w') as metadata_file:
-                    json.dump(metadata, metadata_file)
-
-            with open(os.path.join(self.folder_path, f'{document_id}.txt'), 'w') as text_file:
-                text_file.write(text)
-
-            self._new_catalog['uri_to_id'][uri] = document_id
-            self._new_catalog['id_to_uri'][document_id] = uri
-            self._new_catalog['count'] += 1
+            await self.begin_update()
+            try:
+                added = await self.add_streamed_document_to_update(document, metadata)
+                await self.end_update()
+            except Exception as err:
+                self.cancel_update()
+                raise Exception(f'Error adding document "{uri}": {str(err)}')
+        finally:
+            document.discard()
 
-            await self.end_update()
+        return added
+
+    async def prepare_document_stream(
+        self,
+        uri: str,
+        blocks: Union[IO[str], Iterable[str]],
+        doc_type: Optional[str] = None
+    ) -> StreamedDocument:
+        """
+        Splits and embeds a streamed document, copying its text and offsets to temporary
+        files, without beginning an update. Add it to an update with
+        add_streamed_document_to_update, or discard it.
+        """
+        if not self._embeddings:
+            raise Exception('Embeddings model not configured.')
+
+        splitter = TextSplitter(self.get_chunking_config(uri, doc_type))
+        temp_id = str(uuid4())
+        document = StreamedDocument(uri, {extension: os.path.join(self.folder_path, f'{temp_id}.{extension}.tmp')
+                                          for extension in ('txt', 'tokens', 'chars')})
+        try:
+            with open(document.temp_paths['txt'], 'w', encoding='utf-8', newline='') as text_file, \
+                    TokenPositionsWriter(document.temp_paths['tokens']) as token_positions:
+                copied = _BlockCopier(blocks, text_file, token_positions, self._tokenizer)
+                chunks = splitter.split_stream(copied)
+                while True:
+                    batch = await asyncio.to_thread(self._next_chunk_batch, chunks)
+                    if not batch:
+                        break
+                    document.embeddings.extend(await self.embed_chunks(batch))
+                    document.spans.extend((chunk.start_pos, chunk.end_pos, len(chunk.tokens)) for chunk in batch)
+                token_positions.text_length = copied.char_offsets.text_length
+            copied.char_offsets.save(document.temp_paths['chars'])
         except Exception as err:
-            self.cancel_update()
+            document.discard()
             raise Exception(f'Error adding document "{uri}": {str(err)}')
 
+        document.content_hash = copied.content_hash.hexdigest()
+        document.token_count = token_positions.count
+        return document
+
+    async def add_streamed_document_to_update(
+        self,
+        document: StreamedDocument,
+        metadata: Optional[Dict[str, MetadataTypes]] = None
+    ) -> LocalDocument:
+        """
+        Adds a document prepared by prepare_document_stream to the pending update. Its
+        temporary files become the document's staged files.
+        """
+        document_id = self.remove_document_from_update(document.uri) or str(uuid4())
+        chunk_ids = await self._add_spans_to_update(document_id, document.spans, document.embeddings, metadata)
+        for extension, temp_path in document.temp_paths.items():
+            os.replace(temp_path, self._stage_file(os.path.join(self.folder_path, f'{document_id}.{extension}')))
+        return self.add_document_to_catalog(document.uri, document_id, metadata, chunk_ids,
+                                            document.content_hash, document.token_count)
+
+    async def add_chunks_to_update(
+        self,
+        document_id: str,
+        chunks: List[TextChunk],
+        embeddings: List[List[float]],
+        metadata: Optional[Dict[str, MetadataTypes]] = None
+    ) -> List[str]:
+        spans = [(chunk.start_pos, chunk.end_pos, len(chunk.tokens)) for chunk in chunks]
+        return await self._add_spans_to_update(document_id, spans, embeddings, metadata)
+
+    async def _add_spans_to_update(
+        self,
+        document_id: str,
+        spans: List[Tuple[int, int, int]],
+        embeddings: List[List[float]],
+        metadata: Optional[Dict[str, MetadataTypes]] = None
+    ) -> List[str]:
+        # Adds a chunk item for each (start_pos, end_pos, token_count) span
+        chunk_ids = []
+        for (start_pos, end_pos, token_count), embedding in zip(spans, embeddings):
+            chunk_metadata = {
+                "document_id": document_id,
+                "start_pos": start_pos,
+                "end_pos": end_pos,
+                "token_count": token_count,
+                **(metadata or {}),
+            }
+            item = await self.add_item_to_update(
+                {
+                    "id": str(uuid4()),
+                    "metadata": chunk_metadata,
+                    "vector": embedding,
+                },
+                True
+            )
+            chunk_ids.append(item["id"])
+        return chunk_ids
+
+    def add_document_to_catalog(
+        self,
+        uri: str,
+        document_id: str,
+        metadata: Optional[Dict[str, MetadataTypes]] = None,
+        chunk_ids: Optional[List[str]] = None,
+        content_hash: Optional[str] = None,
+        token_count: int = 0
+    ) -> LocalDocument:
+        metadata_path = os.path.join(self.folder_path, f'{document_id}.json')
+        if metadata:
+            with open(self._stage_file(metadata_path), 'w') as metadata_file:
+                json.dump(metadata, metadata_file)
+        else:
+            self._stage_removal(metadata_path)
+
+        now = time.time()
+        previous = self._catalog.get_document(document_id, with_chunks=False)
+        self._catalog.upsert(DocumentRecord(
+            id=document_id,
+            uri=uri,
+            chunk_ids=list(chunk_ids or []),
+            content_hash=content_hash,
+            token_count=token_count,
+            created_at=previous.created_at if previous else now,
+            updated_at=now,
+        ))
+
         return LocalDocument(self.folder_path, document_id, uri)
 
+    def _next_chunk_batch(self, chunks: Iterator[TextChunk]) -> List[TextChunk]:
+        # Pull chunks until the next one would no longer fit in one embeddings request
+        batch = []
+        total_tokens = 0
+        for chunk in chunks:
+            batch.append(chunk)
+            total_tokens += len(chunk.tokens)
+            if total_tokens >= self._embeddings.max_tokens - self._chunking_config["chunk_size"]:
+                break
+        return batch
+
     async def query_documents(self, query: str, options: DocumentQueryOptions = None) -> List[LocalDocumentResult]:
         if not self._embeddings:
             raise Exception('Embeddings model not configured.')
@@ -236,12 +515,12 @@ class LocalDocumentIndex(LocalIndex):
         document_chunks = {}
 
         for result in results:
-            metadata = result.item.metadata
+            document_id = result["item"]["metadata"]["document_id"]
 
-            if metadata.document_id not in document_chunks:
-                document_chunks[metadata.document_id] = []
+            if document_id not in document_chunks:
+                document_chunks[document_id] = []
 
-            document_chunks[metadata.document_id].append(result)
+            document_chunks[document_id].append(result)
 
         document_results = []
 
@@ -253,53 +532,193 @@ class LocalDocumentIndex(LocalIndex):
         document_results.sort(key=lambda x: x.score, reverse=True)
         return document_results[:options.max_documents]
 
+    async def render_documents(
+        self,
+        results: List[LocalDocumentResult],
+        max_tokens: int,
+        max_sections: int = 1,
+        total_tokens: Optional[int] = None,
+        max_workers: int = 8
+    ) -> List[List[DocumentTextSection]]:
+        """
+        Renders the sections of many query results at once, reading and rendering the
+        documents concurrently in a thread pool. When total_tokens is given, sections are
+        kept in order of document score, then section score, while they fit within it.
+        Returns the sections of each result in the same order as results.
+        """
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            rendered = await asyncio.gather(*(
+                loop.run_in_executor(pool, result.render_sections_sync, max_tokens, max_sections)
+                for result in results
+            ))
+
+        if total_tokens is None:
+            return list(rendered)
+
+        ranked = sorted(
+            ((result.score, section["score"], i, section) for i, (result, sections) in enumerate(zip(results, rendered))
+             for section in sections),
+            key=lambda x: (x[0], x[1]),
+            reverse=True
+        )
+        kept = [[] for _ in results]
+        budget = total_tokens
+        for _, _, i, section in ranked:
+            if section["token_count"] <= budget:
+                kept[i].append(section)
+                budget -= section["token_count"]
+        return kept
+
     async def begin_update(self):
         await super().begin_update()
-        self._new_catalog = self._catalog.copy()
+        self._catalog.begin()
 
     def cancel_update(self):
         super().cancel_update()
-        self._new_catalog = None
-
-    async def end_update(self):
-        await super().end_update()
-
+        self._catalog.cancel()
+        self._discard_staged_files()
+
+    def _save_update(self, generation: int) -> None:
+        """
+        Writing index.json commits the update. It carries a journal of the update's
+        catalog changes and staged files, which are applied after it's written. If that's
+        cut short the next load finds the catalog behind the index and applies the
+        journal again.
+        """
+        journal = {
+            "generation": generation,
+            "catalog": self._catalog.pending_changes(),
+            "files": {
+                os.path.basename(path): staged_path and os.path.basename(staged_path)
+                for path, staged_path in self._staged_files.items()
+            },
+        }
+        self._update[COMMIT_JOURNAL_KEY] = journal
+        super()._save_update(generation)
+        # Committed, so the staged files now belong to the journal
+        self._staged_files = {}
         try:
-            # Save catalog
-            catalog_path = os.path.join(self.folder_path, 'catalog.json')
-            with open(catalog_path, 'w') as catalog_file:
-                json.dump(self._new_catalog, catalog_file)
-            self._catalog = self._new_catalog
-            self._new_catalog = None
+            self._apply_journal(journal)
         except Exception as err:
-            raise Exception(f'Error saving document catalog: {str(err)}')
-
-    async def load_index_data(self):
-        await super().load_index_data()
-
-        if self._catalog:
+            self._catalog.cancel()
+            self._recovered_generation = None
+            print(f'Error applying document changes: {str(err)}. They will be applied when the index is next loaded')
+
+    def _apply_journal(self, journal: Dict) -> None:
+        # Files are moved first as the catalog's generation marks the journal as applied
+        for name, staged_name in journal["files"].items():
+            path = os.path.join(self.folder_path, name)
+            if staged_name:
+                staged_path = os.path.join(self.folder_path, staged_name)
+                if os.path.exists(staged_path):
+                    os.replace(staged_path, path)
+            elif os.path.exists(path):
+                os.unlink(path)
+        self._catalog.apply(journal["catalog"], journal["generation"])
+
+    def _recover_commit(self) -> None:
+        journal = self._data.get(COMMIT_JOURNAL_KEY)
+        if not journal or journal["generation"] <= self._catalog.generation:
+            return
+        if self._write_lock.is_locked:
+            self._apply_journal(journal)
             return
+        # Applied under the write lock so it can't race a writer that has already done so
+        with FileLock(self._write_lock.path):
+            if journal["generation"] > self._catalog.generation:
+                self._apply_journal(journal)
+
+    def _stage_file(self, path: str) -> str:
+        """
+        Returns the staged path to write a document file to. It's moved to path when the
+        update is committed and deleted if it's cancelled.
+        """
+        staged_path = f'{path}.pending'
+        self._discard_staged_file(path)
+        self._staged_files[path] = staged_path
+        return staged_path
+
+    def _stage_removal(self, path: str) -> None:
+        self._discard_staged_file(path)
+        self._staged_files[path] = None
+
+    def _discard_staged_file(self, path: str) -> None:
+        staged_path = self._staged_files.pop(path, None)
+        if staged_path and os.path.exists(staged_path):
+            os.unlink(staged_path)
+
+    def _discard_staged_files(self) -> None:
+        for path in list(self._staged_files):
+            self._discard_staged_file(path)
+
+    async def delete_index(self) -> None:
+        self._catalog.close()
+        await super().delete_index()
 
-        catalog_path = os.path.join(self.folder_path, 'catalog.json')
-        thread_test = await asyncio.gather(
-                                            asyncio.to_thread(is_catalog_created),
-                                            asyncio.sleep(1)
-                                            )
-        if is_catalog_created():
-            # Load catalog
-            async with aiofiles.open(catalog_path, 'r') as catalog_file:
-                contents = await catalog_file.read()
-                self._catalog = json.loads(contents)
+    async def load_index_data(self):
+        if self._catalog.is_open:
+            # sqlite keeps the catalog current, only the index may need reloading
+            await super().load_index_data()
         else:
+            if not self.is_index_created():
+                raise ValueError('Index does not exist')
+
+            # Load the index and open the catalog concurrently
+            await asyncio.gather(super().load_index_data(), asyncio.to_thread(self._catalog.open))
+            if self._catalog.needs_migration():
+                try:
+                    await asyncio.to_thread(self._migrate_catalog)
+                except Exception as err:
+                    raise Exception(f'Error migrating document catalog: {str(err)}')
+
+        # Finish a commit whose writer stopped between writing index.json and the catalog
+        if not self._update and self._recovered_generation != self._generation:
             try:
-                # Initialize catalog
-                self._catalog = {
-                    'version': 1,
-                    'count': 0,
-                    'uri_to_id': {},
-                    'id_to_uri': {},
-                }
-                with open(catalog_path, 'w') as catalog_file:
-                    json.dump(self._catalog, catalog_file)
+                await asyncio.to_thread(self._recover_commit)
             except Exception as err:
-                raise Exception(f'Error creating document catalog: {str(err)}')
+                raise Exception(f'Error recovering document catalog: {str(err)}')
+            self._recovered_generation = self._generation
+
+    def _migrate_catalog(self) -> None:
+        if self._write_lock.is_locked:
+            self._catalog.migrate(self._data["items"])
+            return
+        # Another process may be migrating the same folder
+        with FileLock(self._write_lock.path):
+            if self._catalog.needs_migration():
+                self._catalog.migrate(self._data["items"])
+
+
+class _BlockCopier:
+    """
+    Passes text blocks through to the splitter while copying them to the document's
+    text file, appending its token offsets to a .tokens file and collecting its char
+    offsets. Token offsets are computed per block, so a token straddling two blocks is
+    counted as two.
+    """
+    def __init__(self,
+                 blocks: Union[IO[str], Iterable[str]],
+                 text_file: IO[str],
+                 offsets: TokenPositionsWriter,
+                 tokenizer: Tokenizer):
+        if isinstance(blocks, str):
+            blocks = [blocks]
+        elif hasattr(blocks, 'read'):
+            file = blocks
+            blocks = iter(lambda: file.read(STREAM_BLOCK_SIZE), '')
+        self._blocks = blocks
+        self._text_file = text_file
+        self._offsets = offsets
+        self._tokenizer = tokenizer
+        self.char_offsets = CharOffsets()
+        self.content_hash = hashlib.sha256()
+
+    def __iter__(self) -> Iterator[str]:
+        for block in self._blocks:
+            self._text_file.write(block)
+            start = self.char_offsets.text_length
+            self._offsets.extend(start + offset for offset in encode_offsets(self._tokenizer, block))
+            self.char_offsets.extend(block)
+            self.content_hash.update(block.encode('utf-8'))
+            yield block
@@ -1,5 +1,6 @@
+import asyncio
 from typing import List
-from local_document import LocalDocument
+from local_document import LocalDocument, TokenPositions
 from custom_types import QueryResult, DocumentChunkMetadata, Tokenizer, DocumentTextSection
 
 
@@ -12,7 +13,7 @@ class LocalDocumentResult(LocalDocument):
         # Compute average score
         score = 0
         for chunk in self._chunks:
-            score += chunk.score
+            score += chunk["score"]
         self._score = score / len(self._chunks)
 
     @property
@@ -24,15 +25,25 @@ class LocalDocumentResult(LocalDocument):
         return self._score
 
     async def render_sections(self, max_tokens: int, max_sections: int) -> List[DocumentTextSection]:
-        # Load text from disk
-        text = await self.load_text()
+        return await asyncio.to_thread(self.render_sections_sync, max_tokens, max_sections)
+
+    def render_sections_sync(self, max_tokens: int, max_sections: int) -> List[DocumentTextSection]:
+        """
+        Blocking version of render_sections. Only the ranges of text around the matched
+        chunks are read from disk.
+        """
+        positions = self.read_token_positions()
+        if positions is None:
+            # Documents indexed before token offsets were saved need encoding once
+            positions = TokenPositions.from_text(self.read_text(), self._tokenizer)
+            self._token_positions = positions
 
         # First check to see if the entire document is less than max_tokens
-        tokens = self._tokenizer.encode(text)
-        if len(tokens) < max_tokens:
+        token_count = len(positions)
+        if token_count < max_tokens:
             return [{
-                "text": text,
-                "token_count": len(tokens),
+                "text": self.read_text(),
+                "token_count": token_count,
                 "score": 1.0
             }]
 
@@ -46,17 +57,20 @@ class LocalDocumentResult(LocalDocument):
         # - Dynamically add overlapping chunks of text to each section until the max_tokens is reached.
         chunks = []
         for chunk in self._chunks:
-            start_pos = chunk.item.metadata.start_pos
-            end_pos = chunk.item.metadata.end_pos
-            chunk_text = text[start_pos:end_pos + 1]
-            chunk_tokens = self._tokenizer.encode(chunk_text)
-            if len(chunk_tokens) <= max_tokens:
+            metadata = chunk["item"]["metadata"]
+            start_pos = metadata["start_pos"]
+            end_pos = metadata["end_pos"]
+            # Token counts are stored with each chunk at ingest time
+            chunk_token_count = metadata.get("token_count")
+            if chunk_token_count is None:
+                chunk_token_count = positions.count(start_pos, end_pos + 1)
+            if chunk_token_count <= max_tokens:
                 chunks.append({
-                    "text": chunk_text,
+                    "text": self.read_text_range(start_pos, end_pos + 1),
                     "start_pos": start_pos,
                     "end_pos": end_pos,
-                    "score": chunk.score,
-                    "token_count": len(chunk_tokens)
+                    "score": chunk["score"],
+                    "token_count": chunk_token_count
                 })
 
         chunks.sort(key=lambda x: x["start_pos"])
@@ -64,14 +78,12 @@ class LocalDocumentResult(LocalDocument):
         if not chunks:
             # Take the top chunk and return a subset of its text
             top_chunk = self._chunks[0]
-            start_pos = top_chunk.item.metadata.start_pos
-            end_pos = top_chunk.item.metadata.end_pos
-            chunk_text = text[start_pos:end_pos + 1]
-            tokens = self._tokenizer.encode(chunk_text)
+            start_pos = top_chunk["item"]["metadata"]["start_pos"]
+            end_pos, count = positions.end_after(start_pos, max_tokens)
             return [{
-                "text": self._tokenizer.decode(tokens[:max_tokens]),
-                "token_count": max_tokens,
-                "score": top_chunk.score
+                "text": self.read_text_range(start_pos, end_pos),
+                "token_count": count,
+                "score": top_chunk["score"]
             }]
 
         sections = []
@@ -92,6 +104,8 @@ class LocalDocumentResult(LocalDocument):
             current_section["chunks"].append(chunk)
             current_section["score"] += chunk["score"]
             current_section["token_count"] += chunk["token_count"]
+        if current_section["chunks"]:
+            sections.append(current_section)
 
         # Normalize section scores
         for section in sections:
@@ -122,7 +136,7 @@ class LocalDocumentResult(LocalDocument):
             "start_pos": -1,
             "end_pos": -1,
             "score": 0,
-            "token_count": self._tokenizer.encode('\n\n...\n\n')
+            "token_count": self._count_tokens('\n\n...\n\n')
         }
 
         for section in sections:
@@ -140,12 +154,10 @@ class LocalDocumentResult(LocalDocument):
                 section_start = section["chunks"][0]["start_pos"]
                 section_end = section["chunks"][-1]["end_pos"]
                 if section_start > 0:
-                    before_text = text[:section_start]
-                    before_tokens = self._tokenizer.encode(before_text)
-                    before_budget = min(len(before_tokens), budget // 2)
+                    before_start, before_budget = positions.start_before(section_start, budget // 2)
                     chunk = {
-                        "text": self._tokenizer.decode(before_tokens[-before_budget:]),
-                        "start_pos": section_start - before_budget,
+                        "text": self.read_text_range(before_start, section_start),
+                        "start_pos": before_start,
                         "end_pos": section_start - 1,
                         "score": 0,
                         "token_count": before_budget
@@ -154,14 +166,12 @@ class LocalDocumentResult(LocalDocument):
                     section["token_count"] += chunk["token_count"]
                     budget -= chunk["token_count"]
 
-                if section_end < len(text) - 1:
-                    after_text = text[section_end + 1:]
-                    after_tokens = self._tokenizer.encode(after_text)
-                    after_budget = min(len(after_tokens), budget)
+                if section_end < positions.text_length - 1:
+                    after_end, after_budget = positions.end_after(section_end + 1, budget)
                     chunk = {
-                        "text": self._tokenizer.decode(after_tokens[:after_budget]),
+                        "text": self.read_text_range(section_end + 1, after_end),
                         "start_pos": section_end + 1,
-                        "end_pos": section_end + after_budget,
+                        "end_pos": after_end - 1,
                         "score": 0,
                         "token_count": after_budget
                     }
@@ -181,3 +191,7 @@ class LocalDocumentResult(LocalDocument):
                 "score": section["score"]
             })
         return rendered_sections
+
+    def _count_tokens(self, text: str) -> int:
+        count_tokens = getattr(self._tokenizer, 'count_tokens', None)
+        return count_tokens(text) if count_tokens else len(self._tokenizer.encode(text))
@@ -1,9 +1,16 @@
+import asyncio
+import heapq
 import os
 import shutil
 import json
+from urllib.parse import quote
 from uuid import uuid4
-from typing import List, Optional, Dict, Union, Any
+from typing import Iterable, List, Optional, Dict, Tuple, Union, Any
 from item_selector import ItemSelector
+from file_lock import FileLock
+from vector_cache import VectorCache, new_query_stats
+from index_file import (VECTOR_ENCODING_COLUMNAR, VECTOR_ENCODING_JSON, LazyItems, open_index_file,
+                        read_index_file, read_index_generation, write_index_file)
 from custom_types import IndexItem, IndexStats, MetadataFilter, MetadataTypes, QueryResult
 
 
@@ -15,11 +22,42 @@ class CreateIndexConfig:
 
 
 class LocalIndex:
-    def __init__(self, folder_path: str, index_name: Optional[str] = None):
+    def __init__(self,
+                 folder_path: str,
+                 index_name: Optional[str] = None,
+                 codec: Optional[str] = None,
+                 vector_encoding: Optional[str] = None,
+                 lazy: bool = False,
+                 memory_budget: Optional[int] = None):
         self._folder_path = folder_path
         self._index_name = index_name or "index.json"
+        # JSON library ("orjson" or "json", defaulting to orjson when installed) and
+        # how vectors are written to index.json. Files in any encoding can be read.
+        self._codec = codec
+        # Lazy indexes read the items of columnar files on demand rather than all at
+        # load, and write columnar files unless told otherwise. Updates still load
+        # every item.
+        self._lazy = lazy or memory_budget is not None
+        # With a memory budget (in bytes) a lazy index keeps at most that much of its
+        # vectors in memory and reads the rest from disk in blocks as queries scan them.
+        # It doesn't cover updates, which load every item of the default namespace and
+        # of the namespaces they change.
+        self._vector_cache = VectorCache(memory_budget) if memory_budget is not None else None
+        # Vectors are kept as JSON numbers unless an encoding is chosen. The float32
+        # encodings are smaller and faster to load but round vectors to 32-bit floats.
+        self._vector_encoding = vector_encoding or (VECTOR_ENCODING_COLUMNAR if self._lazy else VECTOR_ENCODING_JSON)
         self._data = None
         self._update = None
+        self._update_ids = {}  # namespace -> ids of its pending items, built on first use
+        # Items outside the default namespace are kept in one file per namespace, loaded
+        # the first time the namespace is used and cached along with the generation it
+        # was written at
+        self._namespaces = {}
+        self._namespace_updates = {}  # namespace -> pending items, copied on first change
+        self._generation = None  # commit generation the loaded data was read at
+        # Held from begin_update until the update is committed or cancelled so only one
+        # process writes to the folder at a time
+        self._write_lock = FileLock(os.path.join(self._folder_path, f'{self._index_name}.lock'))
 
     @property
     def folder_path(self) -> str:
@@ -32,12 +70,26 @@ class LocalIndex:
     async def begin_update(self) -> None:
         if self._update:
             raise ValueError('Update already in progress')
+        if not self.is_index_created():
+            raise ValueError('Index does not exist')
 
-        await self.load_index_data()
-        self._update = self._data.copy()
+        await asyncio.to_thread(self._write_lock.acquire)
+        try:
+            # Picks up commits made by other processes since the data was loaded
+            await self.load_index_data()
+        except Exception:
+            self._write_lock.release()
+            raise
+        # Copy the item list so a cancelled update leaves the loaded data untouched
+        self._update = {**self._data, "items": list(self._data["items"])}
+        self._update_ids = {}
+        self._namespace_updates = {}
 
     def cancel_update(self) -> None:
         self._update = None
+        self._update_ids = {}
+        self._namespace_updates = {}
+        self._write_lock.release()
 
     async def create_index(self, config: CreateIndexConfig = CreateIndexConfig(version=1)) -> None:
         if self.is_index_created():
@@ -52,134 +104,368 @@ class LocalIndex:
                 "metadata_config": config.metadata_config,
                 "items": []
             }
-            with open(os.path.join(self._folder_path, self._index_name), 'w') as index_file:
-                json.dump(self._data, index_file)
+            self._write_index_file(self._data, 0)
+            self._generation = 0
         except Exception:
             await self.delete_index()
             raise ValueError('Error creating index')
 
     async def delete_index(self) -> None:
         self._data = None
+        self._generation = None
         try:
             shutil.rmtree(self._folder_path)
         except Exception as err:
             print(err)
 
-    async def delete_item(self, id: str) -> None:
+    async def delete_item(self, id: str, namespace: Optional[str] = None) -> None:
+        await self.delete_items([id], namespace)
+
+    async def delete_items(self, ids: Iterable[str], namespace: Optional[str] = None) -> None:
+        if self._update:
+            self.remove_items_from_update(ids, namespace)
+        else:
+            await self.begin_update()
+            try:
+                self.remove_items_from_update(ids, namespace)
+                await self.end_update()
+            except Exception:
+                self.cancel_update()
+                raise
+
+    def remove_items_from_update(self, ids: Iterable[str], namespace: Optional[str] = None) -> int:
+        """
+        Removes every item with one of the given ids in a single pass over the pending
+        items and returns how many were removed.
+        """
+        ids = set(ids)
+        partition = self._update_partition(namespace)
+        count = len(partition["items"])
+        partition["items"] = [item for item in partition["items"] if item["id"] not in ids]
+        if namespace in self._update_ids:
+            self._update_ids[namespace] -= ids
+        return count - len(partition["items"])
+
+    async def delete_namespace(self, namespace: str) -> None:
         if self._update:
-            index = next((i for i, item in enumerate(self._update["items"]) if item["id"] == id), None)
-            if index is not None:
-                self._update["items"].pop(index)
+            self._namespace_updates[namespace] = {"items": []}
+            self._update_ids.pop(namespace, None)
         else:
             await self.begin_update()
-            index = next((i for i, item in enumerate(self._update["items"]) if item["id"] == id), None)
-            if index is not None:
-                self._update["items"].pop(index)
-            await self.end_update()
+            try:
+                await self.delete_namespace(namespace)
+                await self.end_update()
+            except Exception:
+                self.cancel_update()
+                raise
 
     async def end_update(self) -> None:
         if not self._update:
             raise ValueError('No update in progress')
 
         try:
-            with open(os.path.join(self._folder_path, self._index_name), 'w') as index_file:
-                json.dump(self._update, index_file)
-            self._data = self._update.copy()
+            generation = self._read_generation() + 1
+            # Namespace files are written to new files before index.json, which lists
+            # them, and the files it no longer lists are removed once it's written
+            replaced_files = self._save_namespaces(generation)
+            if self._lazy:
+                # Lazy indexes reopen the new file on next use instead of holding every item
+                self._close_partition(None)
+            self._save_update(generation)
+            self._generation = generation
+            self._remove_legacy_generation_file()
+            self._remove_namespace_files(replaced_files, generation)
+            if not self._lazy:
+                self._data = self._update.copy()
             self._update = None
+            self._update_ids = {}
+            self._namespace_updates = {}
         except Exception as err:
             raise ValueError(f'Error saving index: {str(err)}')
+        self._write_lock.release()
 
     async def get_index_stats(self) -> IndexStats:
         await self.load_index_data()
         return {
             "version": self._data["version"],
             "metadata_config": self._data["metadata_config"],
-            "items": len(self._data["items"])
+            "items": len(self._data["items"]),
+            "namespaces": {
+                namespace: {"items": info["items"]} for namespace, info in self._data.get("namespaces", {}).items()
+            }
         }
 
-    async def get_item(self, id: str) -> Optional[IndexItem]:
+    def get_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the vector cache's size, hit rate and bytes read from disk, in total and
+        for the last query, or None without a memory budget.
+        """
+        return self._vector_cache.get_stats() if self._vector_cache else None
+
+    async def list_namespaces(self) -> List[str]:
         await self.load_index_data()
-        item = next((item for item in self._data["items"] if item["id"] == id), None)
+        return list(self._data.get("namespaces", {}))
+
+    async def get_item(self, id: str, namespace: Optional[str] = None) -> Optional[IndexItem]:
+        items = await self._load_items(namespace)
+        if isinstance(items, LazyItems):
+            return items.get(id)
+        item = next((item for item in items if item["id"] == id), None)
         return item
 
-    async def insert_item(self, item: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    async def insert_item(self, item: Optional[Dict[str, Any]] = None, namespace: Optional[str] = None) -> Dict[str, Any]:
         if self._update:
-            return await self.add_item_to_update(item, True)
+            return await self.add_item_to_update(item, True, namespace)
         else:
             await self.begin_update()
-            new_item = await self.add_item_to_update(item, True)
-            await self.end_update()
+            try:
+                new_item = await self.add_item_to_update(item, True, namespace)
+                await self.end_update()
+            except Exception:
+                self.cancel_update()
+                raise
             return new_item
 
     def is_index_created(self) -> bool:
         return os.path.exists(os.path.join(self._folder_path, self._index_name))
 
-    async def list_items(self) -> List[IndexItem]:
-        await self.load_index_data()
-        return self._data["items"][:]
+    async def list_items(self, namespace: Optional[str] = None) -> List[IndexItem]:
+        items = await self._load_items(namespace)
+        return items[:]
 
-    async def list_items_by_metadata(self, filter: MetadataFilter) -> List[IndexItem]:
-        await self.load_index_data()
-        return [item for item in self._data["items"] if ItemSelector.select(item["metadata"], filter)]
+    async def list_items_by_metadata(self, filter: MetadataFilter, namespace: Optional[str] = None) -> List[IndexItem]:
+        items = await self._load_items(namespace)
+        return [items[row] for row in self._filter_rows(items, filter)]
 
     async def query_items(self,
                           vector: List[float],
                           top_k: int,
-                          filter: Optional[MetadataFilter] = None) -> List[QueryResult]:
-        await self.load_index_data()
-
-        items = self._data["items"][:]
-        if filter:
-            items = [item for item in items if ItemSelector.select(item["metadata"], filter)]
+                          filter: Optional[MetadataFilter] = None,
+                          namespace: Optional[str] = None) -> List[QueryResult]:
+        await self._load_items(namespace)
+        # Scoring is CPU bound and a memory budget reads vectors from disk, so it runs
+        # off the event loop
+        return await asyncio.to_thread(self.query_items_sync, vector, top_k, filter, namespace)
+
+    def query_items_sync(self,
+                         vector: List[float],
+                         top_k: int,
+                         filter: Optional[MetadataFilter] = None,
+                         namespace: Optional[str] = None) -> List[QueryResult]:
+        """
+        Blocking version of query_items over the already loaded data, so callers can
+        run it in a worker thread. Only the items of the given namespace are scanned.
+        """
+        items = self._get_namespace(namespace)["items"]
+        rows = self._filter_rows(items, filter) if filter else range(len(items))
+        query_stats = new_query_stats()
+        if isinstance(items, LazyItems):
+            vectors = items.vectors(rows, query_stats)
+        else:
+            vectors = ((row, items[row]["vector"], items[row]["norm"]) for row in rows)
 
         norm = ItemSelector.normalize(vector)
-        distances = []
-        for i, item in enumerate(items):
-            distance = ItemSelector.normalized_cosine_similarity(vector, norm, item["vector"], item["norm"])
-            distances.append({"index": i, "distance": distance})
-
-        distances.sort(key=lambda x: x["distance"], reverse=True)
-        top_items = distances[:top_k]
-
-        for item in top_items:
-            if "metadataFile" in items[item["index"]]:
-                metadata_path = os.path.join(self._folder_path, items[item["index"]]["metadataFile"])
+        distances = [
+            (row, ItemSelector.normalized_cosine_similarity(vector, norm, item_vector, item_norm))
+            for row, item_vector, item_norm in vectors
+        ]
+        top_items = heapq.nlargest(top_k, distances, key=lambda distance: distance[1])
+        if isinstance(items, LazyItems):
+            items.record_results([row for row, _ in top_items], query_stats)
+
+        results = []
+        for row, score in top_items:
+            item = items[row]
+            if "metadataFile" in item:
+                metadata_path = os.path.join(self._folder_path, item["metadataFile"])
                 with open(metadata_path, 'r') as metadata_file:
-                    items[item["index"]]["metadata"] = json.load(metadata_file)
-
-        return [{"item": items[item["index"]], "score": item["distance"]} for item in top_items]
-
-    async def upsert_item(self, item: Optional[Dict[str, Any]] = None) -> IndexItem:
+                    item["metadata"] = json.load(metadata_file)
+            results.append({"item": item, "score": score})
+        return results
+
+    @staticmethod
+    def _filter_rows(items: List[IndexItem], filter: MetadataFilter) -> List[int]:
+        if isinstance(items, LazyItems):
+            # Decodes the records but leaves the vectors on disk
+            return [row for row in range(len(items)) if ItemSelector.select(items.record(row)["metadata"], filter)]
+        return [row for row, item in enumerate(items) if ItemSelector.select(item["metadata"], filter)]
+
+    async def upsert_item(self, item: Optional[Dict[str, Any]] = None, namespace: Optional[str] = None) -> IndexItem:
         if self._update:
-            return await self.add_item_to_update(item, False)
+            return await self.add_item_to_update(item, False, namespace)
         else:
             await self.begin_update()
-            new_item = await self.add_item_to_update(item, False)
-            await self.end_update()
+            try:
+                new_item = await self.add_item_to_update(item, False, namespace)
+                await self.end_update()
+            except Exception:
+                self.cancel_update()
+                raise
             return new_item
 
     async def load_index_data(self) -> None:
-        if self._data:
+        """
+        Loads the index, or reloads it when another process has committed since it was
+        loaded. Checking costs one read of index.json's header.
+        """
+        if self._update:
+            return
+        if self._data and self._read_generation() == self._generation:
             return
 
         if not self.is_index_created():
             raise ValueError('Index does not exist')
 
         try:
-            with open(os.path.join(self._folder_path, self._index_name), 'r') as index_file:
-                self._data = json.load(index_file)
-        except Exception:
-            raise ValueError('Error loading index data')
+            self._generation, self._data = await asyncio.to_thread(self._read_index_file)
+        except Exception as err:
+            raise ValueError(f'Error loading index data: {str(err)}')
 
-    async def add_item_to_update(self, item: Optional[Dict[str, Any]], unique: bool) -> IndexItem:
+    async def _load_items(self, namespace: Optional[str]) -> List[IndexItem]:
+        await self.load_index_data()
+        if namespace is None or namespace in self._namespaces:
+            return self._get_namespace(namespace)["items"]
+        partition = await asyncio.to_thread(self._get_namespace, namespace)
+        return partition["items"]
+
+    def _get_namespace(self, namespace: Optional[str]) -> Dict[str, Any]:
+        """
+        Returns the committed items of a namespace, reading its file if it hasn't been
+        read since it was last written.
+        """
+        if namespace is None:
+            return self._data
+        info = self._data.get("namespaces", {}).get(namespace)
+        if info is None:
+            return {"items": []}
+        partition = self._namespaces.get(namespace)
+        if partition is None or partition["generation"] != info["generation"]:
+            try:
+                data = self._read_items_file(self._namespace_path(namespace, info))
+            except Exception as err:
+                raise ValueError(f'Error loading namespace "{namespace}": {str(err)}')
+            partition = {"generation": info["generation"], "items": data["items"]}
+            self._namespaces[namespace] = partition
+        return partition
+
+    def _update_partition(self, namespace: Optional[str]) -> Dict[str, Any]:
+        if namespace is None:
+            return self._update
+        partition = self._namespace_updates.get(namespace)
+        if partition is None:
+            partition = {"items": list(self._get_namespace(namespace)["items"])}
+            self._namespace_updates[namespace] = partition
+        return partition
+
+    def _namespace_path(self, namespace: str, info: Dict[str, Any]) -> str:
+        # Files written by earlier versions were named after the namespace alone
+        file_name = info.get("file") or f'{quote(namespace, safe="")}.json'
+        return os.path.join(self._folder_path, f'{self._index_name}.namespaces', file_name)
+
+    def _save_namespaces(self, generation: int) -> List[Tuple[str, str]]:
+        """
+        Writes the namespaces changed by the update, each to a new file named after the
+        generation so the committed file stays in place until index.json stops listing
+        it. Returns the namespaces and paths of the files the update replaces.
+        """
+        namespaces = dict(self._update.get("namespaces", {}))
+        replaced = []
+        for namespace, partition in self._namespace_updates.items():
+            info = namespaces.pop(namespace, None)
+            if info is not None:
+                replaced.append((namespace, self._namespace_path(namespace, info)))
+            if not partition["items"]:
+                continue
+            # "@" is always quoted, so these names can't clash with the older ones
+            info = {
+                "items": len(partition["items"]),
+                "generation": generation,
+                "file": f'{quote(namespace, safe="")}@{generation}.json',
+            }
+            path = self._namespace_path(namespace, info)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_index_file(path, {"items": partition["items"]}, keep_previous=False, codec=self._codec,
+                             vector_encoding=self._vector_encoding)
+            namespaces[namespace] = info
+            if not self._lazy:
+                self._namespaces[namespace] = {"generation": generation, "items": partition["items"]}
+        if namespaces or "namespaces" in self._update:
+            self._update["namespaces"] = namespaces
+        return replaced
+
+    def _remove_namespace_files(self, files: List[Tuple[str, str]], generation: int) -> None:
+        for namespace, path in files:
+            partition = self._namespaces.get(namespace)
+            if partition is not None and partition["generation"] != generation:
+                self._close_partition(namespace)
+            for file_path in (path, f'{path}.prev'):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    def _close_partition(self, namespace: Optional[str]) -> None:
+        """
+        Drops the committed items of a namespace, or of the default namespace when it's
+        None, closing a lazily read file so a commit can replace or remove it. Windows
+        can't while it's open. The new file is read on next use.
+        """
+        if namespace is None:
+            partition, self._data = self._data, None
+        else:
+            partition = self._namespaces.pop(namespace, None)
+        if partition is not None and isinstance(partition["items"], LazyItems):
+            partition["items"].close()
+
+    def _read_index_file(self):
+        # The generation is read first so a commit landing in between causes a reload
+        # next time rather than being missed
+        generation = self._read_generation()
+        return generation, self._read_items_file(os.path.join(self._folder_path, self._index_name))
+
+    def _read_items_file(self, path: str) -> Dict[str, Any]:
+        if self._lazy:
+            return open_index_file(path, self._codec, self._vector_cache)
+        return read_index_file(path, self._codec)
+
+    def _save_update(self, generation: int) -> None:
+        self._write_index_file(self._update, generation)
+
+    def _write_index_file(self, data: Dict[str, Any], generation: int) -> None:
+        # Renamed over the old file once fully written so readers never see a partial file.
+        # The generation goes in its header, so it's committed along with the data.
+        write_index_file(os.path.join(self._folder_path, self._index_name), data,
+                         codec=self._codec, vector_encoding=self._vector_encoding, generation=generation)
+
+    def _remove_legacy_generation_file(self) -> None:
+        path = os.path.join(self._folder_path, f'{self._index_name}.gen')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _read_generation(self) -> int:
+        try:
+            generation = read_index_generation(os.path.join(self._folder_path, self._index_name))
+            if generation is not None:
+                return generation
+            # Indexes committed by earlier versions kept it in a separate file
+            with open(os.path.join(self._folder_path, f'{self._index_name}.gen'), 'r') as generation_file:
+                return int(generation_file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    async def add_item_to_update(self,
+                                 item: Optional[Dict[str, Any]],
+                                 unique: bool,
+                                 namespace: Optional[str] = None) -> IndexItem:
         if "vector" not in item:
             raise ValueError('Vector is required')
 
+        if namespace is not None and namespace not in self._namespace_updates:
+            # Reading the namespace's file the first time it's changed
+            await asyncio.to_thread(self._update_partition, namespace)
+        partition = self._update_partition(namespace)
+
         item_id = item.get("id") or str(uuid4())
-        if unique:
-            existing_item = next((i for i in self._update["items"] if i["id"] == item_id), None)
-            if existing_item:
-                raise ValueError(f'Item with id {item_id} already exists')
+        if unique and self._has_update_item(item_id, namespace):
+            raise ValueError(f'Item with id {item_id} already exists')
 
         metadata = {}
         metadata_file = None
@@ -198,9 +484,6 @@ class LocalIndex:
                     json.dump(item["metadata"], metadata_file)
         elif item.get("metadata"):
             metadata = item["metadata"]
-        # print('local index, after metadata')
-        # print('item vector type and len', type(item["vector"]), len(item["vector"]))
-        # print('item vector chunk inspection', item["vector"][0])
         try:
             new_item = {
                 "id": item_id,
@@ -213,11 +496,20 @@ class LocalIndex:
         if metadata_file:
             new_item["metadataFile"] = metadata_file
 
-        if not unique:
-            existing_item = next((i for i in self._update["items"] if i["id"] == item_id), None)
-            if existing_item:
-                existing_item.update(new_item)
-                return existing_item
+        if not unique and self._has_update_item(item_id, namespace):
+            # The update shares its items with the loaded data, so the item is replaced
+            # by an updated copy rather than changed in place
+            position = next(i for i, existing_item in enumerate(partition["items"]) if existing_item["id"] == item_id)
+            new_item = {**partition["items"][position], **new_item}
+            partition["items"][position] = new_item
+            return new_item
 
-        self._update["items"].append(new_item)
+        partition["items"].append(new_item)
+        self._update_ids[namespace].add(item_id)
         return new_item
+
+    def _has_update_item(self, id: str, namespace: Optional[str] = None) -> bool:
+        # Checked with a set so adding many items doesn't rescan the list for each one
+        if namespace not in self._update_ids:
+            self._update_ids[namespace] = {item["id"] for item in self._update_partition(namespace)["items"]}
+        return id in self._update_ids[namespace]
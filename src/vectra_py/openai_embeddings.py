@@ -1,5 +1,4 @@
 import asyncio
-import requests
 from typing import List, Union, Dict
 
 
@@ -123,6 +122,8 @@ class OpenAIEmbeddings:
             if options.organization:
                 request_headers["OpenAI-Organization"] = options.organization
 
+        # Imported here so services that never embed don't pay for it at startup
+        import requests
         response = requests.post(url, json=body, **request_config)
 
         if response.status_code == 429 and isinstance(self.options.retry_policy, list) and retry_count < len(self.options.retry_policy):
@@ -1,5 +1,4 @@
 import asyncio
-import requests
 from typing import List, Union, Dict
 from all_MiniLM_L6_v2_tokenizer import OSSTokenizer
 
@@ -18,7 +17,7 @@ class OSSEmbeddingsOptions(BaseOSSEmbeddingsOptions):
         **kwargs
     ):
         super().__init__(**kwargs)
-        self.tokenizer = OSSTokenizer(model_name=model)
+        self.tokenizer = tokenizer or OSSTokenizer(model_name=model)
         self.model = model
 
 
@@ -55,6 +54,8 @@ class OSSEmbeddings:
     
     async def create_embeddings(self, inputs: Union[str, List[str]]) -> EmbeddingsResponse:
         # create embeddings from the local model
+        if isinstance(inputs, str):
+            inputs = [inputs]
         try:
             data = [self.options.tokenizer.encode(item) for item in inputs]
             return EmbeddingsResponse(
@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+from typing import Any, Dict, Iterable, List, Optional
+from local_index import CreateIndexConfig, LocalIndex
+from custom_types import IndexItem, IndexStats, MetadataFilter, QueryResult
+
+SHARDS_FILE = 'shards.json'
+
+# Shards opened by query worker processes, each reloaded only when it has new commits
+_worker_shards = {}
+
+
+def _query_shard(folder_path: str, index_name: str, shard_options: Dict[str, Any], vector: List[float],
+                 top_k: int, filter: Optional[MetadataFilter], namespace: Optional[str]) -> List[QueryResult]:
+    key = (folder_path, index_name)
+    shard = _worker_shards.get(key)
+    if shard is None:
+        shard = _worker_shards[key] = LocalIndex(folder_path, index_name, **shard_options)
+    return asyncio.run(shard.query_items(vector, top_k, filter, namespace))
+
+
+class ShardedLocalIndex:
+    """
+    A LocalIndex spread over several shards, each a LocalIndex in its own subfolder
+    (shard-000, shard-001, ...). Items are placed by a hash of their id, so inserts,
+    deletes and lookups touch a single shard while queries run on every shard at once
+    and merge the per-shard top_k results.
+
+    Queries run in threads by default. With query_processes set they run in a pool of
+    worker processes, each keeping its own copy of the shards it has queried, so
+    scoring isn't serialized by the GIL.
+
+    An update spans every shard and holds all their write locks, but each shard is
+    committed separately, so a crash during end_update can leave some shards updated.
+    """
+    def __init__(self,
+                 folder_path: str,
+                 shard_count: Optional[int] = None,
+                 index_name: Optional[str] = None,
+                 query_processes: Optional[int] = None,
+                 **shard_options):
+        self._folder_path = folder_path
+        self._index_name = index_name or "index.json"
+        # Read from shards.json when the index already exists
+        self._shard_count = shard_count
+        self._shard_options = shard_options
+        self._query_processes = query_processes
+        self._executor = None
+        self._shards = None
+        self._in_update = False
+
+    @property
+    def folder_path(self) -> str:
+        return self._folder_path
+
+    @property
+    def index_name(self) -> str:
+        return self._index_name
+
+    @property
+    def _options(self) -> Dict[str, Any]:
+        # A memory budget is for the whole index, so it's split between the shards
+        if self._shard_options.get("memory_budget") is None:
+            return self._shard_options
+        return {**self._shard_options, "memory_budget": self._shard_options["memory_budget"] // self._shard_count}
+
+    @property
+    def shards(self) -> List[LocalIndex]:
+        if self._shards is None:
+            if self._shard_count is None:
+                if not self.is_index_created():
+                    raise ValueError('Index does not exist')
+                with open(os.path.join(self._folder_path, SHARDS_FILE), 'r') as shards_file:
+                    self._shard_count = json.load(shards_file)["shards"]
+            self._shards = [
+                LocalIndex(os.path.join(self._folder_path, f'shard-{i:03d}'), self._index_name, **self._options)
+                for i in range(self._shard_count)
+            ]
+        return self._shards
+
+    def get_shard(self, id: str) -> LocalIndex:
+        # A stable hash, unlike hash(), so every process places an id on the same shard
+        digest = hashlib.blake2b(id.encode('utf-8'), digest_size=8).digest()
+        return self.shards[int.from_bytes(digest, 'little') % len(self.shards)]
+
+    async def begin_update(self) -> None:
+        if self._in_update:
+            raise ValueError('Update already in progress')
+        # Always locked in shard order so two writers can't deadlock
+        started = []
+        try:
+            for shard in self.shards:
+                await shard.begin_update()
+                started.append(shard)
+        except Exception:
+            for shard in started:
+                shard.cancel_update()
+            raise
+        self._in_update = True
+
+    def cancel_update(self) -> None:
+        for shard in self.shards:
+            shard.cancel_update()
+        self._in_update = False
+
+    async def end_update(self) -> None:
+        if not self._in_update:
+            raise ValueError('No update in progress')
+        try:
+            for shard in self.shards:
+                await shard.end_update()
+        finally:
+            self.cancel_update()
+
+    async def create_index(self, config: CreateIndexConfig = CreateIndexConfig(version=1)) -> None:
+        if self.is_index_created():
+            if config.delete_if_exists:
+                await self.delete_index()
+            else:
+                raise ValueError('Index already exists')
+        if not self._shard_count or self._shard_count < 1:
+            raise ValueError('shard_count is required to create a sharded index')
+
+        try:
+            os.mkdir(self._folder_path)
+            for shard in self.shards:
+                await shard.create_index(config)
+            # Written last, as its presence marks the index as created
+            with open(os.path.join(self._folder_path, SHARDS_FILE), 'w') as shards_file:
+                json.dump({"shards": self._shard_count}, shards_file)
+        except Exception:
+            await self.delete_index()
+            raise ValueError('Error creating index')
+
+    async def delete_index(self) -> None:
+        self._shards = None
+        try:
+            shutil.rmtree(self._folder_path)
+        except Exception as err:
+            print(err)
+
+    def is_index_created(self) -> bool:
+        return os.path.exists(os.path.join(self._folder_path, SHARDS_FILE))
+
+    async def load_index_data(self) -> None:
+        await asyncio.gather(*(shard.load_index_data() for shard in self.shards))
+
+    async def delete_item(self, id: str, namespace: Optional[str] = None) -> None:
+        await self.delete_items([id], namespace)
+
+    async def delete_items(self, ids: Iterable[str], namespace: Optional[str] = None) -> None:
+        if self._in_update:
+            self.remove_items_from_update(ids, namespace)
+            return
+        for shard, shard_ids in self._group_by_shard(ids).items():
+            await shard.delete_items(shard_ids, namespace)
+
+    def remove_items_from_update(self, ids: Iterable[str], namespace: Optional[str] = None) -> int:
+        return sum(shard.remove_items_from_update(shard_ids, namespace)
+                   for shard, shard_ids in self._group_by_shard(ids).items())
+
+    async def delete_namespace(self, namespace: str) -> None:
+        for shard in self.shards:
+            await shard.delete_namespace(namespace)
+
+    async def add_item_to_update(self,
+                                 item: Optional[Dict[str, Any]],
+                                 unique: bool,
+                                 namespace: Optional[str] = None) -> IndexItem:
+        # The id is assigned here rather than by the shard, as it decides the shard
+        item = {**item, "id": item.get("id") or str(uuid4())}
+        return await self.get_shard(item["id"]).add_item_to_update(item, unique, namespace)
+
+    async def insert_item(self, item: Optional[Dict[str, Any]] = None, namespace: Optional[str] = None) -> IndexItem:
+        if self._in_update:
+            return await self.add_item_to_update(item, True, namespace)
+        item = {**item, "id": item.get("id") or str(uuid4())}
+        return await self.get_shard(item["id"]).insert_item(item, namespace)
+
+    async def upsert_item(self, item: Optional[Dict[str, Any]] = None, namespace: Optional[str] = None) -> IndexItem:
+        if self._in_update:
+            return await self.add_item_to_update(item, False, namespace)
+        item = {**item, "id": item.get("id") or str(uuid4())}
+        return await self.get_shard(item["id"]).upsert_item(item, namespace)
+
+    async def get_item(self, id: str, namespace: Optional[str] = None) -> Optional[IndexItem]:
+        return await self.get_shard(id).get_item(id, namespace)
+
+    async def get_index_stats(self) -> IndexStats:
+        stats = await asyncio.gather(*(shard.get_index_stats() for shard in self.shards))
+        namespaces = {}
+        for shard_stats in stats:
+            for namespace, namespace_stats in shard_stats["namespaces"].items():
+                namespaces.setdefault(namespace, {"items": 0})["items"] += namespace_stats["items"]
+        return {
+            "version": stats[0]["version"],
+            "metadata_config": stats[0]["metadata_config"],
+            "items": sum(shard_stats["items"] for shard_stats in stats),
+            "namespaces": namespaces,
+            "shards": [shard_stats["items"] for shard_stats in stats]
+        }
+
+    async def list_namespaces(self) -> List[str]:
+        namespaces = await asyncio.gather(*(shard.list_namespaces() for shard in self.shards))
+        return list(dict.fromkeys(namespace for shard_namespaces in namespaces for namespace in shard_namespaces))
+
+    async def list_items(self, namespace: Optional[str] = None) -> List[IndexItem]:
+        items = await asyncio.gather(*(shard.list_items(namespace) for shard in self.shards))
+        return [item for shard_items in items for item in shard_items]
+
+    async def list_items_by_metadata(self, filter: MetadataFilter, namespace: Optional[str] = None) -> List[IndexItem]:
+        items = await asyncio.gather(*(shard.list_items_by_metadata(filter, namespace) for shard in self.shards))
+        return [item for shard_items in items for item in shard_items]
+
+    async def query_items(self,
+                          vector: List[float],
+                          top_k: int,
+                          filter: Optional[MetadataFilter] = None,
+                          namespace: Optional[str] = None) -> List[QueryResult]:
+        if self._query_processes:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self._query_processes)
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self._executor, _query_shard, shard.folder_path, shard.index_name,
+                                     self._options, vector, top_k, filter, namespace)
+                for shard in self.shards
+            ))
+        else:
+            await self.load_index_data()
+            results = await asyncio.gather(*(
+                asyncio.to_thread(shard.query_items_sync, vector, top_k, filter, namespace) for shard in self.shards
+            ))
+        return heapq.nlargest(top_k, (result for shard_results in results for result in shard_results),
+                              key=lambda result: result["score"])
+
+    def get_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the vector cache stats of the shards added together. Queries run in
+        worker processes aren't counted.
+        """
+        stats = [shard.get_cache_stats() for shard in self.shards]
+        if stats[0] is None:
+            return None
+        totals = {key: sum(shard_stats[key] for shard_stats in stats)
+                  for key in ("max_bytes", "bytes", "blocks", "hits", "misses", "bytes_read")}
+        lookups = totals["hits"] + totals["misses"]
+        # Every query scans every shard, so the shards' query counts are the same
+        queries = max(shard_stats["queries"] for shard_stats in stats)
+        return {
+            **totals,
+            "hit_rate": totals["hits"] / lookups if lookups else 0.0,
+            "queries": queries,
+            "bytes_read_per_query": totals["bytes_read"] / queries if queries else 0.0,
+            "last_query": {key: sum(shard_stats["last_query"][key] for shard_stats in stats)
+                           for key in ("hits", "misses", "bytes_read")},
+        }
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _group_by_shard(self, ids: Iterable[str]) -> Dict[LocalIndex, List[str]]:
+        groups = {}
+        for id in ids:
+            groups.setdefault(self.get_shard(id), []).append(id)
+        return groups
@@ -1,10 +1,18 @@
-from typing import List, Optional
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Iterable, Iterator, List, Optional, Sequence, Union
 
 from custom_types import Tokenizer
 from gpt3_tokenizer import GPT3Tokenizer
-from all_MiniLM_L6_v2_tokenizer import OSSTokenizer
 
 ALPHANUMERIC_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+ALPHANUMERIC_PATTERN = re.compile(f'[{ALPHANUMERIC_CHARS}]')
+STREAM_BLOCK_SIZE = 1 << 16
+
+# Splitter owned by each split_batch worker process
+_worker_splitter = None
 
 
 class TextSplitterConfig:
@@ -41,6 +49,81 @@ class TextChunk:
         self.end_overlap = end_overlap
 
 
+class TokenOffsets:
+    """
+    The tokens of a whole document along with the character offset each token starts
+    at, so the tokens of any span can be sliced out instead of re-encoding the span.
+    Spans are given as positions in the document, which starts at text_start.
+    """
+    def __init__(self, tokens: List[int], offsets: List[int], text: str, tokenizer: Tokenizer, text_start: int = 0):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.text = text
+        self.tokenizer = tokenizer
+        self.text_start = text_start
+        # The same boundaries are sliced at each level and as chunks are combined
+        self._fragments = {}
+
+    def slice(self, start_pos: int, end_pos: int) -> List[int]:
+        """
+        Returns the tokens of the span [start_pos, end_pos). Tokens inside the span are sliced
+        out and only the part of a token straddling either end is encoded again. That
+        happens at most chunk boundaries, as tokenizers like tiktoken's start a word's
+        token on the space before it. Whitespace ending the span is encoded again too, as
+        it's split differently without the text that followed it.
+
+        Byte-level tokenizers can split a multibyte character over several tokens, which
+        all start at the character's offset. They're kept or encoded again together.
+        """
+        start_pos -= self.text_start
+        end_pos -= self.text_start
+        first = self._group_start(max(0, bisect_right(self.offsets, start_pos) - 1))
+        last = bisect_left(self.offsets, end_pos, first)
+        if first >= last:
+            return []
+        head = first
+        if self.offsets[first] < start_pos or self._starts_inside_char(first):
+            head = self._group_end(first)
+        while head < last and self._starts_inside_char(head):
+            head = self._group_end(head)
+        tail = last
+        if self._token_end(last - 1) > end_pos or self._starts_inside_char(last) or self._is_space(last - 1):
+            tail = self._group_start(last - 1)
+            while tail > first and (self._is_space(tail - 1) or self._starts_inside_char(tail)):
+                tail = self._group_start(tail - 1)
+        if tail < head:
+            return self._encode(start_pos, end_pos)
+        tokens = self.tokens[head:tail]
+        if head > first:
+            tokens[:0] = self._encode(start_pos, self.offsets[head] if head < len(self.offsets) else len(self.text))
+        if tail < last:
+            tokens.extend(self._encode(self.offsets[tail], end_pos))
+        return tokens
+
+    def _group_start(self, i: int) -> int:
+        return bisect_left(self.offsets, self.offsets[i])
+
+    def _group_end(self, i: int) -> int:
+        return bisect_right(self.offsets, self.offsets[i], i)
+
+    def _token_end(self, i: int) -> int:
+        end = self._group_end(i)
+        return self.offsets[end] if end < len(self.offsets) else len(self.text)
+
+    def _is_space(self, i: int) -> bool:
+        return self.text[self.offsets[i]:self._token_end(i)].isspace()
+
+    def _starts_inside_char(self, i: int) -> bool:
+        # A token starting with part of a character decodes to a replacement character
+        return 0 < i < len(self.tokens) and self.tokenizer.decode([self.tokens[i]]).startswith('\ufffd')
+
+    def _encode(self, start_pos: int, end_pos: int) -> List[int]:
+        tokens = self._fragments.get((start_pos, end_pos))
+        if tokens is None:
+            tokens = self._fragments[(start_pos, end_pos)] = self.tokenizer.encode(self.text[start_pos:end_pos])
+        return tokens
+
+
 class TextSplitter:
     def __init__(self, config: Optional[TextSplitterConfig] = None):
         if config is None:
@@ -55,7 +138,7 @@ class TextSplitter:
         # Create a default tokenizer if none is provided
         if not self.config.get('tokenizer'):
             print('tokenizer not found. defaulting to GPT3.')
-            self.config.tokenizer = GPT3Tokenizer()
+            self.config['tokenizer'] = GPT3Tokenizer()
 
         # Use default separators if none are provided
         if not self.config.get('separators') or len(self.config.get('separators')) == 0:
@@ -71,8 +154,94 @@ class TextSplitter:
 
     def split(self, text: str) -> List[TextChunk]:
         # Get basic chunks
-        chunks = self.recursive_split(text, self.config.get('separators'), 0)
+        chunks = self._split_segment(text, 0)
+
+        # Add overlap tokens and text to the start and end of each chunk
+        if self.config.get('chunk_overlap') > 0:
+            for i in range(1, len(chunks)):
+                next_chunk = chunks[i + 1] if i < len(chunks) - 1 else None
+                self.add_overlap(chunks[i - 1], chunks[i], next_chunk)
+
+        return chunks
+
+    def split_batch(self, texts: Sequence[str], max_workers: Optional[int] = None) -> List[List[TextChunk]]:
+        """
+        Splits many documents across a process pool. Each worker gets a pickled copy of
+        the tokenizer and sends its chunks back packed into arrays to keep pickling cheap.
+        The result is identical to calling split on each text in turn.
+        """
+        if max_workers == 1 or len(texts) <= 1:
+            return [self.split(text) for text in texts]
+
+        # The tokenizers pickle their settings only, so workers load their own model
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_split_worker,
+                                 initargs=(dict(self.config),)) as pool:
+            packed_results = list(pool.map(_split_packed, texts))
+
+        results = []
+        for packed in packed_results:
+            chunks = _unpack_chunks(packed)
+            if self.config.get('chunk_overlap') > 0:
+                for i in range(1, len(chunks)):
+                    self.add_overlap(chunks[i - 1], chunks[i], chunks[i + 1] if i < len(chunks) - 1 else None)
+            results.append(chunks)
+        return results
+
+    def split_stream(self, blocks: Union[str, IO[str], Iterable[str]]) -> Iterator[TextChunk]:
+        """
+        Splits text arriving as an iterable of text blocks or a file handle, yielding chunks
+        with positions relative to the start of the whole stream. Only a window of a few
+        chunk sizes is buffered, so memory use doesn't depend on the document size.
+        """
+        if isinstance(blocks, str):
+            blocks = [blocks]
+        elif hasattr(blocks, 'read'):
+            file = blocks
+            blocks = iter(lambda: file.read(STREAM_BLOCK_SIZE), '')
+
+        window = self.config.get('stream_window') or self.config.get('chunk_size') * 48
+        separators = self.config.get('separators')
+        buffer = ''
+        buffer_start = 0
+        pending = []
 
+        def segments():
+            nonlocal buffer, buffer_start
+            for block in blocks:
+                buffer += block
+                while len(buffer) >= 2 * window:
+                    # Cut after the highest priority separator in the back half of the window
+                    cut = window
+                    for separator in separators:
+                        pos = buffer.rfind(separator, window, 2 * window)
+                        if pos >= 0:
+                            cut = pos + len(separator)
+                            break
+                    yield buffer[:cut], buffer_start
+                    buffer = buffer[cut:]
+                    buffer_start += cut
+            if buffer:
+                yield buffer, buffer_start
+
+        # Chunks are combined across segment boundaries and held back until the
+        # next chunk is known so overlaps can be added
+        previous = None
+        for segment, segment_start in segments():
+            pending = self.combine_chunks(pending + self._split_segment(segment, segment_start))
+            while len(pending) > 2:
+                chunk = pending.pop(0)
+                if self.config.get('chunk_overlap') > 0 and previous is not None:
+                    self.add_overlap(previous, chunk, pending[0])
+                yield chunk
+                previous = chunk
+        for i, chunk in enumerate(pending):
+            if self.config.get('chunk_overlap') > 0 and previous is not None:
+                self.add_overlap(previous, chunk, pending[i + 1] if i < len(pending) - 1 else None)
+            yield chunk
+            previous = chunk
+
+    def add_overlap(self, previous_chunk: TextChunk, chunk: TextChunk, next_chunk: Optional[TextChunk]) -> None:
         def get_overlap_tokens(tokens: Optional[List[int]] = None) -> List[int]:
             if tokens is not None:
                 length = min(len(tokens), self.config.get('chunk_overlap'))
@@ -80,23 +249,31 @@ class TextSplitter:
             else:
                 return []
 
-        # Add overlap tokens and text to the start and end of each chunk
-        if self.config.get('chunk_overlap') > 0:
-            for i in range(1, len(chunks)):
-                previous_chunk = chunks[i - 1]
-                chunk = chunks[i]
-                next_chunk = chunks[i + 1] if i < len(chunks) - 1 else None
-                chunk.start_overlap = get_overlap_tokens(previous_chunk.tokens[::-1])[::-1]
-                chunk.end_overlap = get_overlap_tokens(next_chunk.tokens) if next_chunk else []
+        chunk.start_overlap = get_overlap_tokens(previous_chunk.tokens[::-1])[::-1]
+        chunk.end_overlap = get_overlap_tokens(next_chunk.tokens) if next_chunk else []
 
-        return chunks
+    def _split_segment(self, text: str, start_pos: int) -> List[TextChunk]:
+        tokenizer = self.config.get('tokenizer')
+        token_offsets = None
+        # Chunks are only slices of the text when separators are kept, otherwise they're
+        # joined with spaces and have to be encoded part by part
+        if (self.config.get('tokenize_once') and self.config.get('keep_separators')
+                and hasattr(tokenizer, 'encode_with_offsets')):
+            # Encode the text once and slice each chunk's tokens by character offset
+            token_offsets = TokenOffsets(*tokenizer.encode_with_offsets(text), text, tokenizer, start_pos)
+        return self.recursive_split(text, self.config.get('separators'), start_pos, token_offsets)
 
-    def recursive_split(self, text: str, separators: List[str], start_pos: int) -> List[TextChunk]:
+    def recursive_split(self,
+                        text: str,
+                        separators: List[str],
+                        start_pos: int,
+                        token_offsets: Optional[TokenOffsets] = None) -> List[TextChunk]:
         chunks = []
         if len(text) > 0:
             # Split text into parts
             parts = []
             separator = ''
+            separators = self._skip_absent_separators(text, separators)
             next_separators = separators[1:] if len(separators) > 1 else []
             if separators:
                 # Split by separator
@@ -107,7 +284,8 @@ class TextSplitter:
                 half = len(text) // 2
                 parts = [text[:half], text[half:]]
 
-            # Iterate over parts
+            # Collect the parts containing text with their positions
+            kept_parts = []
             for i in range(len(parts)):
                 last_chunk = i == len(parts) - 1
                 # Get chunk text and end_pos
@@ -117,37 +295,50 @@ class TextSplitter:
                     chunk += separator
 
                 # Ensure chunk contains text
-                if not self.contains_alphanumeric(chunk):
-                    continue
+                if self.contains_alphanumeric(chunk):
+                    # Optimization to avoid encoding really large chunks
+                    oversized = len(chunk) / 6 > self.config.get('chunk_size')
+                    kept_parts.append((chunk, start_pos, end_pos, oversized))
 
-                # Optimization to avoid encoding really large chunks
-                if len(chunk) / 6 > self.config.get('chunk_size'):
-                    # Break the text into smaller chunks
-                    sub_chunks = self.recursive_split(chunk, next_separators, start_pos)
-                    chunks.extend(sub_chunks)
-                else:
-                    # Encode chunk text
-                    tokens = self.config.get('tokenizer').encode(chunk)
-                    if len(tokens) > self.config.get('chunk_size'):
-                        # Break the text into smaller chunks
-                        sub_chunks = self.recursive_split(chunk, next_separators, start_pos)
-                        chunks.extend(sub_chunks)
-                    else:
-                        # Append chunk to output
-                        chunks.append(TextChunk(
-                            text=chunk,
-                            tokens=tokens,
-                            start_pos=start_pos,
-                            end_pos=end_pos,
-                            start_overlap=[],
-                            end_overlap=[],
-                        ))
                 # Update start_pos
                 start_pos = end_pos + 1
 
-        return self.combine_chunks(chunks)
+            # Encode every part of this level in one batch
+            if token_offsets:
+                part_tokens = [None if oversized else token_offsets.slice(part_start, part_start + len(chunk))
+                               for chunk, part_start, _, oversized in kept_parts]
+            else:
+                part_tokens = self._encode_parts(kept_parts)
 
-    def combine_chunks(self, chunks: List[TextChunk]) -> List[TextChunk]:
+            for (chunk, part_start, end_pos, oversized), tokens in zip(kept_parts, part_tokens):
+                if oversized or len(tokens) > self.config.get('chunk_size'):
+                    # Break the text into smaller chunks
+                    chunks.extend(self.recursive_split(chunk, next_separators, part_start, token_offsets))
+                else:
+                    # Append chunk to output
+                    chunks.append(TextChunk(
+                        text=chunk,
+                        tokens=tokens,
+                        start_pos=part_start,
+                        end_pos=end_pos,
+                        start_overlap=[],
+                        end_overlap=[],
+                    ))
+
+        return self.combine_chunks(chunks, token_offsets)
+
+    def _encode_parts(self, parts) -> List[Optional[List[int]]]:
+        tokenizer = self.config.get('tokenizer')
+        texts = [chunk for chunk, _, _, oversized in parts if not oversized]
+        if len(texts) > 1 and hasattr(tokenizer, 'encode_batch'):
+            encoded = iter(tokenizer.encode_batch(texts))
+        else:
+            encoded = iter([tokenizer.encode(part_text) for part_text in texts])
+        return [None if oversized else next(encoded) for _, _, _, oversized in parts]
+
+    def combine_chunks(self,
+                       chunks: List[TextChunk],
+                       token_offsets: Optional[TokenOffsets] = None) -> List[TextChunk]:
         combined_chunks = []
         current_chunk = None
         current_length = 0
@@ -155,15 +346,29 @@ class TextSplitter:
         for i in range(len(chunks)):
             chunk = chunks[i]
             if current_chunk:
-                length = len(current_chunk.tokens) + len(chunk.tokens)
+                if token_offsets is None:
+                    tokens = None
+                elif len(current_chunk.text) + len(chunk.text) == chunk.end_pos - current_chunk.start_pos + 1:
+                    # The combined chunk is one span of the text, so its tokens are sliced
+                    # again rather than concatenated, as a token can straddle the two
+                    tokens = token_offsets.slice(current_chunk.start_pos, chunk.end_pos + 1)
+                else:
+                    # Text-less parts were skipped within or between the chunks, so they
+                    # join into text that isn't in the document
+                    tokens = self.config.get('tokenizer').encode(current_chunk.text + chunk.text)
+                length = len(tokens) if tokens is not None else len(current_chunk.tokens) + len(chunk.tokens)
                 if length > self.config.get('chunk_size'):
                     combined_chunks.append(current_chunk)
                     current_chunk = chunk
                     current_length = len(chunk.tokens)
                 else:
                     current_chunk.text += separator + chunk.text
-                    current_chunk.tokens.extend(chunk.tokens)
-                    current_length += len(chunk.tokens)
+                    if tokens is not None:
+                        current_chunk.tokens = tokens
+                    else:
+                        current_chunk.tokens.extend(chunk.tokens)
+                    current_chunk.end_pos = chunk.end_pos
+                    current_length = length
             else:
                 current_chunk = chunk
                 current_length = len(chunk.tokens)
@@ -174,7 +379,16 @@ class TextSplitter:
         return combined_chunks
 
     def contains_alphanumeric(self, text: str) -> bool:
-        return any(char in ALPHANUMERIC_CHARS for char in text)
+        return ALPHANUMERIC_PATTERN.search(text) is not None
+
+    def _skip_absent_separators(self, text: str, separators: List[str]) -> List[str]:
+        # A text too large to encode is passed down whole by the level of each separator
+        # it doesn't contain, so those levels are skipped. Smaller texts are encoded at
+        # each level in case they fit, so they go through every level.
+        if len(text) / 6 > self.config.get('chunk_size'):
+            while separators and separators[0] not in text:
+                separators = separators[1:]
+        return separators
 
     def get_separators(self, doc_type: str = "") -> List[str]:
         separators = {
@@ -665,3 +879,40 @@ class TextSplitter:
         }
 
         return separators.get(doc_type, ["\n\n", "\n", " "])
+
+
+def _init_split_worker(config) -> None:
+    global _worker_splitter
+    _worker_splitter = TextSplitter(config)
+
+
+def _split_packed(text: str):
+    # Overlaps are derived from the tokens, so the parent adds them after unpacking
+    chunks = _worker_splitter._split_segment(text, 0)
+    return (
+        ''.join(chunk.text for chunk in chunks),
+        array('q', (len(chunk.text) for chunk in chunks)),
+        array('i', (token for chunk in chunks for token in chunk.tokens)),
+        array('q', (len(chunk.tokens) for chunk in chunks)),
+        array('q', (chunk.start_pos for chunk in chunks)),
+        array('q', (chunk.end_pos for chunk in chunks)),
+    )
+
+
+def _unpack_chunks(packed) -> List[TextChunk]:
+    text, text_lengths, tokens, token_counts, start_positions, end_positions = packed
+    chunks = []
+    text_offset = 0
+    token_offset = 0
+    for i in range(len(text_lengths)):
+        chunks.append(TextChunk(
+            text=text[text_offset:text_offset + text_lengths[i]],
+            tokens=tokens[token_offset:token_offset + token_counts[i]].tolist(),
+            start_pos=start_positions[i],
+            end_pos=end_positions[i],
+            start_overlap=[],
+            end_overlap=[],
+        ))
+        text_offset += text_lengths[i]
+        token_offset += token_counts[i]
+    return chunks
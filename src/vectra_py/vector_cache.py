@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable
+
+# Vectors are read from disk and cached in blocks of about this many bytes
+VECTOR_BLOCK_BYTES = 1 << 20
+
+
+class VectorCache:
+    """
+    A memory bounded cache of vector blocks, shared by the lazily loaded index files of
+    a LocalIndex. Blocks are evicted least recently used first, but a block read during
+    a scan only displaces cached blocks when queries have recently returned more items
+    from it than from them. That way a scan of an index larger than the budget doesn't
+    flush the hot blocks, and the cache fills up with the blocks queries keep hitting.
+
+    Result counts are halved every decay_interval queries so the hot set follows
+    recent traffic.
+    """
+    def __init__(self, max_bytes: int, decay_interval: int = 100):
+        self.max_bytes = max_bytes
+        self.decay_interval = decay_interval
+        self._blocks = OrderedDict()  # key -> (block, size), least recently used first
+        self._frequencies = {}  # key -> recent query results in the block
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._bytes_read = 0
+        self._queries = 0
+        self._last_query = new_query_stats()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is None:
+                return None
+            self._blocks.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, block: Any, size: int) -> bool:
+        """
+        Caches a block read from disk if it fits in the budget or is hotter than the
+        blocks it would evict. Returns whether it was cached.
+        """
+        with self._lock:
+            if key in self._blocks or size > self.max_bytes:
+                return False
+            frequency = self._frequencies.get(key, 0)
+            victims = []
+            free = self.max_bytes - self._bytes
+            # The least recently used blocks that are colder than the new one make room
+            for victim_key, (_, victim_size) in self._blocks.items():
+                if free >= size:
+                    break
+                if self._frequencies.get(victim_key, 0) < frequency:
+                    victims.append(victim_key)
+                    free += victim_size
+            if free < size:
+                return False
+            for victim_key in victims:
+                self._bytes -= self._blocks.pop(victim_key)[1]
+            self._blocks[key] = (block, size)
+            self._bytes += size
+            return True
+
+    def record_query(self, stats: Dict[str, int], result_keys: Iterable[Hashable]) -> None:
+        """
+        Adds a finished query's hits, misses and bytes read to the totals, and counts
+        the blocks its results came from.
+        """
+        with self._lock:
+            self._hits += stats["hits"]
+            self._misses += stats["misses"]
+            self._bytes_read += stats["bytes_read"]
+            self._queries += 1
+            self._last_query = dict(stats)
+            for key in result_keys:
+                self._frequencies[key] = self._frequencies.get(key, 0) + 1
+            if self._queries % self.decay_interval == 0:
+                self._frequencies = {key: count // 2 for key, count in self._frequencies.items() if count > 1}
+
+    def discard(self, token: Hashable) -> None:
+        """
+        Drops the blocks and counts of a file that's no longer used. Keys are
+        (token, block number) pairs.
+        """
+        with self._lock:
+            for key in [key for key in self._blocks if key[0] == token]:
+                self._bytes -= self._blocks.pop(key)[1]
+            self._frequencies = {key: count for key, count in self._frequencies.items() if key[0] != token}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "max_bytes": self.max_bytes,
+                "bytes": self._bytes,
+                "blocks": len(self._blocks),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "bytes_read": self._bytes_read,
+                "queries": self._queries,
+                "bytes_read_per_query": self._bytes_read / self._queries if self._queries else 0.0,
+                "last_query": dict(self._last_query),
+            }
+
+
+def new_query_stats() -> Dict[str, int]:
+    return {"hits": 0, "misses": 0, "bytes_read": 0}
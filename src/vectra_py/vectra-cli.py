@@ -1,10 +1,12 @@
 import argparse
+import asyncio
 import json
 import os
 
-from local_document_index import LocalDocumentIndex
+from local_index import CreateIndexConfig
+from local_document_index import LocalDocumentIndex, LocalDocumentIndexConfig, DocumentQueryOptions
 from web_fetcher import WebFetcher
-from openai_embeddings import OpenAIEmbeddings
+from openai_embeddings import OpenAIEmbeddings, OpenAIEmbeddingsOptions
 from file_fetcher import FileFetcher
 
 
@@ -47,37 +49,32 @@ async def run():
     query_parser.add_argument("--chunk-count", "-cc", type=int, default=50, help="Max number of chunks to return")
     query_parser.add_argument("--section-count", "-sc", type=int, default=1, help="Max number of document sections to render")
     query_parser.add_argument("--tokens", "-t", type=int, default=2000, help="Max number of tokens to render for each section")
+    query_parser.add_argument("--total-tokens", "-tt", type=int, default=None, help="Max number of tokens to render across all documents")
     query_parser.add_argument("--format", "-f", type=str, default="sections", choices=["sections", "stats", "chunks"], help="Format of the rendered results")
 
     args = parser.parse_args()
 
     if args.command == "create":
         folder_path = args.index
-        index = LocalDocumentIndex(folder_path)
+        index = open_index(folder_path)
         print(f"Creating index at {folder_path}")
-        await index.create_index(version=1, delete_if_exists=True)
+        await index.create_index(CreateIndexConfig(version=1, delete_if_exists=True))
 
     elif args.command == "delete":
         folder_path = args.index
         print(f"Deleting index at {folder_path}")
-        index = LocalDocumentIndex(folder_path)
+        index = open_index(folder_path)
         await index.delete_index()
 
     elif args.command == "add":
         print("Adding Web Pages to Index")
 
         # Create embeddings
-        with open(args.keys, "r", encoding="utf-8") as keys_file:
-            keys = json.load(keys_file)
-        embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", **keys)
+        embeddings = create_embeddings(args.keys)
 
         # Initialize index
         folder_path = args.index
-        index = LocalDocumentIndex(
-            folder_path=folder_path,
-            embeddings=embeddings,
-            chunking_config={"chunk_size": args.chunk_size},
-        )
+        index = open_index(folder_path, embeddings, chunking_config={"chunk_size": args.chunk_size})
 
         # Get list of URIs
         uris = get_item_list(args.uri, args.list, "web page")
@@ -85,17 +82,25 @@ async def run():
         # Fetch web pages
         file_fetcher = FileFetcher()
         web_fetcher = WebFetcher()
-        for uri in uris:
-            try:
-                print(f"Fetching {uri}")
-                fetcher = web_fetcher if uri.startswith("http") else file_fetcher
-                await fetcher.fetch(uri, index_upsert_document(index))
-            except Exception as err:
-                print(f"Error adding: {uri}\n{str(err)}")
+        try:
+            for uri in uris:
+                try:
+                    print(f"Fetching {uri}")
+                    upsert_document = index_upsert_document(index)
+                    if uri.startswith("http"):
+                        await upsert_document(uri, web_fetcher.fetch(uri), "html")
+                    else:
+                        async for file_uri, text, doc_type in file_fetcher.fetch(uri):
+                            # Large files are streamed as blocks rather than read whole
+                            await upsert_document(file_uri, text, doc_type)
+                except Exception as err:
+                    print(f"Error adding: {uri}\n{str(err)}")
+        finally:
+            web_fetcher.close()
 
     elif args.command == "remove":
         folder_path = args.index
-        index = LocalDocumentIndex(folder_path)
+        index = open_index(folder_path)
 
         # Get list of URIs
         uris = get_item_list(args.uri, args.list, "document")
@@ -107,7 +112,8 @@ async def run():
 
     elif args.command == "stats":
         folder_path = args.index
-        index = LocalDocumentIndex(folder_path)
+        # Stats only need the header and id table of a columnar index, other files are read in full
+        index = open_index(folder_path, lazy=True)
         stats = await index.get_catalog_stats()
         print("Index Stats")
         print(stats)
@@ -116,44 +122,56 @@ async def run():
         print("Querying Index")
 
         # Create embeddings
-        with open(args.keys, "r", encoding="utf-8") as keys_file:
-            keys = json.load(keys_file)
-        embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", **keys)
+        embeddings = create_embeddings(args.keys)
 
         # Initialize index
         folder_path = args.index
-        index = LocalDocumentIndex(folder_path=folder_path, embeddings=embeddings)
+        index = open_index(folder_path, embeddings)
 
         # Query index
         query = args.query
         results = await index.query_documents(
             query,
-            max_documents=args.document_count,
-            max_chunks=args.chunk_count,
+            DocumentQueryOptions(max_documents=args.document_count, max_chunks=args.chunk_count),
         )
 
         # Render results
-        for result in results:
+        if args.format == "sections":
+            rendered = await index.render_documents(results, args.tokens, args.section_count, args.total_tokens)
+        for j, result in enumerate(results):
             print(result.uri)
             print("score:", result.score)
             print("chunks:", len(result.chunks))
             if args.format == "sections":
-                sections = await result.render_sections(args.tokens, args.section_count)
-                for i, section in enumerate(sections):
+                for i, section in enumerate(rendered[j]):
                     print(f"Section {i + 1}" if args.section_count > 1 else "Section")
-                    print("score:", section.score)
-                    print("tokens:", section.token_count)
-                    print(section.text)
+                    print("score:", section["score"])
+                    print("tokens:", section["token_count"])
+                    print(section["text"])
             elif args.format == "chunks":
-                text = await result.load_text()
                 for i, chunk in enumerate(result.chunks):
-                    start_pos = chunk.item.metadata["startPos"]
-                    end_pos = chunk.item.metadata["endPos"]
+                    start_pos = chunk["item"]["metadata"]["start_pos"]
+                    end_pos = chunk["item"]["metadata"]["end_pos"]
                     print(f"Chunk {i + 1}")
-                    print("score:", chunk.score)
-                    print("startPos:", start_pos)
-                    print("endPos:", end_pos)
-                    print(text[start_pos:end_pos + 1])
+                    print("score:", chunk["score"])
+                    print("start_pos:", start_pos)
+                    print("end_pos:", end_pos)
+                    print(await result.load_text_range(start_pos, end_pos + 1))
+
+
+def open_index(folder_path, embeddings=None, chunking_config=None, lazy=False):
+    # The tokenizer is created lazily by the index when it's first needed
+    return LocalDocumentIndex(LocalDocumentIndexConfig(folder_path=folder_path,
+                                                       tokenizer=None,
+                                                       embeddings=embeddings,
+                                                       chunking_config=chunking_config,
+                                                       lazy=lazy))
+
+
+def create_embeddings(keys_path):
+    with open(keys_path, "r", encoding="utf-8") as keys_file:
+        keys = json.load(keys_file)
+    return OpenAIEmbeddings(OpenAIEmbeddingsOptions(model="text-embedding-ada-002", **keys))
 
 
 def get_item_list(items, list_file, item_type):
@@ -170,11 +188,14 @@ def get_item_list(items, list_file, item_type):
 def index_upsert_document(index):
     async def upsert_document(uri, text, doc_type):
         print(f"Indexing {uri}")
-        await index.upsert_document(uri, text, doc_type)
+        if isinstance(text, str):
+            await index.upsert_document(uri, text, doc_type)
+        else:
+            await index.upsert_document_stream(uri, text, doc_type)
         print(f"Added {uri}")
         return True
 
     return upsert_document
 
 if __name__ == "__main__":
-    run()
+    asyncio.run(run())
@@ -13,9 +13,7 @@ from oss_embeddings import OSSEmbeddings, OSSEmbeddingsOptions
 from openai_embeddings import OpenAIEmbeddings, OpenAIEmbeddingsOptions
 from local_index import LocalIndex, CreateIndexConfig
 from local_document_index import LocalDocumentIndex, LocalDocumentIndexConfig
-# from local_index import CreateIndexConfig
-from file_fetcher import FileFetcher
-from web_fetcher import WebFetcher
+from ingest_pipeline import IngestPipeline, IngestPipelineConfig
 
 # test defaults
 keys_file = "vectra.keys"
@@ -86,20 +84,14 @@ async def add_docs_to_index(uri: str = None, list_file: str = None, item_type: s
     uris = get_item_list(uri, list_file, item_type)
     print('uris', uris)
 
-    # Fetch web pages
-    file_fetcher = FileFetcher()
-    web_fetcher = WebFetcher()
-    for uri in uris:
-        try:
-            url = uri.url if isinstance(uri, Filing) else uri
-            print(f"Fetching {url}")
-            fetcher = web_fetcher if url.startswith("http") else file_fetcher
-            fetched_doc = fetcher.fetch(url)
-            await index.upsert_document(url,
-                                        fetched_doc,
-                                        doc_type=item_type)
-        except Exception as err:
-            print(f"Error adding: {uri}\n{str(err)}")
+    # Fetch, split, embed and write the docs as a stream, committing in groups
+    pipeline_config = IngestPipelineConfig(doc_type=item_type,
+                                           commit_every=32,
+                                           on_progress=print)
+    pipeline = IngestPipeline(index, pipeline_config)
+    progress = await pipeline.run(uri.url if isinstance(uri, Filing) else uri for uri in uris)
+    for failed_uri, err in progress.errors:
+        print(f"Error adding: {failed_uri}\n{err}")
 
 
 async def main():
@@ -1,9 +1,11 @@
-import requests
-from typing import Callable
-from urllib.parse import urlparse
-
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+import asyncio
+import hashlib
+import json
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Tuple
+from urllib.parse import urljoin, urlparse
 
 ALLOWED_CONTENT_TYPES = [
     "text/html",
@@ -29,52 +31,245 @@ DEFAULT_HEADERS = {
 }
 
 
+class HttpCache:
+    """
+    On-disk cache of the ETag and Last-Modified validators returned for each URL,
+    used to send conditional requests when a site is crawled again. Entries can be
+    scoped, e.g. by the index a page is written to, so a page indexed into one index
+    isn't skipped as unchanged when crawled for another.
+    """
+    def __init__(self, folder_path: str):
+        self._folder_path = folder_path
+        os.makedirs(folder_path, exist_ok=True)
+
+    @property
+    def folder_path(self) -> str:
+        return self._folder_path
+
+    def get(self, uri: str, scope: Optional[str] = None) -> Optional[Dict[str, str]]:
+        try:
+            with open(self._entry_path(uri, scope), 'r', encoding='utf-8') as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, uri: str, etag: Optional[str], last_modified: Optional[str], scope: Optional[str] = None) -> None:
+        if not etag and not last_modified:
+            self.invalidate(uri, scope)
+            return
+        entry_path = self._entry_path(uri, scope)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as entry_file:
+            json.dump({"uri": uri, "scope": scope, "etag": etag, "last_modified": last_modified}, entry_file)
+        os.replace(temp_path, entry_path)
+
+    def invalidate(self, uri: str, scope: Optional[str] = None) -> None:
+        try:
+            os.unlink(self._entry_path(uri, scope))
+        except FileNotFoundError:
+            pass
+
+    def _entry_path(self, uri: str, scope: Optional[str] = None) -> str:
+        key = uri if scope is None else f"{scope}\n{uri}"
+        return os.path.join(self._folder_path, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+
 class WebFetcher:
     def __init__(self, config=None):
         self._config = {
             "htmlToMarkdown": True,
             "summarizeHtml": False,
+            "maxConcurrency": 16,
+            "maxPerHost": 4,
+            "cacheFolder": None,
+            "fastHtmlToMarkdown": False,
+            "convertInProcessPool": False,
+            "maxConvertWorkers": None,
         }
         if config:
             self._config.update(config)
+        self._cache = HttpCache(self._config["cacheFolder"]) if self._config["cacheFolder"] else None
+        self._sessions = {}
+        # Semaphores are bound to the event loop they're first used on, so each loop
+        # gets its own per-host limits
+        self._host_limits = weakref.WeakKeyDictionary()  # loop -> host -> semaphore
+        self._executor = None
+        self._convert_executor = None
+
+    @property
+    def cache(self) -> Optional[HttpCache]:
+        return self._cache
 
     def fetch(self, uri: str) -> str:
+        response = self._get(uri, self._get_headers(uri))
+        text, doc_type = self._process_response(response)
+        if doc_type == "html" and self._config["htmlToMarkdown"]:
+            return self.html_to_markdown(text, uri, self._config["fastHtmlToMarkdown"])
+        return text
+
+    async def fetch_async(self, uri: str) -> Optional[Tuple[str, str, Optional[str]]]:
+        """
+        Fetches a page without blocking the event loop and returns (uri, text, doc_type).
+        Returns None when the cache is enabled and the site reports the page as unchanged.
+        """
+        result = await self.fetch_with_validators_async(uri)
+        if result is None:
+            return None
+        uri, text, doc_type, validators = result
+        if self._cache:
+            self._cache.set(uri, validators["etag"], validators["last_modified"])
+        return uri, text, doc_type
+
+    async def fetch_with_validators_async(self,
+                                          uri: str,
+                                          cache_scope: Optional[str] = None
+                                          ) -> Optional[Tuple[str, str, Optional[str], Dict[str, Optional[str]]]]:
+        """
+        Like fetch_async but leaves the cache alone, returning the response's validators
+        as a fourth element ({"etag", "last_modified"}) for the caller to save once the
+        page has been processed. The validators cached under cache_scope are sent.
+        """
+        headers = self._get_headers(uri)
+        entry = self._cache.get(uri, cache_scope) if self._cache else None
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        loop = asyncio.get_running_loop()
+        host_limits = self._host_limits.setdefault(loop, {})
+        host = urlparse(uri).hostname
+        if host not in host_limits:
+            host_limits[host] = asyncio.Semaphore(self._config["maxPerHost"])
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._config["maxConcurrency"])
+
+        async with host_limits[host]:
+            response = await loop.run_in_executor(self._executor, self._get, uri, headers)
+        if response.status_code == 304:
+            return None
+
+        text, doc_type = await loop.run_in_executor(self._executor, self._process_response, response)
+        if doc_type == "html" and self._config["htmlToMarkdown"]:
+            # Conversion is CPU bound, so optionally run it in a process pool to keep
+            # it from holding up the fetch threads
+            if self._config["convertInProcessPool"] and self._convert_executor is None:
+                self._convert_executor = ProcessPoolExecutor(max_workers=self._config["maxConvertWorkers"])
+            text = await loop.run_in_executor(self._convert_executor or self._executor,
+                                              WebFetcher.html_to_markdown,
+                                              text, uri, self._config["fastHtmlToMarkdown"])
+            doc_type = "md"
+        validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        return uri, text, doc_type, validators
+
+    async def fetch_many(self,
+                         uris: Iterable[str],
+                         on_error: Optional[Callable[[str, Exception], None]] = None
+                         ) -> AsyncIterator[Tuple[str, str, Optional[str]]]:
+        """
+        Fetches many pages concurrently, yielding (uri, text, doc_type) as each completes.
+        Unchanged pages are skipped and failures are passed to on_error.
+        """
+        uris = iter(uris)
+        results = asyncio.Queue(maxsize=self._config["maxConcurrency"] * 2)
+
+        async def worker():
+            for uri in uris:
+                try:
+                    result = await self.fetch_async(uri)
+                    if result:
+                        await results.put(result)
+                except Exception as err:
+                    if on_error:
+                        on_error(uri, err)
+                    else:
+                        print(f"Error fetching: {uri}\n{str(err)}")
+            await results.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self._config["maxConcurrency"])]
+        try:
+            remaining = len(workers)
+            while remaining:
+                result = await results.get()
+                if result is None:
+                    remaining -= 1
+                else:
+                    yield result
+        finally:
+            for task in workers:
+                task.cancel()
+
+    def close(self) -> None:
+        for session in self._sessions.values():
+            session.close()
+        self._sessions = {}
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._convert_executor:
+            self._convert_executor.shutdown(wait=False)
+            self._convert_executor = None
+
+    def _get_headers(self, uri: str) -> Dict[str, str]:
         headers = DEFAULT_HEADERS.copy()
         parsed_uri = urlparse(uri)
         headers["Host"] = parsed_uri.hostname
         headers["Alt-Used"] = parsed_uri.hostname
+        return headers
+
+    def _get(self, uri: str, headers: Dict[str, str]):
+        # Reuse one pooled session per host so connections are kept alive between pages
+        host = urlparse(uri).hostname
+        session = self._sessions.get(host)
+        if session is None:
+            # requests is only imported once something is actually fetched
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._config["maxPerHost"])
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._sessions[host] = session
 
-        response = requests.get(uri, headers=headers, **self._config.get("requestConfig", {}))
-        response.raise_for_status()
+        response = session.get(uri, headers=headers, **self._config.get("requestConfig", {}))
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
 
+    def _process_response(self, response) -> Tuple[str, Optional[str]]:
         content_type = response.headers["content-type"]
         content_type_array = content_type.split(";")
         if not content_type_array[0] or content_type_array[0] not in ALLOWED_CONTENT_TYPES:
             raise Exception(f"Site returned an invalid content type of {content_type}")
 
         doc_type = content_type_array[0].split("/")[1] if content_type_array[0] != "text/plain" else None
-        if doc_type == "html" and self._config["htmlToMarkdown"]:
-            text = self.html_to_markdown(response.text, uri)
-            return text
-        else:
-            return response.text
+        return response.text, doc_type
 
     @staticmethod
-    def html_to_markdown(html: str, base_url: str) -> str:
-        soup = BeautifulSoup(html, "html.parser")
+    def html_to_markdown(html: str, base_url: str, fast: bool = False) -> str:
+        # The HTML libraries are imported on first conversion to keep them out of startup
+        from bs4 import BeautifulSoup
+        from markdownify import markdownify as md
 
-        for script in soup.find_all("script"):
-            script.extract()
+        if fast:
+            markdown = WebFetcher._fast_html_to_markdown(html, base_url)
+        else:
+            soup = BeautifulSoup(html, "html.parser")
 
-        for a in soup.find_all("a"):
-            href = a.get("href")
-            if href and not href.startswith("http"):
-                try:
-                    a["href"] = requests.compat.urljoin(base_url, href)
-                except ValueError:
-                    pass
+            for script in soup.find_all("script"):
+                script.extract()
+
+            for a in soup.find_all("a"):
+                href = a.get("href")
+                if href and not href.startswith("http"):
+                    try:
+                        a["href"] = urljoin(base_url, href)
+                    except ValueError:
+                        pass
+
+            markdown = md(str(soup.body), heading_style="ATX", bullet_style="-", code_style="backticks")
 
-        markdown = md(str(soup.body), heading_style="ATX", bullet_style="-", code_style="backticks")
         markdown = "\n\n".join(markdown.splitlines())
         if len(markdown) > 64:
             start = markdown.find("\n")
@@ -87,6 +282,37 @@ class WebFetcher:
 
         return markdown
 
+    @staticmethod
+    def _fast_html_to_markdown(html: str, base_url: str) -> str:
+        """
+        Gives the same output as the default conversion, but removes scripts and
+        resolves links in one walk of the tree and converts the body where it is,
+        rather than serializing it for markdownify to parse again.
+        """
+        from bs4 import BeautifulSoup
+        from markdownify import MarkdownConverter
+
+        soup = BeautifulSoup(html, "html.parser")
+        converter = MarkdownConverter(heading_style="ATX", bullet_style="-", code_style="backticks")
+        if soup.body is None:
+            # The default conversion is given the text "None" for pages without a body
+            return converter.convert(str(soup.body))
+
+        for tag in soup.find_all(["script", "a"]):
+            if tag.name == "script":
+                tag.extract()
+                continue
+            href = tag.get("href")
+            if href and not href.startswith("http"):
+                try:
+                    tag["href"] = urljoin(base_url, href)
+                except ValueError:
+                    pass
+
+        # markdownify converts a whole document, so the body is moved into an empty one
+        document = BeautifulSoup("", "html.parser")
+        document.append(soup.body.extract())
+        return converter.convert_soup(document)
 
 
 # Example usage:
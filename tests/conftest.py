@@ -0,0 +1,45 @@
+import os
+import re
+import sys
+import zlib
+
+# The package modules import each other by their bare names
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'vectra_py'))
+
+from custom_types import EmbeddingsResponse  # noqa: E402
+
+
+class WordTokenizer:
+    """
+    A stand-in for tiktoken. Like tiktoken, a word's token starts on the space before
+    it, so token boundaries don't line up with separator boundaries.
+    """
+    _pattern = re.compile(r' ?\w+| ?[^\w\s]+|\s+(?!\S)|\s+')
+
+    def __init__(self):
+        self._words = {}
+
+    def encode(self, text):
+        return [self._id(match.group()) for match in self._pattern.finditer(text)]
+
+    def encode_with_offsets(self, text):
+        matches = list(self._pattern.finditer(text))
+        return [self._id(match.group()) for match in matches], [match.start() for match in matches]
+
+    def decode(self, tokens):
+        return ''.join(self._words[token] for token in tokens)
+
+    def _id(self, word):
+        # Stable across processes, so split_batch workers give the same ids
+        token = zlib.crc32(word.encode('utf-8')) & 0xFFFFFF
+        self._words[token] = word
+        return token
+
+
+class FakeEmbeddings:
+    max_tokens = 8000
+
+    async def create_embeddings(self, inputs):
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return EmbeddingsResponse(status='success',
+                                  output=[[float(len(text)), 1.0, float(text.count(' '))] for text in inputs])
@@ -0,0 +1,32 @@
+import asyncio
+import copy
+import pickle
+
+import pytest
+
+from batching_embeddings import BatchingEmbeddings, BatchingEmbeddingsOptions
+from conftest import FakeEmbeddings
+
+
+def test_batches_concurrent_calls():
+    embeddings = BatchingEmbeddings(FakeEmbeddings(), BatchingEmbeddingsOptions(max_batch_size=8, max_wait_ms=5))
+
+    async def embed():
+        return await asyncio.gather(*(embeddings.create_embeddings(f'text {i}') for i in range(5)))
+
+    responses = asyncio.run(embed())
+    assert [response.output for response in responses] == [[[6.0, 1.0, 1.0]]] * 5
+    assert embeddings.get_stats()["batch_size"]["count"] == 1
+
+
+def test_reads_attributes_from_wrapped_model():
+    embeddings = BatchingEmbeddings(FakeEmbeddings())
+    assert embeddings.max_tokens == 8000
+    with pytest.raises(AttributeError):
+        embeddings.missing
+
+
+def test_copy_and_pickle():
+    embeddings = BatchingEmbeddings(FakeEmbeddings())
+    assert copy.copy(embeddings).max_tokens == 8000
+    assert pickle.loads(pickle.dumps(embeddings)).max_tokens == 8000
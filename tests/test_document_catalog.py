@@ -0,0 +1,76 @@
+import json
+
+from document_catalog import DocumentCatalog, DocumentRecord
+
+
+def open_catalog(folder):
+    folder.mkdir(exist_ok=True)
+    catalog = DocumentCatalog(str(folder))
+    catalog.open()
+    return catalog
+
+
+def test_commit_and_lookup(tmp_path):
+    catalog = open_catalog(tmp_path)
+    catalog.begin()
+    catalog.upsert(DocumentRecord(id='doc-1', uri='a', chunk_ids=['c1', 'c2'], token_count=7))
+    assert catalog.get_document_id('a') is None
+    assert catalog.get_document_id('a', pending=True) == 'doc-1'
+    catalog.commit(generation=3)
+
+    assert catalog.generation == 3
+    assert catalog.get_document_id('a') == 'doc-1'
+    assert catalog.get_document('doc-1').chunk_ids == ['c1', 'c2']
+
+    catalog.begin()
+    catalog.delete('doc-1')
+    assert catalog.get_document_id('a', pending=True) is None
+    catalog.cancel()
+    assert catalog.get_document_uri('doc-1') == 'a'
+    catalog.close()
+
+
+def test_pending_changes_survive_json(tmp_path):
+    source = open_catalog(tmp_path / 'source')
+    target = open_catalog(tmp_path / 'target')
+    for catalog in (source, target):
+        catalog.begin()
+        catalog.upsert(DocumentRecord(id='old', uri='old-uri'))
+        catalog.commit()
+
+    source.begin()
+    source.upsert(DocumentRecord(id='new', uri='new-uri', chunk_ids=['c1'], content_hash='h'))
+    source.delete('old')
+    changes = json.loads(json.dumps(source.pending_changes()))
+    target.apply(changes, generation=5)
+
+    assert target.generation == 5
+    assert target.get_document_id('old-uri') is None
+    record = target.get_document('new')
+    assert (record.uri, record.chunk_ids, record.content_hash) == ('new-uri', ['c1'], 'h')
+
+
+def test_migrates_catalog_json(tmp_path):
+    (tmp_path / 'catalog.json').write_text(json.dumps({
+        "version": 1,
+        "count": 2,
+        "uri_to_id": {"a": "doc-1", "b": "doc-2"},
+        "id_to_uri": {"doc-1": "a", "doc-2": "b"},
+    }))
+    items = [
+        {"id": "c1", "metadata": {"document_id": "doc-1", "token_count": 3}},
+        {"id": "c2", "metadata": {"document_id": "doc-1", "token_count": 4}},
+        {"id": "c3", "metadata": {"document_id": "doc-2"}},
+        {"id": "x", "metadata": {}},
+    ]
+    catalog = open_catalog(tmp_path)
+    assert catalog.needs_migration()
+    catalog.migrate(items)
+
+    assert not catalog.needs_migration()
+    assert not (tmp_path / 'catalog.json').exists()
+    assert (tmp_path / 'catalog.json.bak').exists()
+    assert catalog.count() == 2
+    record = catalog.get_document('doc-1')
+    assert (record.uri, record.chunk_ids, record.token_count) == ('a', ['c1', 'c2'], 7)
+    assert catalog.get_document('doc-2').chunk_ids == ['c3']
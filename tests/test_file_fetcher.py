@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+from file_fetcher import FileFetcher
+
+
+def fetch_all(fetcher, uri):
+    async def run():
+        return [(path, text if isinstance(text, str) else ''.join(text), doc_type)
+                async for path, text, doc_type in fetcher.fetch(uri)]
+    return asyncio.run(run())
+
+
+def make_tree(root):
+    for path, text in [('a.md', 'a'), ('b.txt', 'b'), ('docs/c.md', 'c'), ('docs/d.py', 'd'),
+                       ('build/e.md', 'e'), ('large.md', 'x' * 100)]:
+        file_path = root / path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(text)
+
+
+def test_walks_folders_in_name_order_with_filters(tmp_path):
+    make_tree(tmp_path)
+    fetcher = FileFetcher({"include": ["*.md"], "exclude": ["build"], "max_file_size": 10, "max_workers": 2})
+    results = fetch_all(fetcher, str(tmp_path))
+    assert [(os.path.relpath(path, tmp_path).replace(os.sep, '/'), text, doc_type) for path, text, doc_type in results] == [
+        ('a.md', 'a', 'md'),
+        ('docs/c.md', 'c', 'md'),
+    ]
+
+
+def test_filters_apply_to_a_single_file(tmp_path):
+    make_tree(tmp_path)
+    fetcher = FileFetcher({"include": ["*.md"], "exclude": ["a.*"], "max_file_size": 10})
+    assert fetch_all(fetcher, str(tmp_path / 'a.md')) == []
+    assert fetch_all(fetcher, str(tmp_path / 'b.txt')) == []
+    assert fetch_all(fetcher, str(tmp_path / 'large.md')) == []
+    assert fetch_all(fetcher, str(tmp_path / 'docs' / 'c.md')) == [(str(tmp_path / 'docs' / 'c.md'), 'c', 'md')]
+
+
+def test_large_files_are_streamed_in_blocks(tmp_path):
+    make_tree(tmp_path)
+    fetcher = FileFetcher({"stream_threshold": 50, "block_size": 16})
+
+    async def run():
+        return [text async for _, text, _ in fetcher.fetch(str(tmp_path / 'large.md'))]
+
+    text, = asyncio.run(run())
+    blocks = list(text)
+    assert len(blocks) == 7
+    assert ''.join(blocks) == 'x' * 100
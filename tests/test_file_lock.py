@@ -0,0 +1,66 @@
+import multiprocessing
+import threading
+
+import pytest
+
+from file_lock import FileLock
+
+
+def hold_lock(path, locked, release):
+    with FileLock(path):
+        locked.set()
+        release.wait(10)
+
+
+def test_excludes_other_instances(tmp_path):
+    path = str(tmp_path / 'index.lock')
+    first, second = FileLock(path), FileLock(path)
+    first.acquire()
+    assert first.is_locked
+    with pytest.raises(TimeoutError):
+        second.acquire(timeout=0.1)
+    first.release()
+    second.acquire(timeout=1)
+    assert second.is_locked
+    second.release()
+    assert not second.is_locked
+
+
+def test_not_reentrant(tmp_path):
+    with FileLock(str(tmp_path / 'index.lock')) as lock:
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+
+
+def test_blocking_acquire_waits_for_release(tmp_path):
+    path = str(tmp_path / 'index.lock')
+    first = FileLock(path)
+    first.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        with FileLock(path):
+            acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.2)
+    first.release()
+    thread.join(5)
+    assert acquired.is_set()
+
+
+def test_excludes_other_processes(tmp_path):
+    path = str(tmp_path / 'index.lock')
+    context = multiprocessing.get_context('spawn')
+    locked, release = context.Event(), context.Event()
+    process = context.Process(target=hold_lock, args=(path, locked, release))
+    process.start()
+    try:
+        assert locked.wait(30)
+        with pytest.raises(TimeoutError):
+            FileLock(path).acquire(timeout=0.1)
+    finally:
+        release.set()
+        process.join(10)
+    FileLock(path).acquire(timeout=1)
@@ -0,0 +1,63 @@
+import pickle
+
+import pytest
+
+import gpt3_tokenizer
+from gpt3_tokenizer import MAX_CACHED_TEXT_LENGTH, GPT3Tokenizer
+
+tiktoken = pytest.importorskip('tiktoken')
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    # A byte-level encoding, so the tests don't download a model's encoding
+    ranks = {bytes([i]): i for i in range(256)}
+    for merge in [b'he', b'll', b'hell', b'hello', b' w', b'or']:
+        ranks[merge] = len(ranks)
+    encoding = tiktoken.Encoding('test-bytes', pat_str=r" ?\S+|\s+(?!\S)|\s+", mergeable_ranks=ranks,
+                                 special_tokens={})
+    monkeypatch.setitem(gpt3_tokenizer._encodings, 'test-model', encoding)
+    return GPT3Tokenizer('test-model', cache_size=3)
+
+
+def test_cached_encoding_matches_encoding(tokenizer):
+    encoding = tokenizer.encoding
+    for text in ['hello world', 'hello world', 'café ☃', '']:
+        assert tokenizer.encode(text) == encoding.encode(text)
+        assert tokenizer.count_tokens(text) == len(encoding.encode(text))
+    tokens = tokenizer.encode('hello world')
+    tokens.append(0)
+    # Changing returned tokens doesn't change the cached ones
+    assert tokenizer.encode('hello world') == encoding.encode('hello world')
+    assert tokenizer.decode(encoding.encode('café ☃')) == 'café ☃'
+
+
+def test_cache_is_bounded_and_skips_long_texts(tokenizer):
+    for text in ['a', 'b', 'c', 'd']:
+        tokenizer.encode(text)
+    assert len(tokenizer._cache) == 3
+    assert tokenizer._cache_get('a') is None
+    assert tokenizer._cache_get('d') is not None
+
+    tokenizer.encode('x' * (MAX_CACHED_TEXT_LENGTH + 1))
+    assert tokenizer._cache_get('x' * (MAX_CACHED_TEXT_LENGTH + 1)) is None
+
+
+def test_encode_batch_matches_encode(tokenizer):
+    texts = ['hello', 'world', 'hello', 'café', 'hello world']
+    tokenizer.encode('world')
+    assert tokenizer.encode_batch(texts) == [tokenizer.encoding.encode(text) for text in texts]
+
+
+def test_encode_with_offsets(tokenizer):
+    tokens, offsets = tokenizer.encode_with_offsets('hello café')
+    assert tokens == tokenizer.encoding.encode('hello café')
+    assert len(offsets) == len(tokens)
+    assert offsets[0] == 0 and offsets == sorted(offsets)
+
+
+def test_pickles_without_its_cache(tokenizer):
+    tokenizer.encode('hello')
+    copy = pickle.loads(pickle.dumps(tokenizer))
+    assert (copy.model_name, copy._cache_size, len(copy._cache)) == ('test-model', 3, 0)
+    assert copy.encode('hello') == tokenizer.encode('hello')
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip('bs4')
+pytest.importorskip('markdownify')
+
+from web_fetcher import WebFetcher  # noqa: E402
+
+PAGES = [
+    # An article with navigation, scripts, styles and relative links
+    '''<!DOCTYPE html>
+<html><head><title>Article</title><style>body { color: red; }</style>
+<script>var tracking = "<b>not text</b>";</script></head>
+<body>
+  <nav><a href="/">Home</a> | <a href="../about.html">About</a> | <a href="https://example.org/x">Out</a></nav>
+  <h1>The title &amp; more</h1>
+  <p>Some <b>bold</b>, <i>italic</i> and <code>inline code</code> text with &lt;brackets&gt;.</p>
+  <script type="application/ld+json">{"a": 1}</script>
+  <ul><li>One</li><li>Two<ul><li>Nested <a href="#frag">link</a></li></ul></li></ul>
+  <ol start="3"><li>Three</li><li>Four</li></ol>
+  <pre><code>def f():
+    return "&lt;x&gt;"
+</code></pre>
+  <blockquote><p>Quoted text</p></blockquote>
+  <noscript>Enable scripts</noscript>
+</body></html>''',
+    # Tables, including a layout table without text, and an iframe and svg
+    '''<html><body>
+<table><tr><th>Name</th><th>Value</th></tr><tr><td>a</td><td>1</td></tr><tr><td>b</td><td>2</td></tr></table>
+<table><tr><td><img src="spacer.gif"></td></tr></table>
+<iframe src="/embed">frame text</iframe>
+<svg><text>svg text</text></svg>
+<p>After<br>the break</p><hr><h2>Section</h2><p>Final paragraph.</p>
+</body></html>''',
+    # Unclosed tags and stray end tags
+    '<html><body><p>First<p>Second <b>unclosed<div>block</span></div><a href="rel">end</a></body>',
+    # Short page, shorter than the 64 characters that trigger trimming
+    '<body><p>Tiny</p></body>',
+    # No body, which the default conversion turns into the text "None"
+    '<p>A fragment without a body</p>',
+]
+
+
+@pytest.mark.parametrize('html', PAGES)
+def test_fast_conversion_matches_default(html):
+    base_url = 'https://example.com/docs/page.html'
+    assert WebFetcher.html_to_markdown(html, base_url, fast=True) == WebFetcher.html_to_markdown(html, base_url)
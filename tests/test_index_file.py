@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+
+from index_file import (VECTOR_ENCODING_COLUMNAR, VECTOR_ENCODING_FLOAT32, VECTOR_ENCODING_JSON, LazyItems,
+                        open_index_file, read_index_file, write_index_file)
+from vector_cache import VectorCache
+
+
+def make_data(count=10, dimensions=4):
+    return {
+        "version": 1,
+        "metadata_config": {},
+        "items": [
+            {
+                "id": f"item-{i}",
+                "metadata": {"position": i},
+                "vector": [float(i + j) for j in range(dimensions)],
+                "norm": float(i),
+            }
+            for i in range(count)
+        ],
+    }
+
+
+@pytest.mark.parametrize('vector_encoding', [VECTOR_ENCODING_JSON, VECTOR_ENCODING_FLOAT32, VECTOR_ENCODING_COLUMNAR])
+@pytest.mark.parametrize('codec', ['json', 'orjson'])
+def test_round_trip(tmp_path, vector_encoding, codec):
+    if codec == 'orjson':
+        pytest.importorskip('orjson')
+    path = str(tmp_path / 'index.json')
+    data = make_data()
+    write_index_file(path, data, codec=codec, vector_encoding=vector_encoding)
+    assert read_index_file(path, codec) == data
+
+
+def test_reads_files_without_header(tmp_path):
+    path = tmp_path / 'index.json'
+    data = make_data()
+    path.write_text(json.dumps(data))
+    assert read_index_file(str(path)) == data
+
+
+def test_damaged_file_falls_back_to_previous(tmp_path):
+    path = str(tmp_path / 'index.json')
+    first, second = make_data(3), make_data(5)
+    write_index_file(path, first)
+    write_index_file(path, second)
+    assert read_index_file(f'{path}.prev') == first
+
+    with open(path, 'r+b') as index_file:
+        index_file.seek(-2, os.SEEK_END)
+        index_file.write(b'xx')
+    assert read_index_file(path) == first
+
+    with open(path, 'r+b') as index_file:
+        index_file.truncate(os.path.getsize(path) - 10)
+    assert read_index_file(path) == first
+
+
+def test_newer_format_is_rejected(tmp_path):
+    path = tmp_path / 'index.json'
+    path.write_bytes(b'{"format": "vectra-index", "format_version": 99, "size": 2, "checksum": 0}\n{}')
+    with pytest.raises(ValueError):
+        read_index_file(str(path))
+
+
+@pytest.mark.parametrize('memory_budget', [None, 64])
+def test_lazy_items_match_full_read(tmp_path, memory_budget):
+    path = str(tmp_path / 'index.json')
+    data = make_data(25)
+    write_index_file(path, data, vector_encoding=VECTOR_ENCODING_COLUMNAR)
+    cache = VectorCache(memory_budget) if memory_budget is not None else None
+
+    lazy = open_index_file(path, cache=cache)
+    items = lazy["items"]
+    try:
+        assert isinstance(items, LazyItems)
+        assert len(items) == 25
+        assert list(items) == data["items"]
+        assert items[3:7] == data["items"][3:7]
+        assert items[::5] == data["items"][::5]
+        assert items[-1] == data["items"][-1]
+        assert items.get("item-12") == data["items"][12]
+        assert items.get("missing") is None
+        assert [(row, list(vector), norm) for row, vector, norm in items.vectors([2, 20])] == [
+            (row, data["items"][row]["vector"], data["items"][row]["norm"]) for row in (2, 20)
+        ]
+        # Items are copies, changing one doesn't change the index
+        items[0]["metadata"]["position"] = -1
+        assert items[0]["metadata"]["position"] == 0
+    finally:
+        items.close()
+
+
+def test_lazy_open_reads_other_encodings_in_full(tmp_path):
+    path = str(tmp_path / 'index.json')
+    data = make_data()
+    write_index_file(path, data, vector_encoding=VECTOR_ENCODING_FLOAT32)
+    assert open_index_file(path) == data
+
+
+def test_columnar_falls_back_for_mixed_dimensions(tmp_path):
+    path = str(tmp_path / 'index.json')
+    data = make_data(2)
+    data["items"][1]["vector"] = [1.0, 2.0]
+    write_index_file(path, data, vector_encoding=VECTOR_ENCODING_COLUMNAR)
+    assert read_index_file(path) == data
+    assert not isinstance(open_index_file(path)["items"], LazyItems)
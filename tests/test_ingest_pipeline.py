@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeEmbeddings, WordTokenizer
+from ingest_pipeline import IngestPipeline, IngestPipelineConfig
+from local_document_index import LocalDocumentIndex, LocalDocumentIndexConfig
+from local_index import CreateIndexConfig
+
+
+async def create_index(folder_path):
+    index = LocalDocumentIndex(LocalDocumentIndexConfig(folder_path, WordTokenizer(), FakeEmbeddings(),
+                                                        {"chunk_size": 20}))
+    await index.create_index(CreateIndexConfig(version=1))
+    return index
+
+
+def write_documents(folder, count):
+    folder.mkdir()
+    paths = []
+    for i in range(count):
+        path = folder / f'doc-{i}.txt'
+        path.write_text(f'Document number {i}. ' * 30)
+        paths.append(str(path))
+    return paths
+
+
+def run_pipeline(pipeline, uris):
+    # Times out instead of hanging if a stage is left blocked on its queue
+    return asyncio.run(asyncio.wait_for(pipeline.run(uris), 30))
+
+
+def test_writes_documents_in_grouped_commits(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        paths = write_documents(tmp_path / 'docs', 7)
+        progress = await IngestPipeline(index, IngestPipelineConfig(commit_every=3)).run([str(tmp_path / 'docs')])
+
+        assert not progress.errors
+        assert (progress.fetched, progress.written, progress.commits) == (7, 7, 3)
+        assert (await index.get_catalog_stats()).documents == 7
+        assert await index.get_document_id(paths[4]) is not None
+        assert progress.chunks == (await index.get_index_stats())["items"]
+
+    asyncio.run(run())
+
+
+def test_failing_document_only_fails_itself(tmp_path, monkeypatch):
+    index = asyncio.run(create_index(str(tmp_path / 'index')))
+    paths = write_documents(tmp_path / 'docs', 5)
+    add_document = LocalDocumentIndex.add_document_to_update
+
+    async def add_document_to_update(self, uri, *args, **kwargs):
+        if uri == paths[2]:
+            raise ValueError('bad document')
+        return await add_document(self, uri, *args, **kwargs)
+
+    monkeypatch.setattr(LocalDocumentIndex, 'add_document_to_update', add_document_to_update)
+    progress = run_pipeline(IngestPipeline(index, IngestPipelineConfig(commit_every=5)), paths)
+
+    assert progress.errors == [(paths[2], 'bad document')]
+    assert progress.written == 4
+    assert asyncio.run(index.get_document_id(paths[2])) is None
+    assert asyncio.run(index.get_catalog_stats()).documents == 4
+
+
+def test_failed_begin_update_is_reported(tmp_path, monkeypatch):
+    index = asyncio.run(create_index(str(tmp_path / 'index')))
+    paths = write_documents(tmp_path / 'docs', 4)
+
+    async def begin_update(self):
+        raise OSError('disk unavailable')
+
+    monkeypatch.setattr(LocalDocumentIndex, 'begin_update', begin_update)
+    progress = run_pipeline(IngestPipeline(index, IngestPipelineConfig(commit_every=2)), paths)
+
+    assert sorted(progress.errors) == [(path, 'disk unavailable') for path in paths]
+    assert progress.written == 0
+
+
+def test_failing_stage_cancels_the_others(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        paths = write_documents(tmp_path / 'docs', 3)
+
+        def uris():
+            yield from paths
+            raise RuntimeError('listing failed')
+
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(IngestPipeline(index).run(uris()), 30)
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+from array import array
+
+from conftest import WordTokenizer
+from local_document import TEXT_BLOCK_SIZE, CharOffsets, LocalDocument, TokenPositions, TokenPositionsWriter
+
+TEXT = 'The quick brown fox jumps over the lazy dog. ' * 400 + 'café ☃ ' * 300
+
+
+def test_token_positions_round_trip(tmp_path):
+    path = str(tmp_path / 'doc.tokens')
+    positions = TokenPositions.from_text(TEXT, WordTokenizer())
+    positions.save(path)
+
+    loaded = TokenPositions.load(path)
+    assert loaded.text_length == len(TEXT)
+    assert list(loaded.offsets) == list(positions.offsets)
+    assert loaded.count(0, len(TEXT)) == len(positions)
+    assert loaded.count(0, 3) == 1
+    assert loaded.count(0, 4) == 2
+    assert loaded.end_after(0, 2) == (9, 2)
+    assert loaded.start_before(9, 1) == (3, 1)
+
+
+def test_token_positions_writer_matches_save(tmp_path):
+    positions = TokenPositions.from_text(TEXT, WordTokenizer())
+    positions.save(str(tmp_path / 'saved.tokens'))
+
+    with TokenPositionsWriter(str(tmp_path / 'written.tokens')) as writer:
+        for start in range(0, len(positions.offsets), 1000):
+            writer.extend(positions.offsets[start:start + 1000])
+        writer.text_length = len(TEXT)
+    assert writer.count == len(positions)
+    assert (tmp_path / 'written.tokens').read_bytes() == (tmp_path / 'saved.tokens').read_bytes()
+
+
+def test_token_positions_past_4gi_characters(tmp_path):
+    path = str(tmp_path / 'doc.tokens')
+    offsets = [0, 5, 1 << 32, (1 << 32) + 7, 5 << 32]
+    TokenPositions(array('Q', offsets), (5 << 32) + 3).save(path)
+
+    loaded = TokenPositions.load(path)
+    assert list(loaded.offsets) == offsets
+    assert loaded.text_length == (5 << 32) + 3
+    assert loaded.count(1 << 32, 5 << 32) == 2
+    assert loaded.end_after(1 << 32, 2) == (5 << 32, 2)
+
+
+def test_token_positions_reads_version_1_files(tmp_path):
+    # Version 1 files are all 32-bit ints headed by the text length
+    path = tmp_path / 'doc.tokens'
+    positions = TokenPositions.from_text(TEXT, WordTokenizer())
+    path.write_bytes(array('I', [len(TEXT), *positions.offsets]).tobytes())
+
+    loaded = TokenPositions.load(str(path))
+    assert loaded.text_length == len(TEXT)
+    assert list(loaded.offsets) == list(positions.offsets)
+
+
+def test_char_offsets_round_trip(tmp_path):
+    path = str(tmp_path / 'doc.chars')
+    char_offsets = CharOffsets.from_text(TEXT)
+    assert char_offsets.text_length == len(TEXT)
+    assert char_offsets.byte_length == len(TEXT.encode('utf-8'))
+    char_offsets.save(path)
+
+    loaded = CharOffsets.load(path)
+    assert loaded.offsets.typecode == 'Q'
+    assert list(loaded.offsets) == list(char_offsets.offsets)
+    assert (loaded.text_length, loaded.byte_length) == (char_offsets.text_length, char_offsets.byte_length)
+
+
+def test_char_offsets_extend_matches_from_text():
+    char_offsets = CharOffsets()
+    for start in range(0, len(TEXT), 1000):
+        char_offsets.extend(TEXT[start:start + 1000])
+    expected = CharOffsets.from_text(TEXT)
+    assert list(char_offsets.offsets) == list(expected.offsets)
+    assert char_offsets.byte_length == expected.byte_length
+    assert list(char_offsets.offsets) == [
+        len(TEXT[:pos].encode('utf-8')) for pos in range(0, len(TEXT), TEXT_BLOCK_SIZE)
+    ]
+
+
+def test_char_offsets_reads_version_1_files(tmp_path):
+    # Version 1 files are all 32-bit ints headed by the text and byte lengths
+    path = tmp_path / 'doc.chars'
+    char_offsets = CharOffsets.from_text(TEXT)
+    path.write_bytes(array('I', [char_offsets.text_length, char_offsets.byte_length,
+                                 *char_offsets.offsets]).tobytes())
+
+    loaded = CharOffsets.load(str(path))
+    assert list(loaded.offsets) == list(char_offsets.offsets)
+    assert (loaded.text_length, loaded.byte_length) == (char_offsets.text_length, char_offsets.byte_length)
+
+
+def test_read_text_range_uses_char_offsets(tmp_path):
+    (tmp_path / 'doc.txt').write_text(TEXT, encoding='utf-8')
+    CharOffsets.from_text(TEXT).save(str(tmp_path / 'doc.chars'))
+    document = LocalDocument(str(tmp_path), 'doc', 'uri')
+    for start, end in [(0, 10), (TEXT_BLOCK_SIZE - 5, TEXT_BLOCK_SIZE + 5), (len(TEXT) - 700, len(TEXT))]:
+        assert document.read_text_range(start, end) == TEXT[start:end]
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from conftest import FakeEmbeddings, WordTokenizer
+from document_catalog import DocumentCatalog
+from local_document import TokenPositions
+from local_document_index import DocumentQueryOptions, LocalDocumentIndex, LocalDocumentIndexConfig
+from local_index import CreateIndexConfig
+
+
+def make_config(folder_path, lazy=False):
+    return LocalDocumentIndexConfig(folder_path, WordTokenizer(), FakeEmbeddings(), {"chunk_size": 20}, lazy=lazy)
+
+
+async def create_index(folder_path, lazy=False):
+    index = LocalDocumentIndex(make_config(folder_path, lazy))
+    await index.create_index(CreateIndexConfig(version=1))
+    return index
+
+
+def folder_files(index):
+    return sorted(os.listdir(index.folder_path))
+
+
+def read_file(index, name, mode='r'):
+    with open(os.path.join(index.folder_path, name), mode) as file:
+        return file.read()
+
+
+def test_cancelled_update_leaves_files_untouched(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        document = await index.upsert_document('a', 'first version text ' * 20, metadata={"v": 1})
+        before = {name: read_file(index, name, 'rb') for name in folder_files(index) if name.startswith(document.id)}
+
+        text = 'second version ' * 10
+        chunks = index.split_document('a', text)
+        embeddings = await index.embed_chunks(chunks)
+        await index.begin_update()
+        await index.add_document_to_update('a', text, chunks, embeddings, {"v": 2})
+        index.remove_document_from_update('a')
+        index.cancel_update()
+
+        after = {name: read_file(index, name, 'rb') for name in folder_files(index) if name.startswith(document.id)}
+        assert after == before
+        assert not [name for name in folder_files(index) if name.endswith('.pending')]
+        assert (await index.get_catalog_stats()).chunks == len(index.split_document('a', 'first version text ' * 20))
+
+    asyncio.run(run())
+
+
+def test_failed_stream_upsert_keeps_previous_version(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        document = await index.upsert_document_stream('a', ['hello world. ' * 50, 'more text here ' * 40])
+        files = folder_files(index)
+        text = read_file(index, f'{document.id}.txt')
+
+        def broken_stream():
+            yield 'new text ' * 100
+            raise RuntimeError('stream broke')
+
+        with pytest.raises(Exception):
+            await index.upsert_document_stream('a', broken_stream())
+        assert folder_files(index) == files
+        assert read_file(index, f'{document.id}.txt') == text
+
+        replaced = await index.upsert_document_stream('a', ['replaced text ' * 30])
+        assert replaced.id == document.id
+        assert read_file(index, f'{document.id}.txt') == 'replaced text ' * 30
+        assert folder_files(index) == files
+
+    asyncio.run(run())
+
+
+def test_render_documents_matches_render_sections(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        for i in range(4):
+            text = f'Document {i} starts here. ' + 'some filler words go here. ' * (20 + 15 * i)
+            await index.upsert_document(f'doc-{i}', text)
+        results = await index.query_documents('some filler words', DocumentQueryOptions(max_documents=4, max_chunks=40))
+        assert len(results) == 4
+
+        rendered = await index.render_documents(results, 40, max_sections=2)
+        assert rendered == [await result.render_sections(40, 2) for result in results]
+
+        budgeted = await index.render_documents(results, 40, max_sections=2, total_tokens=100)
+        assert sum(section["token_count"] for sections in budgeted for section in sections) <= 100
+        for sections, full in zip(budgeted, rendered):
+            assert all(section in full for section in sections)
+        # The best sections of the best documents are kept first
+        assert budgeted[0] == rendered[0][:len(budgeted[0])] and budgeted[0]
+
+    asyncio.run(run())
+
+
+def test_fresh_instance_loads_index_and_catalog(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        ids = [(await index.upsert_document(f'doc-{i}', f'text of document {i}. ' * 15)).id for i in range(3)]
+
+        other = LocalDocumentIndex(make_config(index.folder_path))
+        await other.load_index_data()
+        assert [await other.get_document_id(f'doc-{i}') for i in range(3)] == ids
+        assert await other.get_catalog_stats() == await index.get_catalog_stats()
+        assert len(await other.list_items()) == len(await index.list_items())
+
+    asyncio.run(run())
+
+
+def test_load_migrates_catalog_json(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        document = await index.upsert_document('a', 'some document text. ' * 15)
+        stats = await index.get_catalog_stats()
+        index._catalog.close()
+
+        # Replace the sqlite catalog with one written by earlier versions
+        os.remove(os.path.join(index.folder_path, 'catalog.db'))
+        with open(os.path.join(index.folder_path, 'catalog.json'), 'w') as catalog_file:
+            json.dump({"version": 1, "count": 1, "uri_to_id": {"a": document.id}, "id_to_uri": {document.id: "a"}},
+                      catalog_file)
+
+        other = LocalDocumentIndex(make_config(index.folder_path))
+        await other.load_index_data()
+        assert await other.get_document_id('a') == document.id
+        assert (await other.get_catalog_stats()).chunks == stats.chunks
+        assert 'catalog.json.bak' in folder_files(other)
+
+    asyncio.run(run())
+
+
+def test_upsert_documents_commits_once(tmp_path, monkeypatch):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        await index.upsert_document('doc-0', 'old text ' * 20)
+        documents = [(f'doc-{i}', f'document {i} text. ' * (10 + i), None, {"n": i}) for i in range(5)]
+        documents.append(('empty', '', None, None))
+
+        end_update = LocalDocumentIndex.end_update
+        commits = []
+
+        async def counting_end_update(self):
+            commits.append(1)
+            await end_update(self)
+
+        from_text = TokenPositions.from_text
+        outside_update = []
+
+        def checked_from_text(text, tokenizer):
+            outside_update.append(index._update is None)
+            return from_text(text, tokenizer)
+
+        with monkeypatch.context() as patch:
+            patch.setattr(LocalDocumentIndex, 'end_update', counting_end_update)
+            patch.setattr(TokenPositions, 'from_text', staticmethod(checked_from_text))
+            result = await index.upsert_documents(documents, concurrency=2)
+
+        assert len(commits) == 1
+        assert outside_update and all(outside_update)
+        assert [document.uri for document in result.documents] == [uri for uri, _, _, _ in documents]
+        assert result.chunks == len(await index.list_items())
+        assert (await index.get_catalog_stats()).documents == 6
+        for document, (_, text, _, _) in zip(result.documents, documents):
+            assert await document.load_text() == text
+
+    asyncio.run(run())
+
+
+def test_failed_upsert_documents_cancels_the_others(tmp_path, monkeypatch):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        embedded = []
+        embed_chunks = LocalDocumentIndex.embed_chunks
+
+        async def slow_embed_chunks(self, chunks):
+            if 'bad' in chunks[0].text:
+                raise ValueError('embedding failed')
+            await asyncio.sleep(1)
+            embedded.append(chunks[0].text)
+            return await embed_chunks(self, chunks)
+
+        monkeypatch.setattr(LocalDocumentIndex, 'embed_chunks', slow_embed_chunks)
+        documents = [('a', 'good text', None, None), ('b', 'bad text', None, None), ('c', 'more text', None, None)]
+        with pytest.raises(Exception, match='embedding failed'):
+            await asyncio.wait_for(index.upsert_documents(documents, concurrency=3), 5)
+
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        await asyncio.sleep(1.5)
+        assert embedded == []
+        assert (await index.get_catalog_stats()).documents == 0
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_interrupted_commit_is_recovered_on_load(tmp_path, monkeypatch, lazy):
+    async def run():
+        folder_path = str(tmp_path / 'index')
+        index = await create_index(folder_path, lazy)
+        await index.upsert_document('a', 'alpha text ' * 30)
+
+        # The commit stops after index.json is written, before the files and catalog are updated
+        def stop(self, journal):
+            raise OSError('disk full')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(LocalDocumentIndex, '_apply_journal', stop)
+            document = await index.upsert_document('b', 'beta text ' * 30, metadata={"m": 1})
+        assert not os.path.exists(os.path.join(folder_path, f'{document.id}.txt'))
+        catalog = DocumentCatalog(folder_path)
+        catalog.open()
+        assert catalog.get_document_id('b') is None
+        catalog.close()
+
+        reader = LocalDocumentIndex(make_config(folder_path, lazy))
+        assert await reader.get_document_id('b') == document.id
+        assert read_file(reader, f'{document.id}.txt') == 'beta text ' * 30
+        assert read_file(reader, f'{document.id}.json') == '{"m": 1}'
+        assert (await reader.get_catalog_stats()).documents == 2
+        assert not [name for name in folder_files(reader) if name.endswith('.pending')]
+
+        await reader.delete_document('a')
+        assert await index.get_document_id('a') is None
+        assert await index.get_document_id('b') == document.id
+
+    asyncio.run(run())
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from index_file import LazyItems, read_index_file, read_index_generation, write_index_file
+from local_index import LocalIndex
+
+
+async def create_index(folder_path, **options):
+    index = LocalIndex(folder_path, **options)
+    await index.create_index()
+    await index.begin_update()
+    for i in range(20):
+        await index.add_item_to_update({"id": f"item-{i}", "vector": [1.0, float(i)], "metadata": {"n": i}}, True)
+    await index.add_item_to_update({"id": "other", "vector": [0.0, 1.0], "metadata": {}}, True, namespace="ns")
+    await index.end_update()
+    return index
+
+
+def test_cancelled_update_leaves_loaded_items_untouched(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        await index.begin_update()
+        await index.upsert_item({"id": "item-1", "vector": [0.0, 1.0], "metadata": {"n": -1}})
+        await index.insert_item({"id": "new", "vector": [0.0, 1.0]})
+        index.remove_items_from_update(["item-2"])
+        index.cancel_update()
+        assert (await index.get_item("item-1"))["metadata"] == {"n": 1}
+        assert await index.get_item("new") is None
+        assert await index.get_item("item-2") is not None
+        assert (await LocalIndex(index.folder_path).get_index_stats())["items"] == 20
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('options', [{}, {"lazy": True}, {"memory_budget": 64}])
+def test_commits_are_seen_by_other_instances(tmp_path, options):
+    async def run():
+        folder_path = str(tmp_path / 'index')
+        await create_index(folder_path, **options)
+        reader = LocalIndex(folder_path, **options)
+        assert (await reader.get_index_stats())["items"] == 20
+
+        writer = LocalIndex(folder_path, **options)
+        await writer.upsert_item({"id": "item-3", "vector": [0.0, 1.0], "metadata": {"n": -3}})
+        await writer.delete_item("item-4")
+        assert (await reader.get_item("item-3"))["metadata"] == {"n": -3}
+        assert await reader.get_item("item-4") is None
+        assert [item["id"] for item in await reader.list_items(namespace="ns")] == ["other"]
+        results = await reader.query_items([0.0, 1.0], 2)
+        assert {result["item"]["id"] for result in results} == {"item-3", "item-19"}
+
+    asyncio.run(run())
+
+
+def test_generation_is_committed_in_index_json(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        index_path = os.path.join(index.folder_path, 'index.json')
+        assert read_index_generation(index_path) == 1
+        await index.upsert_item({"id": "item-1", "vector": [0.0, 1.0]})
+        assert read_index_generation(index_path) == 2
+
+        # Indexes committed by earlier versions kept the generation in index.json.gen
+        write_index_file(index_path, read_index_file(index_path))
+        with open(f'{index_path}.gen', 'w') as generation_file:
+            generation_file.write('7')
+        await index.upsert_item({"id": "item-2", "vector": [0.0, 1.0]})
+        assert read_index_generation(index_path) == 8
+        assert not os.path.exists(f'{index_path}.gen')
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('vector_encoding', [None, "float32-base64"])
+def test_vectors_are_only_rounded_when_float32_is_chosen(tmp_path, vector_encoding):
+    async def run():
+        folder_path = str(tmp_path / 'index')
+        index = LocalIndex(folder_path, vector_encoding=vector_encoding)
+        await index.create_index()
+        await index.insert_item({"id": "a", "vector": [0.1, 0.2, 0.3]})
+
+        item = await LocalIndex(folder_path).get_item("a")
+        if vector_encoding is None:
+            assert item["vector"] == [0.1, 0.2, 0.3]
+        else:
+            assert item["vector"] != [0.1, 0.2, 0.3]
+            assert item["vector"] == pytest.approx([0.1, 0.2, 0.3], rel=1e-6)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('options', [{}, {"lazy": True}])
+def test_namespace_files_are_replaced_after_index_json(tmp_path, monkeypatch, options):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'), **options)
+        namespaces_path = os.path.join(index.folder_path, 'index.json.namespaces')
+        assert os.listdir(namespaces_path) == ['ns@1.json']
+
+        # The commit fails writing index.json, after the namespace was written
+        def fail(self, generation):
+            raise OSError('disk full')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(LocalIndex, '_save_update', fail)
+            with pytest.raises(ValueError):
+                await index.insert_item({"id": "more", "vector": [1.0, 0.0]}, namespace="ns")
+        reader = LocalIndex(index.folder_path, **options)
+        assert [item["id"] for item in await reader.list_items(namespace="ns")] == ["other"]
+
+        await index.insert_item({"id": "more", "vector": [1.0, 0.0]}, namespace="ns")
+        assert os.listdir(namespaces_path) == ['ns@2.json']
+        assert [item["id"] for item in await reader.list_items(namespace="ns")] == ["other", "more"]
+
+        await index.delete_namespace("ns")
+        assert os.listdir(namespaces_path) == []
+        assert await reader.list_namespaces() == []
+
+    asyncio.run(run())
+
+
+def test_reads_namespace_files_of_earlier_versions(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'))
+        namespaces_path = os.path.join(index.folder_path, 'index.json.namespaces')
+        os.rename(os.path.join(namespaces_path, 'ns@1.json'), os.path.join(namespaces_path, 'ns.json'))
+        index_path = os.path.join(index.folder_path, 'index.json')
+        data = read_index_file(index_path)
+        del data["namespaces"]["ns"]["file"]
+        write_index_file(index_path, data, generation=1)
+
+        reader = LocalIndex(index.folder_path)
+        assert [item["id"] for item in await reader.list_items(namespace="ns")] == ["other"]
+        await reader.insert_item({"id": "more", "vector": [1.0, 0.0]}, namespace="ns")
+        assert os.listdir(namespaces_path) == ['ns@2.json']
+        assert len(await reader.list_items(namespace="ns")) == 2
+
+    asyncio.run(run())
+
+
+def test_lazy_update_closes_replaced_files(tmp_path):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'), lazy=True)
+        await index.get_item("item-0")
+        await index.get_item("other", namespace="ns")
+        items, namespace_items = index._data["items"], index._namespaces["ns"]["items"]
+        assert isinstance(items, LazyItems)
+
+        await index.begin_update()
+        await index.upsert_item({"id": "more", "vector": [1.0, 1.0]}, namespace="ns")
+        await index.delete_item("item-0")
+        await index.end_update()
+        assert items._file.closed and namespace_items._file.closed
+        assert (await index.get_index_stats())["items"] == 19
+        assert [item["id"] for item in await index.list_items(namespace="ns")] == ["other", "more"]
+
+        namespace_items = index._namespaces["ns"]["items"]
+        await index.delete_namespace("ns")
+        assert namespace_items._file.closed
+        assert await index.list_namespaces() == []
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('options', [{}, {"memory_budget": 64}])
+def test_queries_run_off_the_event_loop(tmp_path, monkeypatch, options):
+    async def run():
+        index = await create_index(str(tmp_path / 'index'), **options)
+        query_items_sync = LocalIndex.query_items_sync
+        threads = []
+
+        def recording_query_items_sync(self, *args):
+            threads.append(threading.current_thread())
+            return query_items_sync(self, *args)
+
+        monkeypatch.setattr(LocalIndex, 'query_items_sync', recording_query_items_sync)
+        results = await index.query_items([1.0, 19.0], 3)
+        assert [result["item"]["id"] for result in results] == ["item-19", "item-18", "item-17"]
+        assert threads and threads[0] is not threading.main_thread()
+        if options:
+            assert index.get_cache_stats()["queries"] == 1
+
+    asyncio.run(run())
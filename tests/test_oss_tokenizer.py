@@ -0,0 +1,13 @@
+import pickle
+
+from all_MiniLM_L6_v2_tokenizer import OSSTokenizer
+
+
+def test_pickles_its_settings_only():
+    tokenizer = OSSTokenizer('some/model', add_special_tokens=False)
+    copy = pickle.loads(pickle.dumps(tokenizer))
+    assert (copy.model_name, copy.add_special_tokens) == ('some/model', False)
+    # The model is loaded on first use, in the process that uses it
+    assert copy._tokenizer is None
+    with copy._load_lock:
+        pass
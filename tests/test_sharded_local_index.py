@@ -0,0 +1,99 @@
+import asyncio
+import random
+
+import pytest
+
+from local_index import LocalIndex
+from sharded_local_index import ShardedLocalIndex
+
+
+def make_items(count, dimensions=8):
+    random.seed(7)
+    return [
+        {"id": f"item-{i}", "vector": [random.random() for _ in range(dimensions)], "metadata": {"even": i % 2 == 0}}
+        for i in range(count)
+    ]
+
+
+async def create_indexes(tmp_path, items, **options):
+    single = LocalIndex(str(tmp_path / 'single'))
+    await single.create_index()
+    sharded = ShardedLocalIndex(str(tmp_path / 'sharded'), shard_count=4, **options)
+    await sharded.create_index()
+    for index in (single, sharded):
+        await index.begin_update()
+        for item in items:
+            await index.add_item_to_update(item, True)
+        await index.end_update()
+    return single, sharded
+
+
+def summarize(results):
+    return [(result["item"]["id"], round(result["score"], 9)) for result in results]
+
+
+@pytest.mark.parametrize('options', [{}, {"query_processes": 2}])
+def test_queries_match_a_single_index(tmp_path, options):
+    async def run():
+        single, sharded = await create_indexes(tmp_path, make_items(60), **options)
+        try:
+            vector = make_items(61)[-1]["vector"]
+            assert summarize(await sharded.query_items(vector, 7)) == summarize(await single.query_items(vector, 7))
+            even = {"even": True}
+            assert (summarize(await sharded.query_items(vector, 5, even))
+                    == summarize(await single.query_items(vector, 5, even)))
+        finally:
+            sharded.close()
+
+    asyncio.run(run())
+
+
+def test_items_are_placed_by_id(tmp_path):
+    async def run():
+        items = make_items(40)
+        _, sharded = await create_indexes(tmp_path, items)
+
+        stats = await sharded.get_index_stats()
+        assert stats["items"] == 40 and sum(stats["shards"]) == 40
+        assert all(count > 0 for count in stats["shards"])
+        for item in items[:10]:
+            assert await sharded.get_shard(item["id"]).get_item(item["id"]) is not None
+
+        # A new instance reads the shard count and places ids on the same shards
+        reopened = ShardedLocalIndex(sharded.folder_path)
+        assert len(reopened.shards) == 4
+        assert (await reopened.get_item("item-3"))["metadata"] == {"even": False}
+        await reopened.upsert_item({"id": "item-3", "vector": items[3]["vector"], "metadata": {"even": True}})
+        await reopened.delete_items(["item-4", "item-5"])
+        assert (await sharded.get_item("item-3"))["metadata"] == {"even": True}
+        assert (await sharded.get_index_stats())["items"] == 38
+        assert len(await sharded.list_items_by_metadata({"even": True})) == 20
+
+    asyncio.run(run())
+
+
+def test_cancelled_update_spans_every_shard(tmp_path):
+    async def run():
+        items = make_items(20)
+        _, sharded = await create_indexes(tmp_path, items)
+        await sharded.begin_update()
+        with pytest.raises(ValueError):
+            await sharded.begin_update()
+        await sharded.insert_item({"id": "new", "vector": items[0]["vector"]})
+        sharded.remove_items_from_update([item["id"] for item in items[:10]])
+        sharded.cancel_update()
+
+        assert (await sharded.get_index_stats())["items"] == 20
+        assert await sharded.get_item("new") is None
+        # Every shard's write lock was released
+        await sharded.insert_item({"id": "new", "vector": items[0]["vector"]})
+        assert (await sharded.get_index_stats())["items"] == 21
+
+    asyncio.run(run())
+
+
+def test_create_requires_a_shard_count(tmp_path):
+    with pytest.raises(ValueError):
+        asyncio.run(ShardedLocalIndex(str(tmp_path / 'index')).create_index())
+    with pytest.raises(ValueError):
+        ShardedLocalIndex(str(tmp_path / 'index')).shards
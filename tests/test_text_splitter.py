@@ -0,0 +1,131 @@
+import pytest
+
+from conftest import WordTokenizer
+from text_splitter import ALPHANUMERIC_CHARS, TextSplitter
+
+TEXT = ('## Heading\n\nOne sentence here, and another one. ' * 30 + '\n\n' +
+        'Final words of the text; more words follow.\n' * 40 + '\n\n' + 'x' * 300)
+
+
+def make_splitter(**config):
+    return TextSplitter({
+        "keep_separators": True,
+        "chunk_size": 24,
+        "chunk_overlap": 4,
+        "tokenizer": WordTokenizer(),
+        "doc_type": "md",
+        **config,
+    })
+
+
+def assert_positioned(chunk):
+    # Parts without any text are dropped, so a chunk's span can hold text its own text skips
+    assert TEXT.startswith(chunk.text[:10], chunk.start_pos)
+    assert TEXT[:chunk.end_pos + 1].endswith(chunk.text[-10:])
+
+
+@pytest.mark.parametrize('tokenize_once', [False, True])
+@pytest.mark.parametrize('keep_separators', [True, False])
+def test_chunks_are_positioned_within_size(keep_separators, tokenize_once):
+    splitter = make_splitter(keep_separators=keep_separators, tokenize_once=tokenize_once)
+    chunks = splitter.split(TEXT)
+    assert chunks
+    for chunk in chunks:
+        assert len(chunk.tokens) <= 24
+        if keep_separators:
+            assert_positioned(chunk)
+
+
+def test_tokenize_once_counts_match_reencoding():
+    # Tokens straddling chunk boundaries used to be dropped, as a word's token starts
+    # on the space before it
+    splitter = make_splitter(tokenize_once=True)
+    tokenizer = splitter.config["tokenizer"]
+    chunks = splitter.split(TEXT)
+    for chunk in chunks:
+        assert chunk.tokens == tokenizer.encode(chunk.text)
+        assert len(chunk.tokens) <= 24
+
+
+def test_stream_matches_split():
+    splitter = make_splitter(stream_window=300)
+    blocks = [TEXT[i:i + 97] for i in range(0, len(TEXT), 97)]
+    streamed = list(splitter.split_stream(blocks))
+    for chunk in streamed:
+        assert_positioned(chunk)
+    assert ''.join(chunk.text for chunk in streamed) == ''.join(chunk.text for chunk in splitter.split(TEXT))
+
+
+def summarize(chunks):
+    return [(chunk.text, chunk.tokens, chunk.start_pos, chunk.end_pos, chunk.start_overlap, chunk.end_overlap)
+            for chunk in chunks]
+
+
+def test_split_batch_matches_split():
+    splitter = make_splitter()
+    texts = [TEXT, TEXT[:900], TEXT[500:]]
+    assert [summarize(chunks) for chunks in splitter.split_batch(texts, max_workers=2)] == [
+        summarize(splitter.split(text)) for text in texts
+    ]
+
+
+class OriginalTextSplitter(TextSplitter):
+    # Checks each part character by character and splits oversized text at every level
+    def contains_alphanumeric(self, text):
+        return any(char in ALPHANUMERIC_CHARS for char in text)
+
+    def _skip_absent_separators(self, text, separators):
+        return separators
+
+
+@pytest.mark.parametrize('doc_type, text', [
+    ('md', TEXT),
+    ('html', '<body>' + ''.join(f'<p>paragraph {i} of the page' + ' word' * (i % 40) for i in range(300))),
+    ('py', ''.join(f'\ndef f{i}():\n' + '    x = 1\n' * (i % 30) for i in range(200))),
+    ('md', '\n\n'.join('## 第{}节\n\n'.format(i) + '数据向量索引。' * (i % 50) for i in range(100))),
+])
+@pytest.mark.parametrize('keep_separators, tokenize_once', [(True, False), (False, False), (True, True)])
+def test_scan_matches_original(doc_type, text, keep_separators, tokenize_once):
+    config = {"doc_type": doc_type, "keep_separators": keep_separators, "tokenize_once": tokenize_once}
+    assert summarize(make_splitter(**config).split(text)) == summarize(
+        OriginalTextSplitter(make_splitter(**config).config).split(text))
+
+
+class ByteTokenizer:
+    """
+    A byte-level tiktoken encoding with a few merges joining ASCII and parts of
+    multibyte characters, so characters are split over tokens sharing an offset
+    and tokens straddle characters.
+    """
+    def __init__(self):
+        tiktoken = pytest.importorskip('tiktoken')
+        ranks = {bytes([i]): i for i in range(256)}
+        for merge in [b' \xe4', b'\xbd\xa0', b' \xe4\xbd\xa0', b'\xe5\xa5', b'\xa5\xbd', b'he', b'll', b'o ',
+                      b'\xe2\x98', b'\x83 ', b'\xc3\xa9', b'f\xc3', b'\xa9 ']:
+            ranks[merge] = len(ranks)
+        self.encoding = tiktoken.Encoding('bytes', pat_str=r" ?\S+|\s+(?!\S)|\s+", mergeable_ranks=ranks,
+                                          special_tokens={})
+
+    def encode(self, text):
+        return self.encoding.encode(text)
+
+    def decode(self, tokens):
+        return self.encoding.decode(tokens)
+
+    def encode_with_offsets(self, text):
+        tokens = self.encoding.encode(text)
+        return tokens, self.encoding.decode_with_offsets(tokens)[1]
+
+
+@pytest.mark.parametrize('chunk_size', [5, 12, 40])
+def test_tokenize_once_keeps_tokens_of_multibyte_characters(chunk_size):
+    words = ['你好', '世界', 'café', '☃', '🙂', 'naïve', 'hello', 'データ', '你', 'é', 'ok']
+    separators = [' ', '', '\n\n', '. ', '  ']
+    text = ''.join(words[i % len(words)] + separators[i * 7 % len(separators)] for i in range(1500))
+    splitter = make_splitter(tokenize_once=True, chunk_size=chunk_size, chunk_overlap=0, tokenizer=ByteTokenizer())
+    tokenizer = splitter.config["tokenizer"]
+    chunks = splitter.split(text)
+    assert chunks
+    for chunk in chunks:
+        assert chunk.tokens == tokenizer.encode(chunk.text)
+        assert len(chunk.tokens) <= chunk_size
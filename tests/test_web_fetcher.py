@@ -0,0 +1,100 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from web_fetcher import HttpCache, WebFetcher
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        PageHandler.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        etag = f'"{self.path}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f"page {self.path}".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    PageHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_many_across_event_loops(server):
+    fetcher = WebFetcher({"maxConcurrency": 4, "maxPerHost": 2})
+    errors = []
+
+    async def fetch(paths):
+        return sorted([result async for result in fetcher.fetch_many(
+            (f"{server}/{path}" for path in paths), on_error=lambda uri, err: errors.append(uri))])
+
+    try:
+        # Each asyncio.run has its own event loop, which the per-host limits must follow
+        for _ in range(2):
+            assert asyncio.run(fetch(["a", "b", "missing", "c"])) == [
+                (f"{server}/{path}", f"page /{path}", None) for path in ["a", "b", "c"]
+            ]
+        assert errors == [f"{server}/missing"] * 2
+    finally:
+        fetcher.close()
+
+
+def test_close_shuts_down_the_executor(server):
+    fetcher = WebFetcher()
+    asyncio.run(fetcher.fetch_async(f"{server}/a"))
+    executor = fetcher._executor
+    fetcher.close()
+    assert executor._shutdown
+    # The fetcher can still be used after closing
+    assert asyncio.run(fetcher.fetch_async(f"{server}/a")) == (f"{server}/a", "page /a", None)
+    fetcher.close()
+
+
+def test_conditional_requests_skip_unchanged_pages(server, tmp_path):
+    fetcher = WebFetcher({"cacheFolder": str(tmp_path / "cache")})
+    try:
+        assert asyncio.run(fetcher.fetch_async(f"{server}/a")) is not None
+        assert asyncio.run(fetcher.fetch_async(f"{server}/a")) is None
+        assert PageHandler.requests == [("/a", None), ("/a", '"/a"')]
+
+        # Validators are scoped, and only saved by the caller of fetch_with_validators_async
+        result = asyncio.run(fetcher.fetch_with_validators_async(f"{server}/a", "scope"))
+        assert result[3] == {"etag": '"/a"', "last_modified": None}
+        assert fetcher.cache.get(f"{server}/a", "scope") is None
+    finally:
+        fetcher.close()
+
+
+def test_http_cache(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    cache.set("https://example.com/", '"1"', None)
+    cache.set("https://example.com/", '"2"', "yesterday", "index")
+    assert cache.get("https://example.com/")["etag"] == '"1"'
+    assert cache.get("https://example.com/", "index")["last_modified"] == "yesterday"
+    cache.set("https://example.com/", None, None)
+    assert cache.get("https://example.com/") is None
+    cache.invalidate("https://example.com/", "index")
+    assert cache.get("https://example.com/", "index") is None